@@ -15,15 +15,26 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import concurrent.futures
 import math
+import os
 import numpy as np
+import threading
 import time
 
 from numbers import Number
 
 from .altitude_data import AltitudeData
-from .database import Database
-from .interpolator import Interpolator
+from .archive import Archive
+from .database import Database, MODALITY_MAP
+from .interpolator import (create_interpolator, FactorizationCache, ENGINES,
+                           MODALITY_ENGINE, DEFAULT_NEIGHBOURS)
+from . import metrics
+from .observation_store import ObservationStore
+from .retention import Retention, DEFAULT_RAW_WINDOW, DEFAULT_HOURLY_WINDOW
+from .singleflight import SingleFlight
+from . import snapshot
 from .sources import Sources
 from .stations import Stations
 
@@ -95,6 +106,11 @@ MODALITY_VRANGE = {
 # Map defining the color scheme used when coloring the maps
 MODALITY_COLORMAP = {"wind_direction": "hsv"}
 
+# Maximum total size in bytes of the cached grid kernel matrices. Grids whose
+# kernel matrix alone exceeds this size (e.g. large ad-hoc grids requested via
+# the REST API) are evaluated block-wise without caching the kernel.
+DEFAULT_MAX_RENDER_PLAN_BYTES = 512 * 1024 * 1024
+
 class PyDWDApiException(Exception):
     pass
 
@@ -112,39 +128,310 @@ class PyDWDApi:
                  sources="./data/sources.xml",
                  stations="./data/stations.xml",
                  altitude_data="./data/etopo1_germany.asc.bz2",
-                 max_observation_age=(4 * 60 * 60)):
+                 max_observation_age=(4 * 60 * 60),
+                 max_render_plans=4,
+                 max_render_plan_bytes=DEFAULT_MAX_RENDER_PLAN_BYTES,
+                 store_window=None,
+                 max_series_interpolators=256,
+                 raw_window=DEFAULT_RAW_WINDOW,
+                 hourly_window=DEFAULT_HOURLY_WINDOW,
+                 snapshot_file=None,
+                 enable_metrics=False,
+                 profiler=None,
+                 archive_dir=None,
+                 compiled_cache=True,
+                 engines=None,
+                 neighbours=DEFAULT_NEIGHBOURS,
+                 single_precision=False):
         # Copy all the settings
         self.ftp_user = ftp_user
         self.ftp_password = ftp_password
         self.database_file = database
-        self.sources = Sources(sources)
-        self.stations = Stations(stations)
-        self.altitude_data = AltitudeData()
+        self.archive_dir = (database + ".archive"
+                            if archive_dir is None else archive_dir)
+        self.sources = Sources(sources, Archive(self.archive_dir)
+                               if self.archive_dir else None, compiled_cache)
+        self.stations = Stations(stations, compiled_cache)
+
+        # Grids, their kernel matrices and the interpolated fields are
+        # evaluated in single precision if single_precision is True, which
+        # halves their memory footprint and the memory bandwidth required for
+        # rendering. The interpolators are still solved in double precision.
+        self.grid_dtype = np.float32 if single_precision else np.float64
+
+        # The altitude data is loaded upon first use or by preload(). The
+        # parsed stations, sources and altitude data are kept in compiled
+        # cache files next to the original files unless compiled_cache is
+        # False.
+        self.altitude_data = AltitudeData(
+            altitude_data if type(altitude_data) is str and altitude_data else
+            None, compiled_cache, self.grid_dtype)
         self.max_observation_age = max_observation_age
 
-        # Initialize the interpolator cache
+        # Interpolation engine used for each modality, see ENGINES. The local
+        # engines take the given number of neighbouring stations into account.
+        self.engines = dict(MODALITY_ENGINE)
+        self.engines.update({} if engines is None else engines)
+        for engine in self.engines.values():
+            if not engine in ENGINES:
+                raise PyDWDApiException("Unknown interpolation engine \"" +
+                                        str(engine) + "\"")
+        self.neighbours = neighbours
+
+        # Optional profiler sampling update cycles and requests, see the
+        # Profiler class
+        self.profiler = profiler
+
+        # Enable the process-wide timing instrumentation and counters
+        if enable_metrics:
+            metrics.registry.enabled = True
+
+        # Initialize the interpolator cache. The solved interpolators for the
+        # latest data are persisted in a snapshot file next to the database
+        # after each update and restored here, such that a restarted server
+        # does not have to rebuild them. An empty snapshot file name disables
+        # snapshots.
         self.interpolators = {}
+        self.snapshot_file = (database + ".snapshot"
+                              if snapshot_file is None else snapshot_file)
+        self.snapshot_stat = None
 
-        # Read the altitude data
-        if type(altitude_data) is str and altitude_data:
-            logger.info("Loading altitude data from " + altitude_data)
-            if altitude_data.endswith(".bz2"):
-                import bz2
-                with bz2.BZ2File(altitude_data) as f:
-                    self.altitude_data.read(f)
-            else:
-                with open(altitude_data, "rb") as f:
-                    self.altitude_data.read(f)
+        # If True, update() does not download any data but reloads the snapshot
+        # file whenever it was replaced by another process. Used by the workers
+        # of the pre-fork server.
+        self.follow_snapshot = False
+
+        # The observation store mirrors the recent observations in memory, it
+        # is lazily loaded from the database upon first use. A window of zero
+        # disables the store.
+        self.store = None
+        if store_window is None or store_window > 0:
+            self.store = ObservationStore(max_observation_age
+                                          if store_window is None else
+                                          store_window)
+        self.store_loaded = False
+
+        # Databases created by older versions are migrated by migrate(),
+        # rowid at which the migration continues or None once it is done
+        self.migration_rowid = 0
+
+        # Retention subsystem, rolls up and deletes old observations
+        self.retention = Retention(database, raw_window, hourly_window)
+
+        # Separate cache pool used when evaluating time series
+        self.max_series_interpolators = max_series_interpolators
+        self.series_interpolators = collections.OrderedDict()
+
+        # Initialize the cache holding the grids and grid-to-station kernel
+        # matrices used for rendering maps. Each kernel matrix requires
+        # resolution^2 x number of stations x 8 bytes (4 bytes in single
+        # precision). The cache is limited both in the number of kernel
+        # matrices and their total size.
+        self.max_render_plans = max_render_plans
+        self.max_render_plan_bytes = max_render_plan_bytes
+        self.grids = collections.OrderedDict()
+        self.render_plans = collections.OrderedDict()
+        self.render_plan_bytes = 0
 
+        # Concurrent requests for the same interpolator or concurrent updates
+        # are coalesced into a single computation. The cache lock protects the
+        # interpolator caches.
+        self.builds = SingleFlight()
+        self.updates = SingleFlight()
+        self.cache_lock = threading.RLock()
+
+        # Kernel factorizations of recently used station sets, new data for
+        # the same or a similar set of stations is solved in O(N^2)
+        self.factorizations = FactorizationCache()
+
+        # Restore the interpolators from the snapshot file
+        self.refresh_snapshot()
+
+    def preload(self, background=False):
+        """
+        Loads the altitude data, which is otherwise loaded upon the first
+        request requiring it. If background is True, the data is loaded in a
+        background thread and the thread is returned, such that a server can
+        accept requests while loading.
+        """
+        if background:
+            thread = threading.Thread(target=self.preload, daemon=True)
+            thread.start()
+            return thread
+        try:
+            self.altitude_data.load()
+        except Exception:
+            logger.exception("Error while loading the altitude data")
 
     def update(self):
-        if not self.ftp_user or not self.ftp_password:
-            logger.warn("No username or password given, will not download new data")
+        """
+        Downloads new data. Concurrent calls wait for the update which is
+        already in progress instead of starting another one.
+        """
+        return self.updates.do("update", self._update)
+
+    def _update(self):
+        with metrics.registry.stage("update"):
+            if (not self.follow_snapshot and not self.profiler is None and
+                    self.profiler.sample("update")):
+                self.profiler.run(self._update_data, "update")
+            else:
+                self._update_data()
+
+    def _update_data(self):
+        if self.follow_snapshot:
+            self.refresh_snapshot()
             return
-        with Database(self.database_file) as database:
+        with Database(self.database_file, self._store()) as database:
             if self.sources.update(self.ftp_user, self.ftp_password,
                                    self.stations, database):
-                self.interpolators = {}
+                with self.cache_lock:
+                    self.interpolators = {}
+                    self.series_interpolators.clear()
+                self.save_snapshot(database)
+
+    def stats(self):
+        """
+        Returns the number of performed and coalesced interpolator builds and
+        updates, as well as the number of reused, updated and newly computed
+        kernel factorizations.
+        """
+        return {
+            "interpolator_builds": self.builds.stats(),
+            "updates": self.updates.stats(),
+            "factorizations": self.factorizations.stats()
+        }
+
+    def save_snapshot(self, database=None):
+        """
+        Builds the interpolators for the latest data of all modalities and
+        writes them to the snapshot file.
+        """
+        if not self.snapshot_file:
+            return
+        if database is None:
+            with Database(self.database_file) as database:
+                return self.save_snapshot(database)
+        interpolators = {}
+        for modality in MODALITY_MAP:
+            try:
+                interpolator, latest_ts = self._interpolator(database, modality)
+            except Exception:
+                logger.exception("Error while building the interpolator for " +
+                                 modality)
+                continue
+            if not interpolator is None:
+                interpolators[(modality, latest_ts)] = interpolator
+        snapshot.save(self.snapshot_file, interpolators, self.stations)
+        logger.info("Wrote " + str(len(interpolators)) +
+                    " interpolator(s) to " + self.snapshot_file)
+
+    def refresh_snapshot(self):
+        """
+        Loads the snapshot file into the interpolator cache if it was replaced
+        since it was last loaded. Since the snapshot is only written after new
+        observations have been stored, the observation store is reloaded as
+        well. Returns True if the snapshot was loaded.
+        """
+        if not self.snapshot_file:
+            return False
+        try:
+            stat = os.stat(self.snapshot_file)
+        except OSError:
+            return False
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if key == self.snapshot_stat:
+            return False
+        interpolators = snapshot.load(self.snapshot_file, self.stations)
+        self.snapshot_stat = key
+        with self.cache_lock:
+            self.interpolators = {
+                key: [interpolator, 0]
+                for key, interpolator in interpolators.items()
+                if interpolator.engine == self._engine(key[0]) and getattr(
+                    interpolator, "neighbours", self.neighbours) ==
+                self.neighbours
+            }
+            self.series_interpolators.clear()
+            self.store_loaded = False
+        logger.info("Restored " + str(len(self.interpolators)) +
+                    " interpolator(s) from " + self.snapshot_file)
+        return True
+
+    def migrate(self, background=False, max_time=None):
+        """
+        Creates the missing indices, removes duplicate observations from
+        databases created by older versions and creates the unique index
+        preventing new duplicates, see Database.migrate_observations(). Does nothing if this has already
+        been done. If background is True, the migration runs in a background
+        thread, which is returned. If max_time is given, the method returns
+        after about max_time seconds, subsequent calls continue the migration.
+        """
+        if background:
+            thread = threading.Thread(target=self.migrate, daemon=True)
+            thread.start()
+            return thread
+        if self.migration_rowid is None:
+            return
+        try:
+            with Database(self.database_file) as database:
+                self.migration_rowid = database.migrate_observations(
+                    self.migration_rowid, max_time=max_time)
+        except Exception:
+            logger.exception("Error while migrating the database")
+            self.migration_rowid = None
+
+    def apply_retention(self, background=False, interval=(60 * 60)):
+        """
+        Rolls up raw observations older than the raw retention window into
+        hourly aggregates and hourly aggregates older than the hourly retention
+        window into daily aggregates, deleting the original rows. If background
+        is True, this is done periodically in a background thread.
+        """
+        if background:
+            self.retention.start(interval)
+        else:
+            return self.retention.run()
+
+    def _store(self, database=None):
+        """
+        Returns the observation store, loads it from the database upon first
+        use. Returns None if the store is disabled.
+        """
+        if self.store is None or self.store_loaded:
+            return self.store
+        if database is None:
+            with Database(self.database_file) as database:
+                return self._store(database)
+
+        def load():
+            if not self.store_loaded:
+                self.store.load(database, time.time())
+                self.store_loaded = True
+                logger.info("Loaded " + str(self.store.size) +
+                            " observation(s) into the observation store")
+            return self.store
+
+        return self.updates.do("store", load)
+
+    def _query_observations(self, database, modality, since, max_ts):
+        """
+        Returns the latest observation per station for the given modality,
+        either from the observation store or, if the time range is not covered
+        by the store, from the database.
+        """
+        store = self._store(database)
+        if not store is None and store.covers(since):
+            with metrics.registry.stage("query_observations_store"):
+                res = store.query_observations(modality, since, max_ts)
+            metrics.registry.inc("pydwdapi_station_observations_total", len(res),
+                                 (("source", "store"), ))
+        else:
+            with metrics.registry.stage("query_observations_database"):
+                res = database.query_observations(modality, since, max_ts)
+            metrics.registry.inc("pydwdapi_station_observations_total", len(res),
+                                 (("source", "database"), ))
+        return res
 
     def _cleanup_caches(self):
         """
@@ -181,6 +468,63 @@ class PyDWDApi:
         since = ts - self.max_observation_age
         return since, ts
 
+    def _interpolator(self, database, modality, ts=None):
+        """
+        Returns the interpolator for the given modality at the given time,
+        along with the timestamp of the latest observation used by the
+        interpolator. Returns (None, 0.0) if no data is available.
+        """
+        # Load the observations for this timestamp from the database
+        since, max_ts = self._since_max_ts_pair(ts)
+        observations = self._query_observations(database, modality, since,
+                                                max_ts)
+        if (len(observations) == 0):
+            return None, 0.0
+        return self._cached_interpolator(modality, observations)
+
+    def _engine(self, modality):
+        return self.engines[modality] if modality in self.engines else "rbf"
+
+    def _create_interpolator(self, modality, observations):
+        return create_interpolator(observations, self.stations, modality,
+                                   self._engine(modality), self.factorizations,
+                                   self.neighbours)
+
+    def _cached_interpolator(self, modality, observations):
+        """
+        Returns the interpolator for the given observations along with the
+        timestamp of the latest observation. Interpolators are cached by
+        modality and the latest observation timestamp.
+        """
+        latest_ts = max(map(lambda x: x[1], observations.values()))
+
+        # Check whether an interpolator already exists for this timestamp -- if
+        # not, create it. Concurrent requests for the same interpolator wait for
+        # a single build.
+        cache_entry = (modality, latest_ts)
+        with self.cache_lock:
+            if cache_entry in self.interpolators:
+                interpolator = self.interpolators[cache_entry][0]
+                self._update_caches(cache_entry)
+                metrics.registry.inc("pydwdapi_interpolator_cache_hits_total")
+                return interpolator, latest_ts
+        metrics.registry.inc("pydwdapi_interpolator_cache_misses_total")
+
+        def build():
+            with metrics.registry.stage("interpolator_build"):
+                return self._create_interpolator(modality, observations)
+
+        # The cache may have been replaced (refresh_snapshot()) or the entry
+        # evicted in the meantime, the interpolator is thus returned from the
+        # local variable and only inserted if the entry is still missing
+        interpolator = self.builds.do(cache_entry, build)
+        with self.cache_lock:
+            if not cache_entry in self.interpolators:
+                self._cleanup_caches()
+                self.interpolators[cache_entry] = [interpolator, 0]
+            self._update_caches(cache_entry)
+        return interpolator, latest_ts
+
     def interpolate_observations(self, modalities, lats, lons, alts, ts=None):
         """
         Returns interpolated data for the given observation modality and an
@@ -203,61 +547,253 @@ class PyDWDApi:
         with Database(self.database_file) as database:
             res = []
             for modality in modalities:
-                # Load the observations for this timestamp from the database
-                since, max_ts = self._since_max_ts_pair(ts)
-                observations = database.query_observations(modality, since,
-                                                           max_ts)
-                if (len(observations) == 0):
+                interpolator, latest_ts = self._interpolator(database,
+                                                             modality, ts)
+                if interpolator is None:
                     return None, 0.0
-                latest_ts = max(map(lambda x: x[1], observations.values()))
                 res_ts = max(res_ts, latest_ts)
 
-                # Check whether an interpolator already exists for this
-                # timestamp -- if not, create it
-                cache_entry = (modality, latest_ts)
-                if not cache_entry in self.interpolators:
-                    self._cleanup_caches()
-                    self.interpolators[cache_entry] = [Interpolator(
-                        observations, self.stations, modality), 0]
-
                 # Call the actual interpolation routine
-                res.append(self.interpolators[cache_entry][0].interpolate(
-                    lats, lons, alts))
+                with metrics.registry.stage("interpolate"):
+                    res.append(interpolator.interpolate(lats, lons, alts))
+        return res, res_ts
 
-                # Perform some cache management -- update the usage counts
-                self._update_caches(cache_entry)
+    def _series_interpolators(self, modality, snapshots, workers=None):
+        """
+        Returns the interpolators for the given list of (latest_ts,
+        observations) snapshots. Interpolators are taken from the main cache if
+        present, otherwise from a separate cache pool, such that evaluating
+        long time series does not evict the interpolators for the current data.
+        Missing interpolators are built in parallel.
+        """
+        res = [None] * len(snapshots)
+        missing = []
+        with self.cache_lock:
+            for i, (latest_ts, observations) in enumerate(snapshots):
+                key = (modality, latest_ts)
+                if key in self.interpolators:
+                    res[i] = self.interpolators[key][0]
+                elif key in self.series_interpolators:
+                    self.series_interpolators.move_to_end(key)
+                    res[i] = self.series_interpolators[key]
+                else:
+                    missing.append(i)
+
+        # Build the missing interpolators -- the heavy lifting happens in NumPy
+        # and LAPACK, which release the GIL
+        def build(i):
+            return self.builds.do(
+                (modality, snapshots[i][0]),
+                lambda: self._create_interpolator(modality, snapshots[i][1]))
+
+        workers = os.cpu_count() if workers is None else workers
+        if len(missing) > 1 and workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(
+                    min(workers, len(missing))) as executor:
+                built = list(executor.map(build, missing))
+        else:
+            built = list(map(build, missing))
+        with self.cache_lock:
+            for i, interpolator in zip(missing, built):
+                res[i] = interpolator
+                self.series_interpolators[(modality,
+                                           snapshots[i][0])] = interpolator
+            while len(self.series_interpolators) > \
+                    self.max_series_interpolators:
+                self.series_interpolators.popitem(last=False)
+        return res
+
+    def interpolate_series(self,
+                           modalities,
+                           lats,
+                           lons,
+                           alts,
+                           timestamps,
+                           workers=None):
+        """
+        Evaluates the interpolated data for the given modalities at the given
+        locations for each of the given timestamps. All observations in the
+        time range are fetched with a single range scan per modality,
+        timestamps resolving to the same latest observation share one
+        interpolator. Returns a list containing an array of shape (timestamps,
+        locations) per modality, containing NaN where no data is available, and
+        a list of arrays containing the timestamp of the latest observation
+        used for each timestamp.
+        """
+        if type(modalities) is str:
+            modalities = [modalities]
+        lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+        lons = np.atleast_1d(np.asarray(lons, dtype=np.float64))
+        alts = np.atleast_1d(np.asarray(alts, dtype=np.float64))
+        timestamps = np.atleast_1d(np.asarray(timestamps, dtype=np.float64))
+
+        res, res_ts = [], []
+        with Database(self.database_file) as database:
+            for modality in modalities:
+                values = np.full((len(timestamps), len(lats)), np.nan)
+                values_ts = np.zeros(len(timestamps))
+                res.append(values)
+                res_ts.append(values_ts)
+                if len(timestamps) == 0:
+                    continue
+
+                # Load all observations which may contribute to any of the
+                # timestamps
+                since = np.min(timestamps) - self.max_observation_age
+                rows = database.query_observation_range(
+                    modality, since, np.max(timestamps))
+
+                # Observations rolled up by the retention subsystem are only
+                # available as aggregates, use their latest observations
+                aggregates = database.query_aggregate_range(
+                    modality, since, np.max(timestamps))
+                if len(aggregates) > 0:
+                    rows = sorted(rows + aggregates)
+                if len(rows) == 0:
+                    continue
+                tbl = np.array(rows, dtype=np.float64)
+                store = ObservationStore(np.inf, len(rows))
+                store.append(tbl[:, 0], tbl[:, 1], MODALITY_MAP[modality],
+                             tbl[:, 2], tbl[:, 3])
+
+                # Determine the latest observation for each timestamp and group
+                # the timestamps accordingly
+                obs_ts = tbl[:, 0]
+                idcs = np.searchsorted(obs_ts, timestamps, side="right") - 1
+                latest = np.where(idcs >= 0, obs_ts[np.maximum(idcs, 0)],
+                                  -np.inf)
+                valid = latest > timestamps - self.max_observation_age
+                groups, snapshots = [], []
+                for latest_ts in np.unique(latest[valid]):
+                    group = np.flatnonzero(valid & (latest == latest_ts))
+                    t = timestamps[group[0]]
+                    groups.append(group)
+                    snapshots.append((float(latest_ts), store.query_observations(
+                        modality, t - self.max_observation_age, t)))
+
+                # Evaluate each distinct interpolator once
+                interpolators = self._series_interpolators(modality,
+                                                           snapshots, workers)
+                for group, (latest_ts, _), interpolator in zip(
+                        groups, snapshots, interpolators):
+                    values[group] = interpolator.interpolate(lats, lons, alts)
+                    values_ts[group] = latest_ts
         return res, res_ts
 
+    def query_history(self,
+                      modality,
+                      start,
+                      end,
+                      step,
+                      station_id=None,
+                      lat=None,
+                      lon=None,
+                      alt=None,
+                      agg="mean"):
+        """
+        Returns the time series of the given modality for either a station or
+        a location in the half-open time range [start, end). Station
+        observations are aggregated server-side into buckets of the given step
+        size using the aggregation function "agg". For locations, the
+        interpolated value is evaluated at each step start, start + step, ...
+        before end.
+        Returns a dictionary with meta information as well as the arrays of
+        timestamps and values.
+
+        Beyond the raw retention window, observations are only available as
+        the hourly and daily aggregates written by the retention subsystem
+        (see retention.py). These are aggregated into the buckets containing
+        their start time; interpolation uses the latest observation of each
+        aggregate.
+        """
+        from . import history
+
+        if not modality in MODALITY_MAP:
+            raise PyDWDApiException("Unknown modality " + str(modality))
+        meta = {"modality": modality, "start": start, "end": end,
+                "step": step}
+        if not station_id is None:
+            with Database(self.database_file) as database:
+                rows = [(t, 1, v, v, v, v) for t, v in database.query_history(
+                    station_id, modality, start, end)]
+                rows += database.query_aggregate_history(
+                    station_id, modality, start, end)
+            tbl = np.array(sorted(rows), dtype=np.float64).reshape(-1, 6)
+            history.steps(start, end, step)  # Make sure the range is sane
+            ts, values = history.downsample_aggregates(
+                *tbl.T, start, end, step, agg)
+            meta["id"] = station_id
+            meta["agg"] = agg
+        else:
+            if alt is None:
+                if not self.altitude_data.in_bounds(lat, lon):
+                    raise PyDWDApiException("No altitude data available for the given point, please specify explicitly!")
+                alt = round(float(self.altitude_data.query(lat, lon)[0]), 2)
+            ts = history.steps(start, end, step)
+            values, _ = self.interpolate_series(modality, lat, lon, alt, ts)
+            values = values[0][:, 0]
+            ts, values = ts[~np.isnan(values)], values[~np.isnan(values)]
+            meta["coord"] = {"lat": lat, "lon": lon, "alt": float(alt)}
+        return {"meta": meta, "dt": ts, "values": values}
+
     def query_stations(self, station_ids, ts=None):
         """
         Queries the current weather data for the given stations.
         """
         if isinstance(station_ids, Number):
             station_ids = [station_ids]
+        station_ids = list(station_ids)
 
-        res = {}
+        # Fetch the latest observations for all stations at once
+        since, max_ts = self._since_max_ts_pair(ts)
         with Database(self.database_file) as database:
-            since, max_ts = self._since_max_ts_pair(ts)
-            for station_id in station_ids:
-                since, max_ts = self._since_max_ts_pair(ts)
-                observations = database.query_observations_for_station(station_id, since, max_ts)
-                for key, value in observations.items():
-                    observations[key] = {
-                        "value": observations[key][0],
-                        "dt": observations[key][1],
-                        "src": observations[key][2]
-                    }
-                if station_id in self.stations.ids:
-                    coords = self.stations.coords[station_id]
-                res[station_id] = {
-                    "meta": {
-                        "names":  self.stations.ids[station_id],
-                        "lat": coords[0],
-                        "lon": coords[1],
-                        "alt": coords[2]
-                    },
-                    "data": observations
-                }
+            store = self._store(database)
+            if not store is None and store.covers(since):
+                observations = store.query_observations_for_stations(
+                    station_ids, since, max_ts)
+            else:
+                observations = database.query_observations_for_stations(
+                    station_ids, since, max_ts)
+
+        res = {}
+        for station_id in station_ids:
+            if station_id in self.stations.ids:
+                names = self.stations.ids[station_id]
+                lat, lon, alt = self.stations.coords[station_id]
+            else:
+                names, lat, lon, alt = [], None, None, None
+            data = {}
+            if station_id in observations:
+                for key, value in observations[station_id].items():
+                    data[key] = {"value": value[0], "dt": value[1],
+                                 "src": value[2]}
+            res[station_id] = {
+                "meta": {
+                    "names": names,
+                    "lat": lat,
+                    "lon": lon,
+                    "alt": alt
+                },
+                "data": data
+            }
+        return res
+
+    def query_nearest_stations(self, lat, lon, k=5, radius=None, ts=None):
+        """
+        Returns the k stations nearest to the given location along with their
+        latest observations. If a radius (in km) is given, only stations within
+        this radius are returned. The result is sorted by distance.
+        """
+        if radius is None:
+            nearest = self.stations.nearest(lat, lon, k)
+        else:
+            nearest = self.stations.within(lat, lon, radius)[0:k]
+        data = self.query_stations([sid for sid, _ in nearest], ts)
+        res = []
+        for sid, distance in nearest:
+            data[sid]["meta"]["id"] = sid
+            data[sid]["meta"]["distance"] = round(distance, 3)
+            res.append(data[sid])
         return res
 
     def query_interpolated(self, lat, lon, alt=None, ts=None):
@@ -283,7 +819,9 @@ class PyDWDApi:
         # Try to find the altitude if none is given
         if alt is None:
             if self.altitude_data.in_bounds(lat, lon):
-                alt = round(self.altitude_data.query(lat, lon)[0], 2)
+                with metrics.registry.stage("altitude_lookup"):
+                    alt = round(
+                        float(self.altitude_data.query(lat, lon)[0]), 2)
             else:
                 raise PyDWDApiException("No altitude data available for the given point, please specify explicitly!")
 
@@ -307,6 +845,165 @@ class PyDWDApi:
         query_interpolated_key(response["wind"], "wind_direction", "deg")
         return response
 
+    def _map_extents(self, extents=None):
+        """
+        Returns the map extents as tuple (min_lat, max_lat, min_lon, max_lon).
+        If no extents are given, the extents are chosen such that all stations
+        are included.
+        """
+        if extents is None:
+            station_coords = np.array(list(self.stations.coords.values()))
+            return (np.min(station_coords[:, 0]) - 0.5,
+                    np.max(station_coords[:, 0]) + 0.5,
+                    np.min(station_coords[:, 1]) - 0.5,
+                    np.max(station_coords[:, 1]) + 0.5)
+        min_lat, max_lat, min_lon, max_lon = extents
+        return (min_lat, max_lat, min_lon, max_lon)
+
+    def _grid(self, extents, resolution, altitude=None):
+        """
+        Creates the latitude, longitude and altitude arrays for a regular grid
+        with the given extents and resolution. The first array dimension
+        corresponds to the longitude, the second one to the latitude. If no
+        altitude is given, the altitude is read from the altitude data, which
+        must cover the extents. Grids are cached, as querying the altitude data
+        for each pixel is expensive.
+        """
+        key = (tuple(map(float, extents)), int(resolution), altitude)
+        if key in self.grids:
+            self.grids.move_to_end(key)
+            return self.grids[key]
+
+        min_lat, max_lat, min_lon, max_lon = extents
+        lats, lons = np.meshgrid(
+            np.linspace(min_lat, max_lat, resolution),
+            np.linspace(min_lon, max_lon, resolution))
+        if altitude is None:
+            if not (self.altitude_data.in_bounds(min_lat, min_lon) and
+                    self.altitude_data.in_bounds(max_lat, max_lon)):
+                raise PyDWDApiException("No altitude data available for the given extents, please specify the altitude explicitly!")
+            alts = np.maximum(self.altitude_data.query(lats, lons), 0)
+        else:
+            alts = np.tile(altitude, (resolution, resolution))
+        lats = np.reshape(lats, (resolution, resolution, 1)).astype(
+            self.grid_dtype)
+        lons = np.reshape(lons, (resolution, resolution, 1)).astype(
+            self.grid_dtype)
+        alts = np.reshape(alts, (resolution, resolution, 1)).astype(
+            self.grid_dtype)
+
+        self.grids[key] = (lats, lons, alts)
+        while len(self.grids) > max(1, self.max_render_plans):
+            self.grids.popitem(last=False)
+        return lats, lons, alts
+
+    def _grid_kernel(self, interpolator, extents, resolution, altitude=None):
+        """
+        Returns the kernel matrix between the pixels of the given grid and the
+        stations used by the given interpolator. Since the kernel only depends
+        on the grid, the altitude weight and the set of stations, it is cached
+        and can be reused for all subsequent observations -- evaluating the
+        interpolator is then a single matrix-vector product. Returns None if
+        the kernel matrix is not cached because it exceeds the size limit of
+        the cache.
+        """
+        nbytes = interpolator.kernel_nbytes(resolution * resolution,
+                                            self.grid_dtype)
+        if self.max_render_plans <= 0 or nbytes > self.max_render_plan_bytes:
+            return None
+
+        key = (tuple(map(float, extents)), int(resolution), altitude,
+               interpolator.engine, interpolator.altitude_weight,
+               interpolator.station_ids.tobytes())
+        with self.cache_lock:
+            if key in self.render_plans:
+                self.render_plans.move_to_end(key)
+                return self.render_plans[key][0]
+
+        lats, lons, alts = self._grid(extents, resolution, altitude)
+        kernel = interpolator.kernel(lats, lons, alts, self.grid_dtype)
+        with self.cache_lock:
+            if not key in self.render_plans:
+                self.render_plans[key] = (kernel, nbytes)
+                self.render_plan_bytes += nbytes
+            while (len(self.render_plans) > self.max_render_plans or
+                   self.render_plan_bytes > self.max_render_plan_bytes):
+                _, (_, evicted) = self.render_plans.popitem(last=False)
+                self.render_plan_bytes -= evicted
+        return kernel
+
+    def interpolate_grid(self,
+                         modalities,
+                         extents=None,
+                         resolution=256,
+                         altitude=None,
+                         ts=None):
+        """
+        Evaluates the interpolated fields of the given modalities on a regular
+        grid. Returns a list containing one resolution x resolution array per
+        modality (or None if no data is available for one of the modalities)
+        and the timestamp of the latest data incorporated in the result. The
+        first array dimension corresponds to the longitude, the second one to
+        the latitude. The arrays are of type float32 if the instance was
+        created with single_precision=True.
+        """
+        if type(modalities) is str:
+            modalities = [modalities]
+        extents = self._map_extents(extents)
+
+        res_ts = 0
+        with Database(self.database_file) as database:
+            res = []
+            for modality in modalities:
+                interpolator, latest_ts = self._interpolator(database,
+                                                             modality, ts)
+                if interpolator is None:
+                    return None, 0.0
+                res_ts = max(res_ts, latest_ts)
+
+                kernel = self._grid_kernel(interpolator, extents, resolution,
+                                           altitude)
+                if kernel is None:
+                    lats, lons, alts = self._grid(extents, resolution,
+                                                  altitude)
+                    res.append(interpolator.interpolate(
+                        lats[..., 0], lons[..., 0], alts[..., 0],
+                        self.grid_dtype))
+                else:
+                    res.append(interpolator.interpolate_kernel(
+                        kernel, (resolution, resolution)))
+        return res, res_ts
+
+    def query_grid(self,
+                   modalities,
+                   extents=None,
+                   resolution=256,
+                   altitude=None,
+                   ts=None):
+        """
+        Returns the interpolated fields of the given modalities as a single
+        little-endian float32 array of shape (modality, latitude, longitude).
+        Latitudes and longitudes are in ascending order. Modalities for which no
+        data is available are filled with NaN. The second return value is the
+        timestamp of the latest data incorporated in the result.
+        """
+        if type(modalities) is str:
+            modalities = [modalities]
+        extents = self._map_extents(extents)
+
+        res = np.full((len(modalities), resolution, resolution), np.nan,
+                      dtype="<f4")
+        res_ts = 0.0
+        for i, modality in enumerate(modalities):
+            if not modality in MODALITY_MAP:
+                raise PyDWDApiException("Unknown modality " + str(modality))
+            zzs, zzs_ts = self.interpolate_grid(modality, extents, resolution,
+                                                altitude, ts)
+            if not zzs is None:
+                res[i] = zzs[0].T
+                res_ts = max(res_ts, zzs_ts)
+        return res, res_ts
+
     def render_map(self,
                    modality,
                    extents=None,
@@ -321,36 +1018,17 @@ class PyDWDApi:
         import matplotlib
         import matplotlib.pyplot as plt
 
-        # Fetch the minimum/maximum latitude
-        station_coords = np.array(list(self.stations.coords.values()))
-        if extents is None:
-            min_lat = np.min(station_coords[:, 0]) - 0.5
-            max_lat = np.max(station_coords[:, 0]) + 0.5
-            min_lon = np.min(station_coords[:, 1]) - 0.5
-            max_lon = np.max(station_coords[:, 1]) + 0.5
-        else:
-            min_lat, max_lat, min_lon, max_lon = extents
-
-        lats, lons = np.meshgrid(
-            np.linspace(min_lat, max_lat, resolution),
-            np.linspace(min_lon, max_lon, resolution))
-        if altitude is None:
-            alts = np.maximum(self.altitude_data.query(lats, lons), 0)
-        else:
-            alts = np.tile(altitude, (resolution, resolution))
-        lats = np.reshape(lats, (resolution, resolution, 1))
-        lons = np.reshape(lons, (resolution, resolution, 1))
-        alts = np.reshape(alts, (resolution, resolution, 1))
-
         # Perform the actual interpolation
-        zzs, res_ts = self.interpolate_observations(modality, lats, lons, alts,
-                                            ts)
+        extents = self._map_extents(extents)
+        min_lat, max_lat, min_lon, max_lon = extents
+        zzs, res_ts = self.interpolate_grid(modality, extents, resolution,
+                                            altitude, ts)
         if zzs is None:
             fig = plt.figure()
             fig.gca().annotate("No data available")
             return fig
 
-        zzs = zzs[0][:, :, 0]
+        zzs = zzs[0]
 
         # Fetch the currect value range for coloring the map
         if modality in MODALITY_VRANGE:
@@ -408,3 +1086,53 @@ class PyDWDApi:
 
         return fig
 
+    def render_png(self,
+                   modality,
+                   extents=None,
+                   ts=None,
+                   resolution=256,
+                   altitude=None,
+                   bare=False):
+        """
+        Renders the given quantity into a PNG image without using matplotlib.
+        The interpolated field is colormapped and the German border as well as
+        the station locations are rasterized directly into the image. Returns
+        the PNG file content as bytes.
+        """
+        from . import raster
+
+        extents = self._map_extents(extents)
+        zzs, res_ts = self.interpolate_grid(modality, extents, resolution,
+                                            altitude, ts)
+        if zzs is None:
+            raise PyDWDApiException("No data available")
+        zzs = zzs[0]
+
+        # Fetch the currect value range for coloring the map
+        if modality in MODALITY_VRANGE:
+            vmin, vmax = MODALITY_VRANGE[modality]
+        else:
+            vmin, vmax = (np.min(zzs), np.max(zzs))
+        cmap = (MODALITY_COLORMAP[modality] if modality in MODALITY_COLORMAP
+                else "jet")
+
+        # Rasterize the map and the overlay
+        text = {}
+        if bare:
+            img = raster.render(zzs, extents, vmin, vmax, cmap, colorbar=False)
+        else:
+            stations = [(lat, lon) for _, lat, lon, _, _ in
+                        self.stations.name_and_location_list()]
+            img = raster.render(zzs, extents, vmin, vmax, cmap, GERMAN_BORDER,
+                                stations)
+            title = (MODALITY_TITLES[modality] if modality in MODALITY_TITLES
+                     else modality)
+            unit = (" [" + MODALITY_UNITS[modality] + "]"
+                    if modality in MODALITY_UNITS else "")
+            text = {
+                "Title": title + unit,
+                "Creation Time": time.strftime("%Y/%m/%d %H:%M",
+                                               time.localtime(res_ts)),
+                "Comment": "Range " + str(vmin) + " to " + str(vmax)
+            }
+        return raster.encode_png(img, text)
@@ -16,15 +16,41 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import threading
 import numpy as np
-import scipy.interpolate
+
+from . import compiled_cache
+
+# Fetch the logger
+import logging
+logger = logging.getLogger("pydwdapi")
+
 
 class AltitudeData:
     """
     Simple class for reading and querying altitude data.
     """
 
-    def __init__(self):
+    def __init__(self, filename=None, cache=False, dtype=np.float64):
+        """
+        filename : str
+            If given, the ArcGIS ASCII Grid file (optionally bz2 compressed)
+            the altitude data is loaded from upon first use, see load().
+        cache : bool
+            If True, the parsed grid is stored in a compiled cache file next
+            to the grid file, see compiled_cache.py.
+        dtype : type
+            Floating point type the altitude data is stored in and queried
+            with. np.float32 halves the memory footprint, the queried
+            altitudes deviate from the np.float64 result by at most
+            FLOAT32_ERROR_FACTOR * eps * max(abs(data)), see interpolator.py,
+            i.e. well below one centimetre.
+        """
+        self.filename = filename
+        self.cache = cache
+        self.dtype = np.dtype(dtype)
+        self.lock = threading.Lock()
+        self.error = None
         self.meta = {
             "ncols": 0,
             "nrows": 0,
@@ -36,7 +62,50 @@ class AltitudeData:
         self.xs = np.array(())
         self.ys = np.array(())
 
+    def load(self):
+        """
+        Loads the altitude data from the file passed to the constructor, if
+        this has not been done yet. Called implicitly by in_bounds() and
+        query(), may be called explicitly (e.g. from a background thread) to
+        avoid delaying the first request. The file is read only once; if this
+        fails, the error is remembered and raised again by all further calls.
+        """
+        if self.filename is None and self.error is None:
+            return
+        with self.lock:
+            if not self.error is None:
+                raise Exception(self.error)
+            if self.filename is None:
+                return
+            filename = self.filename
+            logger.info("Loading altitude data from " + filename)
+            try:
+                if self.cache:
+                    self.meta, self.data = compiled_cache.load(
+                        filename, self._read_file,
+                        "altitude_data_" + self.dtype.name)
+                else:
+                    self.meta, self.data = self._read_file(filename)
+                self._init_grid()
+            except Exception as e:
+                self.error = ("Error while loading the altitude data from " +
+                              filename + ": " + str(e))
+                raise
+            finally:
+                self.filename = None
+
+    def _read_file(self, filename):
+        if filename.endswith(".bz2"):
+            import bz2
+            with bz2.BZ2File(filename) as f:
+                self.read(f)
+        else:
+            with open(filename, "rb") as f:
+                self.read(f)
+        return self.meta, self.data
+
     def in_bounds(self, lat, lon):
+        self.load()
         return (lat >= self.ys[0]) and (lat <= self.ys[-1]) and (
             lon >= self.xs[0]) and (lon <= self.xs[-1])
 
@@ -58,7 +127,7 @@ class AltitudeData:
                 else:
                     in_header = False
                     self.data = np.zeros((self.meta["nrows"], self.meta[
-                        "ncols"]))
+                        "ncols"]), dtype=self.dtype)
             elif i < self.meta["nrows"]:
                 row = list(map(float, filter(None, s[:-1].split(" "))))
                 if len(row) == self.meta["ncols"]:
@@ -70,8 +139,10 @@ class AltitudeData:
                 raise Exception("Invalid row count")
 
         # Flip the data -- origin is in the lower-left corner
-        self.data = np.flipud(self.data)
+        self.data = np.ascontiguousarray(np.flipud(self.data))
+        self._init_grid()
 
+    def _init_grid(self):
         # Create the grid meta information
         ncols = self.meta["ncols"]
         nrows = self.meta["nrows"]
@@ -86,14 +157,37 @@ class AltitudeData:
         """
         Returns the altitude data for the given points stored in lats and lons.
         lats and lons must have the same shape and may for example be created by
-        a call to numpy.meshgrid().
+        a call to numpy.meshgrid(). The result has the floating point type of the
+        stored altitude data.
         """
         from numbers import Number
 
+        self.load()
         if isinstance(lats, Number):
             lats = [lats]
         if isinstance(lons, Number):
             lons = [lons]
-        return scipy.interpolate.interpn(
-            (self.ys, self.xs), self.data, (lats, lons))
 
+        # Bilinear interpolation on the regular grid, equivalent to
+        # scipy.interpolate.interpn() with method="linear"
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        lats, lons = np.broadcast_arrays(lats, lons)
+        if np.any(~((lats >= self.ys[0]) & (lats <= self.ys[-1]))):
+            raise ValueError(
+                "One of the requested xi is out of bounds in dimension 0")
+        if np.any(~((lons >= self.xs[0]) & (lons <= self.xs[-1]))):
+            raise ValueError(
+                "One of the requested xi is out of bounds in dimension 1")
+        nrows, ncols = self.data.shape
+        fy = (lats - self.ys[0]) / self.meta["cellsize"]
+        fx = (lons - self.xs[0]) / self.meta["cellsize"]
+        iy = np.clip(np.floor(fy).astype(np.intp), 0, max(0, nrows - 2))
+        ix = np.clip(np.floor(fx).astype(np.intp), 0, max(0, ncols - 2))
+        wy = (fy - iy).astype(self.dtype)
+        wx = (fx - ix).astype(self.dtype)
+        iy1 = np.minimum(iy + 1, nrows - 1)
+        ix1 = np.minimum(ix + 1, ncols - 1)
+        d = self.data
+        return ((d[iy, ix] * (1.0 - wx) + d[iy, ix1] * wx) * (1.0 - wy) +
+                (d[iy1, ix] * (1.0 - wx) + d[iy1, ix1] * wx) * wy)
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#   Simple REST HTTP Weather Server using DWD weather data for Germany
+#   Copyright (C) 2016 Andreas Stöckel
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import concurrent.futures
+import lzma
+import os
+import sqlite3
+
+# Fetch the logger
+import logging
+logger = logging.getLogger("pydwdapi")
+
+# Maximum size of a segment file in bytes before a new segment is started
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+# Name of the index database within the archive directory
+INDEX_FILE = "index.db"
+
+# Index of all archived files. Each file is stored as an individual xz stream
+# at the given offset within the given segment file, such that it can be read
+# without decompressing the rest of the segment.
+TABLE_SCHEMA_ARCHIVE = """CREATE TABLE IF NOT EXISTS archive (
+    source int,
+    modified real,
+    filename text,
+    segment int,
+    offset int,
+    length int,
+    size int,
+    PRIMARY KEY(source, modified, filename)
+);"""
+
+INDEX_ARCHIVE_MODIFIED = "CREATE INDEX IF NOT EXISTS archive_modified ON archive (modified)"
+
+# Number of raw files parsed by a worker process at once during replay
+REPLAY_CHUNK = 16
+
+# Number of chunks per worker process being parsed or waiting to be written at
+# the same time during a replay, bounds the memory used for parsed observations
+REPLAY_QUEUE = 4
+
+
+class Archive:
+    """
+    Append-only archive of the raw files downloaded by the sources. Files are
+    compressed individually and appended to segment files in the archive
+    directory; an SQLite index maps (source_id, modified, filename) to the
+    location of the compressed data.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.conn = None
+
+    def _connect(self):
+        if self.conn is None:
+            os.makedirs(self.directory, exist_ok=True)
+            # Appends are serialized by the caller, but may happen from
+            # different threads, see PyDWDApi.update()
+            self.conn = sqlite3.connect(
+                os.path.join(self.directory, INDEX_FILE),
+                check_same_thread=False)
+            self.conn.execute(TABLE_SCHEMA_ARCHIVE)
+            self.conn.execute(INDEX_ARCHIVE_MODIFIED)
+        return self.conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if not self.conn is None:
+            self.conn.close()
+            self.conn = None
+
+    def _segment_file(self, segment):
+        return os.path.join(self.directory,
+                            "segment-{:06d}.xz".format(segment))
+
+    def append(self, source_id, modified, filename, data):
+        """
+        Appends a raw file to the archive. Returns False if the file was
+        already archived.
+        """
+        conn = self._connect()
+        if not conn.execute(
+                "SELECT 1 FROM archive WHERE source = ? AND modified = ? AND "
+                "filename = ?", (int(source_id), float(modified),
+                                 filename)).fetchone() is None:
+            return False
+
+        # Select the segment, start a new one once the current one is full
+        segment = conn.execute("SELECT MAX(segment) FROM archive").fetchone()[0]
+        segment = 0 if segment is None else segment
+        path = self._segment_file(segment)
+        if os.path.exists(path) and os.path.getsize(path) >= SEGMENT_SIZE:
+            segment += 1
+            path = self._segment_file(segment)
+
+        # Append the compressed data to the segment before updating the index,
+        # an interrupted append thus leaves unreferenced bytes at worst
+        compressed = lzma.compress(bytes(data), preset=6)
+        with open(path, "ab") as f:
+            offset = f.tell()
+            f.write(compressed)
+        conn.execute("INSERT INTO archive VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (int(source_id), float(modified), filename, segment,
+                      offset, len(compressed), len(data)))
+        conn.commit()
+        return True
+
+    def records(self, start=None, end=None, source_ids=None):
+        """
+        Returns the index entries (source_id, modified, filename, segment,
+        offset, length, size) of all archived files with a modification time
+        in [start, end), ordered by modification time.
+        """
+        sql = "SELECT source, modified, filename, segment, offset, length, size FROM archive WHERE modified >= ? AND modified < ?"
+        params = [-1e20 if start is None else start,
+                  1e20 if end is None else end]
+        if not source_ids is None:
+            source_ids = list(map(int, source_ids))
+            sql += " AND source IN (" + ",".join(["?"] * len(source_ids)) + ")"
+            params += source_ids
+        sql += " ORDER BY modified, source, filename"
+        return self._connect().execute(sql, params).fetchall()
+
+    def read(self, record):
+        """
+        Returns the raw content of the file described by the given index
+        entry.
+        """
+        segment, offset, length = record[3], record[4], record[5]
+        with open(self._segment_file(segment), "rb") as f:
+            f.seek(offset)
+            return lzma.decompress(f.read(length))
+
+
+_worker_state = {}
+
+
+def _init_worker(directory, stations_file):
+    from .stations import Stations
+    _worker_state["archive"] = Archive(directory)
+    _worker_state["stations"] = Stations(stations_file)
+
+
+def _parse_records(records):
+    """
+    Reads and parses the given archive records in a worker process. Returns
+    the observations of each record.
+    """
+    from .sources import Sources
+    archive, stations = _worker_state["archive"], _worker_state["stations"]
+    res = []
+    for record in records:
+        try:
+            res.append(Sources.parse(record[0], record[1],
+                                     archive.read(record), stations))
+        except Exception:
+            logger.exception("Exception while parsing " + record[2])
+            res.append([])
+    return res
+
+
+def replay(directory,
+           database_file,
+           stations_file,
+           start=None,
+           end=None,
+           source_ids=None,
+           workers=None):
+    """
+    Re-ingests all archived files with a modification time in [start, end) into
+    the given database. The files are decompressed and parsed by a pool of
+    worker processes, the observations are written by the calling process in
+    the original order. The source update times are advanced to the latest
+    replayed file. Returns the number of replayed files and inserted
+    observations.
+    """
+    from .database import Database
+
+    with Archive(directory) as archive:
+        records = archive.records(start, end, source_ids)
+    chunks = [
+        records[i:(i + REPLAY_CHUNK)]
+        for i in range(0, len(records), REPLAY_CHUNK)
+    ]
+    logger.info("Replaying " + str(len(records)) + " file(s)")
+
+    inserted = 0
+    latest = {}
+    workers = os.cpu_count() if workers is None else workers
+    with Database(database_file) as database, \
+            concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=_init_worker,
+                initargs=(directory, stations_file)) as executor:
+        # Only keep a bounded number of chunks in flight, such that the
+        # parsed observations do not pile up if writing is slower than
+        # parsing. Chunks are written in their original order.
+        pending = collections.deque()
+        chunks = iter(chunks)
+        while True:
+            while len(pending) < REPLAY_QUEUE * workers:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                pending.append((chunk, executor.submit(_parse_records, chunk)))
+            if len(pending) == 0:
+                break
+            chunk, future = pending.popleft()
+            for record, rows in zip(chunk, future.result()):
+                inserted += database.store_observations(rows)
+                latest[record[0]] = max(latest.get(record[0], 0.0), record[1])
+            database.conn.commit()
+        for source_id, modified in latest.items():
+            if modified > database.get_source_time(source_id):
+                database.set_source_time(source_id, modified)
+    logger.info("Inserted " + str(inserted) + " observation(s)")
+    return len(records), inserted
+
+################################################################################
+# MAIN PROGRAM
+################################################################################
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Raw file archive')
+    subparsers = parser.add_subparsers(dest='command')
+    parser_list = subparsers.add_parser('list', help='List archived files')
+    parser_list.add_argument('archive', type=str, help='Archive directory')
+    parser_replay = subparsers.add_parser(
+        'replay', help='Re-ingest archived files into a database')
+    parser_replay.add_argument('archive', type=str, help='Archive directory')
+    parser_replay.add_argument('database', type=str, help='Target database')
+    parser_replay.add_argument('--stations',
+                               type=str,
+                               default='./data/stations.xml',
+                               help='Stations file')
+    parser_replay.add_argument('--start',
+                               type=float,
+                               default=None,
+                               help='Start of the time range (Unix time)')
+    parser_replay.add_argument('--end',
+                               type=float,
+                               default=None,
+                               help='End of the time range (Unix time)')
+    parser_replay.add_argument('--source',
+                               type=int,
+                               nargs='+',
+                               default=None,
+                               help='Only replay the given source ids')
+    parser_replay.add_argument('--workers',
+                               type=int,
+                               default=None,
+                               help='Number of parser processes')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format='%(filename)s:%(lineno)s %(levelname)s:%(message)s')
+
+    if args.command == "list":
+        with Archive(args.archive) as archive:
+            for record in archive.records():
+                print(record[0], record[1], record[2], record[6])
+    elif args.command == "replay":
+        replay(args.archive, args.database, args.stations, args.start,
+               args.end, args.source, args.workers)
+    else:
+        parser.print_help()
+        sys.exit(1)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#   Simple REST HTTP Weather Server using DWD weather data for Germany
+#   Copyright (C) 2016 Andreas Stöckel
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import concurrent.futures
+import multiprocessing
+import os
+
+# Fetch the logger
+import logging
+logger = logging.getLogger("pydwdapi")
+
+# PyDWDApi instance of the current worker process, created once by
+# _init_worker or inherited from the parent process, and shared by all render
+# jobs executed in this process
+_worker_api = None
+
+
+def _init_worker(api_kwargs):
+    """
+    Initializes a worker process -- loads the altitude data, stations and
+    sources once. Workers never download new data from the DWD server.
+    """
+    global _worker_api
+    import pydwdapi
+    kwargs = dict(api_kwargs)
+    kwargs["ftp_user"] = ""
+    kwargs["ftp_password"] = ""
+    _worker_api = pydwdapi.PyDWDApi(**kwargs)
+
+
+def _render_job(job):
+    """
+    Renders a single map and writes it to the file specified in the job.
+    Returns the filename or None if no data was available.
+    """
+    return render_job(_worker_api, job)
+
+
+def render_job(api, job):
+    """
+    Renders a single map described by the given job dictionary using the given
+    PyDWDApi instance. Returns the filename or None if no data was available.
+    """
+    from . import PyDWDApiException
+
+    filename = job["filename"]
+    if job["backend"] == "raster":
+        try:
+            data = api.render_png(job["modality"],
+                                  job["extents"],
+                                  job["ts"],
+                                  resolution=job["resolution"],
+                                  bare=job["bare"])
+        except PyDWDApiException:
+            logger.warning("No data available for " + filename)
+            return None
+        with open(filename, "wb") as f:
+            f.write(data)
+    else:
+        import matplotlib.pyplot as plt
+        fig = api.render_map(job["modality"],
+                             job["extents"],
+                             job["ts"],
+                             resolution=job["resolution"],
+                             bare=job["bare"])
+        fig.savefig(filename,
+                    format=job["format"],
+                    bbox_inches='tight',
+                    pad_inches=(0.0 if job["bare"] else 0.1))
+        plt.close(fig)
+    return filename
+
+
+def create_jobs(modalities,
+                timestamps,
+                extents,
+                resolution=256,
+                bare=False,
+                backend="matplotlib",
+                fmt="pdf",
+                target_dir="."):
+    """
+    Creates the list of render jobs for all combinations of the given
+    modalities and timestamps. If more than one timestamp is given, the output
+    files are numbered consecutively per modality, such that they can be used
+    as animation frames.
+
+    timestamps : list
+        List of timestamps that should be rendered. May be [None] to render the
+        current data.
+    """
+    fmt = "png" if backend == "raster" else fmt
+    jobs = []
+    for modality in modalities:
+        for i, ts in enumerate(timestamps):
+            if len(timestamps) > 1:
+                name = "{}_{:05d}.{}".format(modality, i, fmt)
+            else:
+                name = "{}.{}".format(modality, fmt)
+            jobs.append({
+                "modality": modality,
+                "ts": ts,
+                "extents": extents,
+                "resolution": resolution,
+                "bare": bare,
+                "backend": backend,
+                "format": fmt,
+                "filename": os.path.join(target_dir, name)
+            })
+    return jobs
+
+
+def render_batch(jobs, api_kwargs, workers=None, api=None):
+    """
+    Renders all given jobs in parallel using a process pool. If an api
+    instance is given and the platform supports fork(), the workers inherit
+    its state (altitude data, stations, cached interpolators) copy-on-write.
+    Otherwise each worker constructs its own PyDWDApi instance from
+    api_kwargs, which loads the altitude data and stations once per worker.
+    Jobs are distributed in contiguous chunks, such that workers can reuse
+    their cached interpolators and grid kernels for consecutive frames.
+    Returns the list of written files.
+
+    api_kwargs : dict
+        Keyword arguments passed to the PyDWDApi constructor in each worker.
+    workers : int or None
+        Number of worker processes, defaults to the number of CPUs.
+    api : PyDWDApi
+        Instance shared with the workers, and used to render the jobs in this
+        process if only one worker is requested or there is at most one job.
+        If None, an instance is created from api_kwargs.
+    """
+    global _worker_api
+
+    workers = os.cpu_count() if workers is None else workers
+    if workers <= 1 or len(jobs) <= 1:
+        if api is None:
+            _init_worker(api_kwargs)
+            api = _worker_api
+        res = [render_job(api, job) for job in jobs]
+    elif not api is None and "fork" in multiprocessing.get_all_start_methods():
+        # Load the altitude data before forking, such that it is shared
+        api.preload()
+        chunksize = max(1, len(jobs) // (4 * workers))
+        _worker_api = api
+        try:
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context("fork")) as executor:
+                res = list(
+                    executor.map(_render_job, jobs, chunksize=chunksize))
+        finally:
+            _worker_api = None
+    else:
+        chunksize = max(1, len(jobs) // (4 * workers))
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_worker,
+                initargs=(api_kwargs, )) as executor:
+            res = list(executor.map(_render_job, jobs, chunksize=chunksize))
+    return list(filter(None, res))
@@ -0,0 +1,658 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#   Simple REST HTTP Weather Server using DWD weather data for Germany
+#   Copyright (C) 2016 Andreas Stöckel
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Offline benchmark suite. All inputs -- station networks, DWD HTML tables,
+altitude data and observation databases -- are generated synthetically from a
+fixed random seed, such that results are comparable between releases. The
+results are written as JSON.
+"""
+
+import bz2
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+import numpy as np
+import scipy
+
+from .altitude_data import AltitudeData
+from .database import Database, MODALITY_MAP
+from .html_dwd_observation_parser import parse
+from .interpolator import (Interpolator, FactorizationCache,
+                           UpdatedFactorization, create_interpolator,
+                           KERNEL_BLOCK_SIZE)
+from .stations import Stations
+
+# Fetch the logger
+import logging
+logger = logging.getLogger("pydwdapi")
+
+# Version of the JSON result format
+RESULT_VERSION = 1
+
+# Random seed used for all synthetic data
+SEED = 4718
+
+# Bounding box of the synthetic station networks (min_lat, max_lat, min_lon,
+# max_lon)
+EXTENTS = (47.3, 55.0, 5.9, 15.0)
+
+# Default sizes of the synthetic station networks
+DEFAULT_NETWORKS = [180, 1000, 3000]
+
+# Default grid resolutions used to benchmark the interpolator evaluation
+DEFAULT_GRID_SIZES = [64, 256]
+
+# Largest kernel matrix in bytes for which the single and double precision
+# grid evaluation is timed
+MAX_PRECISION_KERNEL_BYTES = 512 * 1024 * 1024
+
+# Modalities for which the single precision grid evaluation is compared to
+# the double precision result
+PRECISION_MODALITIES = ["temperature", "pressure", "wind_direction"]
+
+# Default number of repetitions of each measurement
+DEFAULT_REPEAT = 5
+
+# Column names and value ranges of the synthetic DWD HTML tables
+HTML_COLUMNS = [("Luftd.", 990.0, 1030.0), ("Temp.", -10.0, 30.0),
+                ("U%", 20.0, 100.0), ("RR1", 0.0, 5.0), ("FF", 0.0, 60.0),
+                ("FX", 0.0, 100.0)]
+HTML_DIRECTIONS = ["N", "NO", "O", "SO", "S", "SW", "W", "NW"]
+
+# Script executed in a fresh interpreter to measure the server start-up time.
+# Arguments are the database, sources, stations and altitude data file names.
+STARTUP_SCRIPT = """
+import json, sys, time
+t0 = time.perf_counter()
+import pydwdapi
+t1 = time.perf_counter()
+api = pydwdapi.PyDWDApi(database=sys.argv[1], sources=sys.argv[2],
+                        stations=sys.argv[3], altitude_data=sys.argv[4],
+                        snapshot_file="", archive_dir="")
+t2 = time.perf_counter()
+api.altitude_data.query(50.0, 10.0)
+t3 = time.perf_counter()
+json.dump({"import": t1 - t0, "init": t2 - t1,
+           "first_altitude_query": t3 - t2,
+           "scipy_imported": "scipy" in sys.modules}, sys.stdout)
+"""
+
+# Minimal sources.xml used by the start-up benchmark
+STARTUP_SOURCES = """<?xml version="1.0" encoding="UTF-8"?>
+<sources>
+	<source id="300">
+		<type>local_dir</type>
+		<path>{}</path>
+		<matcher>.*_HTML</matcher>
+		<timeout>10</timeout>
+	</source>
+</sources>
+"""
+
+
+def measure(f, repeat=DEFAULT_REPEAT, warmup=1):
+    """
+    Calls f() warmup + repeat times and returns statistics of the wall-clock
+    time of the last repeat calls in seconds.
+    """
+    for _ in range(warmup):
+        f()
+    ts = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        f()
+        ts.append(time.perf_counter() - t)
+    return {
+        "min": min(ts),
+        "median": float(np.median(ts)),
+        "mean": float(np.mean(ts)),
+        "repeat": repeat
+    }
+
+
+def synthetic_stations(filename, n, seed=SEED):
+    """
+    Writes a stations.xml file containing n stations with random locations
+    within EXTENTS and random altitudes and returns the Stations instance.
+    """
+    rng = np.random.RandomState(seed)
+    lats = rng.uniform(EXTENTS[0], EXTENTS[1], n)
+    lons = rng.uniform(EXTENTS[2], EXTENTS[3], n)
+    alts = np.round(rng.gamma(1.5, 200.0, n))
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n<stations>\n")
+        for i in range(n):
+            f.write("\t<station alt=\"{:.0f}\" id=\"{}\" lat=\"{:.4f}\" "
+                    "lon=\"{:.4f}\" name=\"Station {:05d}\"/>\n".format(
+                        alts[i], i, lats[i], lons[i], i))
+        f.write("</stations>\n")
+    return Stations(filename)
+
+
+def synthetic_observations(stations, modality="temperature", seed=SEED):
+    """
+    Returns a map from station id to (value, timestamp, source_id) tuples
+    containing a smooth, altitude dependent field with some noise.
+    """
+    rng = np.random.RandomState(seed)
+    res = {}
+    for sid, (lat, lon, alt) in sorted(stations.coords.items()):
+        value = (15.0 - 6.5 * alt / 1000.0 + 3.0 * np.sin(lat) +
+                 2.0 * np.cos(lon) + rng.normal(0.0, 0.5))
+        if modality == "wind_direction":
+            value = value * 10.0 % 360.0
+        res[sid] = (float(value), 0.0, 100)
+    return res
+
+
+def synthetic_html(stations, seed=SEED):
+    """
+    Returns an HTML document resembling the DWD observation tables with one
+    row per station.
+    """
+    rng = np.random.RandomState(seed)
+    f = io.StringIO()
+    f.write("<html><head><title>Aktuelle Wettermeldungen</title></head>"
+            "<body><table border=\"1\">\n<tr><th>Station</th>")
+    for name, _, _ in HTML_COLUMNS:
+        f.write("<th>" + name + "</th>")
+    f.write("<th>DD</th></tr>\n")
+    for name in sorted(stations.names.keys()):
+        f.write("<tr><td>" + name + "</td>")
+        for _, vmin, vmax in HTML_COLUMNS:
+            f.write("<td>{:.1f}</td>".format(rng.uniform(vmin, vmax)))
+        f.write("<td>" + HTML_DIRECTIONS[rng.randint(len(
+            HTML_DIRECTIONS))] + "</td></tr>\n")
+    f.write("</table></body></html>\n")
+    return f.getvalue()
+
+
+def synthetic_altitude_data(nrows=663, ncols=892, seed=SEED):
+    """
+    Returns an ArcGIS ASCII grid file with smooth random terrain as bytes. The
+    default size matches the altitude data shipped with pydwdapi.
+    """
+    rng = np.random.RandomState(seed)
+    ys, xs = np.mgrid[0:nrows, 0:ncols]
+    data = np.zeros((nrows, ncols))
+    for _ in range(16):
+        fx, fy, phase = rng.uniform(0.002, 0.05), rng.uniform(0.002, 0.05), \
+            rng.uniform(0, 2 * np.pi)
+        data += rng.uniform(50, 200) * np.sin(fx * xs + fy * ys + phase)
+    data = np.round(np.maximum(data, -50.0))
+    f = io.StringIO()
+    f.write("ncols        {}\nnrows        {}\nxllcorner    4.0\n"
+            "yllcorner    44.5\ncellsize     0.016666666667\n".format(
+                ncols, nrows))
+    for row in data:
+        f.write(" " + " ".join(map(str, row.astype(int))) + "\n")
+    return f.getvalue().encode("ascii")
+
+
+def synthetic_database(filename, stations, end, years, step, seed=SEED):
+    """
+    Writes observations of all modalities for all stations every "step"
+    seconds for the given number of years ending at "end" into the database.
+    Returns the number of rows.
+    """
+    rng = np.random.RandomState(seed)
+    station_ids = sorted(stations.coords.keys())
+    n = len(station_ids)
+    ts = np.arange(end - years * 365 * 24 * 60 * 60, end, step) + step
+    rows = 0
+    with Database(filename) as database:
+        for t in ts:
+            observations = []
+            for modality in MODALITY_MAP:
+                values = np.round(rng.uniform(0.0, 30.0, n), 1)
+                observations.extend(zip([float(t)] * n, values.tolist(),
+                                        [modality] * n, station_ids,
+                                        [100] * n))
+            rows += database.store_observations(observations)
+        database.conn.commit()
+    return rows
+
+
+def bench_interpolator(target_dir, networks, grid_sizes, repeat):
+    res = {}
+    for n in networks:
+        stations = synthetic_stations(
+            os.path.join(target_dir, "stations_" + str(n) + ".xml"), n)
+        observations = synthetic_observations(stations)
+        interpolator = Interpolator(observations, stations, "temperature")
+        entry = {
+            "build": measure(
+                lambda: Interpolator(observations, stations, "temperature"),
+                max(1, repeat // 2 if n > 1000 else repeat))
+        }
+
+        # Rebuild for new values at the same stations, and for a station set
+        # in which a few stations have been removed and added
+        factorizations = FactorizationCache()
+        Interpolator(observations, stations, "temperature", factorizations)
+        changed = {k: (v[0] + 1.0, v[1], v[2])
+                   for k, v in observations.items()}
+        entry["rebuild_same_stations"] = measure(
+            lambda: Interpolator(changed, stations, "temperature",
+                                 factorizations), repeat)
+        base = factorizations.get(interpolator.station_ids,
+                                  interpolator.tbl[:, 0:3],
+                                  interpolator.altitude_weight)
+        subset = Interpolator(
+            {k: v for k, v in observations.items() if k % 50 != 0},
+            stations, "temperature")
+        entry["rebuild_updated_stations"] = measure(
+            lambda: UpdatedFactorization(base, subset.station_ids, subset.tbl[
+                :, 0:3]).solve(subset.tbl[:, 3:]), repeat)
+        for size in grid_sizes:
+            lats, lons = np.meshgrid(
+                np.linspace(EXTENTS[0], EXTENTS[1], size),
+                np.linspace(EXTENTS[2], EXTENTS[3], size),
+                indexing="ij")
+            entry["evaluate_" + str(size)] = measure(
+                lambda: interpolator.interpolate(lats, lons, 0.0), repeat)
+
+        # Local neighbourhood engines, including the mean absolute deviation
+        # from the global interpolator on the largest grid
+        for engine in ["local_rbf", "local_idw"]:
+            local = create_interpolator(observations, stations, "temperature",
+                                        engine)
+            entry[engine] = {
+                "build": measure(
+                    lambda: create_interpolator(observations, stations,
+                                                "temperature", engine),
+                    repeat),
+                "query_1": measure(
+                    lambda: local.interpolate(50.0, 10.0, 0.0), repeat)
+            }
+            for size in grid_sizes:
+                lats, lons = np.meshgrid(
+                    np.linspace(EXTENTS[0], EXTENTS[1], size),
+                    np.linspace(EXTENTS[2], EXTENTS[3], size),
+                    indexing="ij")
+                entry[engine]["evaluate_" + str(size)] = measure(
+                    lambda: local.interpolate(lats, lons, 0.0),
+                    max(1, repeat // 2))
+            entry[engine]["mean_abs_deviation"] = float(
+                np.mean(np.abs(local.interpolate(lats, lons, 0.0) -
+                               interpolator.interpolate(lats, lons, 0.0))))
+        res[str(n)] = entry
+        logger.info("Benchmarked interpolator for " + str(n) + " stations")
+    return res
+
+
+def bench_altitude_data(repeat):
+    data = synthetic_altitude_data()
+    altitude_data = AltitudeData()
+    altitude_data.read(io.BytesIO(data))
+    rng = np.random.RandomState(SEED)
+    lats = rng.uniform(EXTENTS[0], EXTENTS[1], 100000)
+    lons = rng.uniform(EXTENTS[2], EXTENTS[3], 100000)
+    return {
+        "read": measure(
+            lambda: AltitudeData().read(io.BytesIO(data)),
+            max(1, repeat // 2)),
+        "query_1": measure(lambda: altitude_data.query(50.0, 10.0), repeat),
+        "query_100000": measure(lambda: altitude_data.query(lats, lons),
+                                repeat)
+    }
+
+
+def bench_precision(target_dir, networks, grid_sizes, repeat):
+    """
+    Compares the single precision grid evaluation to the double precision
+    path: checks that the deviation of the interpolated values stays within
+    the documented bound and measures the evaluation time. The split values
+    (e.g. the x- and y-component of the wind direction) are compared, for the
+    wind direction the angular deviation in degrees is reported as well.
+    """
+    # Altitude data stored in single precision
+    data = synthetic_altitude_data()
+    altitude_data = {}
+    for dtype in [np.float64, np.float32]:
+        altitude_data[dtype] = AltitudeData(dtype=dtype)
+        altitude_data[dtype].read(io.BytesIO(data))
+    rng = np.random.RandomState(SEED)
+    lats = rng.uniform(EXTENTS[0], EXTENTS[1], 100000)
+    lons = rng.uniform(EXTENTS[2], EXTENTS[3], 100000)
+    res = {
+        "altitude_data": {
+            "max_abs_error": float(np.max(np.abs(
+                altitude_data[np.float32].query(lats, lons) -
+                altitude_data[np.float64].query(lats, lons)))),
+            "bytes_float64": altitude_data[np.float64].data.nbytes,
+            "bytes_float32": altitude_data[np.float32].data.nbytes
+        }
+    }
+
+    size = max(grid_sizes)
+    lats, lons = np.meshgrid(
+        np.linspace(EXTENTS[0], EXTENTS[1], size),
+        np.linspace(EXTENTS[2], EXTENTS[3], size),
+        indexing="ij")
+    alts = np.maximum(altitude_data[np.float64].query(lats, lons), 0)
+    pts = np.stack((lats.ravel(), lons.ravel(), alts.ravel()), 1)
+    for n in networks:
+        stations = Stations(
+            os.path.join(target_dir, "stations_" + str(n) + ".xml"))
+        entry = {}
+        for modality in PRECISION_MODALITIES:
+            interpolator = Interpolator(synthetic_observations(
+                stations, modality), stations, modality)
+
+            # Compare block-wise, the kernel matrix of the entire grid may be
+            # too large to be held in memory twice
+            err, ratio, angle = 0.0, 0.0, 0.0
+            for i in range(0, pts.shape[0], KERNEL_BLOCK_SIZE):
+                block = pts[i:(i + KERNEL_BLOCK_SIZE)]
+                k64 = interpolator.kernel(block[:, 0], block[:, 1],
+                                          block[:, 2])
+                k32 = interpolator.kernel(block[:, 0], block[:, 1],
+                                          block[:, 2], np.float32)
+                v64 = k64 @ interpolator.nodes
+                v32 = k32 @ interpolator.nodes.astype(np.float32)
+                d = np.abs(v32 - v64)
+                err = max(err, float(np.max(d)))
+                ratio = max(ratio, float(np.max(
+                    d / interpolator.float32_error_bound(k64))))
+                if modality == "wind_direction":
+                    d = np.abs(interpolator.interpolate_kernel(k32) -
+                               interpolator.interpolate_kernel(k64))
+                    angle = max(angle, float(np.max(np.minimum(d, 360.0 -
+                                                               d))))
+            entry[modality] = {
+                "max_abs_error": err,
+                "max_bound_ratio": ratio,
+                "within_bound": ratio <= 1.0
+            }
+            if modality == "wind_direction":
+                entry[modality]["max_angular_error"] = angle
+            if ratio > 1.0:
+                logger.error("Single precision deviation of " + modality +
+                             " for " + str(n) + " stations exceeds the bound")
+
+        # Evaluation time of the full grid, including the kernel matrix
+        for size in grid_sizes:
+            if n * size * size * 8 > MAX_PRECISION_KERNEL_BYTES:
+                continue
+            glats, glons = np.meshgrid(
+                np.linspace(EXTENTS[0], EXTENTS[1], size),
+                np.linspace(EXTENTS[2], EXTENTS[3], size),
+                indexing="ij")
+            galts = np.zeros_like(glats)
+            entry["evaluate_" + str(size)] = {
+                np.dtype(dtype).name: measure(
+                    lambda: interpolator.interpolate_kernel(
+                        interpolator.kernel(glats, glons, galts, dtype),
+                        glats.shape), max(1, repeat // 2))
+                for dtype in [np.float64, np.float32]
+            }
+        res[str(n)] = entry
+        logger.info("Benchmarked single precision evaluation for " + str(n) +
+                    " stations")
+    return res
+
+
+def bench_parse(target_dir, networks, repeat):
+    res = {}
+    for n in networks:
+        stations = Stations(
+            os.path.join(target_dir, "stations_" + str(n) + ".xml"))
+        html = synthetic_html(stations)
+        res[str(n)] = measure(lambda: parse(html, stations), repeat)
+        res[str(n)]["bytes"] = len(html)
+    return res
+
+
+def bench_database(target_dir, stations, end, years, step, repeat):
+    filename = os.path.join(target_dir, "observations.db")
+    if os.path.exists(filename):
+        os.remove(filename)
+    t = time.perf_counter()
+    rows = synthetic_database(filename, stations, end, years, step)
+    t = time.perf_counter() - t
+    logger.info("Wrote " + str(rows) + " observation(s) to " + filename)
+
+    station_ids = sorted(stations.coords.keys())[::10]
+    with Database(filename) as database:
+        res = {
+            "ingest": {
+                "rows": rows,
+                "seconds": t,
+                "rows_per_second": rows / t
+            },
+            "query_observations": measure(
+                lambda: database.query_observations(
+                    "temperature", end - 4 * 60 * 60, end), repeat),
+            "query_observations_for_stations": measure(
+                lambda: database.query_observations_for_stations(
+                    station_ids, end - 4 * 60 * 60, end), repeat),
+            "query_history_30d": measure(
+                lambda: database.query_history(
+                    station_ids[0], "temperature",
+                    end - 30 * 24 * 60 * 60, end), repeat),
+            "size": os.path.getsize(filename)
+        }
+    return filename, res
+
+
+def bench_server(target_dir, database_file, stations_file, repeat):
+    from . import PyDWDApi
+    from .server import create_server
+
+    api = PyDWDApi(database=database_file,
+                   stations=stations_file,
+                   altitude_data="",
+                   snapshot_file="")
+    api.altitude_data.read(io.BytesIO(synthetic_altitude_data()))
+
+    # Following an (empty) snapshot makes update() a no-op, no data is
+    # downloaded
+    api.follow_snapshot = True
+
+    httpd = create_server(api, 0)
+    httpd.RequestHandlerClass.log_message = lambda *args: None
+    port = httpd.server_address[1]
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+
+    def get(path):
+        with urllib.request.urlopen("http://127.0.0.1:" + str(port) +
+                                    path) as f:
+            return f.read()
+
+    station_ids = ",".join(map(str, sorted(api.stations.coords.keys())[:20]))
+    requests = {
+        "weather": "/api/1.0/weather?lat=50.1&lon=8.7",
+        "station": "/api/1.0/station?ids=" + station_ids,
+        "stations": "/api/1.0/stations",
+        "nearest": "/api/1.0/nearest?lat=50.1&lon=8.7&k=10",
+        "grid_128": "/api/1.0/grid?bbox=47.3,55.0,5.9,15.0&resolution=128"
+                    "&modalities=temperature,pressure",
+    }
+    try:
+        return {
+            key: measure(lambda: get(path), repeat * 4)
+            for key, path in requests.items()
+        }
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def bench_startup(target_dir, stations_file, repeat):
+    """
+    Measures the time required to import pydwdapi, to construct the PyDWDApi
+    instance and to answer the first altitude query in a fresh interpreter,
+    both without ("cold") and with ("warm") compiled cache files.
+    """
+    sources_file = os.path.join(target_dir, "startup_sources.xml")
+    with open(sources_file, "w", encoding="utf-8") as f:
+        f.write(STARTUP_SOURCES.format(target_dir))
+    altitude_file = os.path.join(target_dir, "startup_altitude.asc.bz2")
+    with open(altitude_file, "wb") as f:
+        f.write(bz2.compress(synthetic_altitude_data()))
+    args = [
+        sys.executable, "-c", STARTUP_SCRIPT,
+        os.path.join(target_dir, "startup.db"), sources_file, stations_file,
+        altitude_file
+    ]
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+        ([env["PYTHONPATH"]] if "PYTHONPATH" in env else []))
+
+    def clear_cache():
+        from .compiled_cache import CACHE_SUFFIX
+        for filename in (sources_file, stations_file, altitude_file):
+            if os.path.exists(filename + CACHE_SUFFIX):
+                os.remove(filename + CACHE_SUFFIX)
+
+    res = {}
+    for mode in ["cold", "warm"]:
+        runs = []
+        for _ in range(repeat):
+            if mode == "cold":
+                clear_cache()
+            runs.append(json.loads(subprocess.check_output(args, env=env)))
+        res[mode] = {
+            key: {
+                "min": min(run[key] for run in runs),
+                "median": float(np.median([run[key] for run in runs]))
+            }
+            for key in ["import", "init", "first_altitude_query"]
+        }
+        res[mode]["scipy_imported"] = runs[0]["scipy_imported"]
+    clear_cache()
+    logger.info("Benchmarked start-up time")
+    return res
+
+
+def run(target_dir,
+        networks=DEFAULT_NETWORKS,
+        grid_sizes=DEFAULT_GRID_SIZES,
+        years=0.25,
+        step=3 * 60 * 60,
+        repeat=DEFAULT_REPEAT):
+    """
+    Runs all benchmarks and returns the results as a dictionary. Temporary
+    files are written to target_dir.
+
+    networks : list
+        Number of stations in the synthetic station networks.
+    grid_sizes : list
+        Grid resolutions at which the interpolators are evaluated.
+    years : float
+        Time span covered by the synthetic observation database.
+    step : float
+        Time between two observations in the synthetic database in seconds.
+    """
+    end = time.time() // step * step
+    res = {
+        "version": RESULT_VERSION,
+        "meta": {
+            "time": time.time(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "scipy": scipy.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "networks": networks,
+            "grid_sizes": grid_sizes,
+            "years": years,
+            "step": step,
+            "repeat": repeat
+        }
+    }
+    res["interpolator"] = bench_interpolator(target_dir, networks,
+                                             grid_sizes, repeat)
+    res["altitude_data"] = bench_altitude_data(repeat)
+    res["precision"] = bench_precision(target_dir, networks, grid_sizes,
+                                       repeat)
+    res["parse"] = bench_parse(target_dir, networks, repeat)
+
+    # The database and server benchmarks use the smallest network
+    stations_file = os.path.join(target_dir,
+                                 "stations_" + str(networks[0]) + ".xml")
+    database_file, res["database"] = bench_database(
+        target_dir, Stations(stations_file), end, years, step, repeat)
+    res["server"] = bench_server(target_dir, database_file, stations_file,
+                                 repeat)
+    res["startup"] = bench_startup(target_dir, stations_file, repeat)
+    return res
+
+################################################################################
+# MAIN PROGRAM
+################################################################################
+
+if __name__ == '__main__':
+    import argparse
+    import tempfile
+
+    parser = argparse.ArgumentParser(description='Offline benchmark suite')
+    parser.add_argument('--networks',
+                        type=str,
+                        default=",".join(map(str, DEFAULT_NETWORKS)),
+                        help='Comma separated station network sizes')
+    parser.add_argument('--grid-sizes',
+                        dest='grid_sizes',
+                        type=str,
+                        default=",".join(map(str, DEFAULT_GRID_SIZES)),
+                        help='Comma separated grid resolutions')
+    parser.add_argument('--years',
+                        type=float,
+                        default=0.25,
+                        help='Time span of the synthetic database')
+    parser.add_argument('--step',
+                        type=float,
+                        default=3 * 60 * 60,
+                        help='Observation interval in seconds')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--dir',
+                        type=str,
+                        default=None,
+                        help='Directory for the temporary files')
+    parser.add_argument('--output',
+                        type=str,
+                        default=None,
+                        help='Output file, defaults to stdout')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format='%(filename)s:%(lineno)s %(levelname)s:%(message)s')
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as target_dir:
+        res = run(target_dir,
+                  list(map(int, args.networks.split(","))),
+                  list(map(int, args.grid_sizes.split(","))), args.years,
+                  args.step, args.repeat)
+    if args.output is None:
+        json.dump(res, sys.stdout, indent=4, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as f:
+            json.dump(res, f, indent=4, sort_keys=True)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#   Simple REST HTTP Weather Server using DWD weather data for Germany
+#   Copyright (C) 2016 Andreas Stöckel
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+
+# Fetch the logger
+import logging
+logger = logging.getLogger("pydwdapi")
+
+# Scale factor used to store values as integers. Values v for which v * VALUE_SCALE
+# is integral are stored as integer, all other values as real, such that the
+# encoding is always lossless.
+VALUE_SCALE = 100
+
+# Compact observations table. The table is clustered by the primary key, which
+# matches the hot queries. Timestamps have integer affinity -- integral epoch
+# seconds are stored as (variable-length) integers. The value column has no
+# type affinity, see VALUE_SCALE.
+TABLE_SCHEMA_OBSERVATIONS_COMPACT = """CREATE TABLE observations_compact (
+    modality int,
+    station int,
+    timestamp integer,
+    source int,
+    value,
+    PRIMARY KEY(modality, station, timestamp, source)
+) WITHOUT ROWID;"""
+
+# Secondary index used for range scans over all stations of a modality
+INDEX_OBSERVATIONS_COMPACT = "CREATE INDEX observations_compact_modality_timestamp ON observations_compact (modality, timestamp)"
+
+# View exposing the compact table with the columns of the original
+# observations table, along with triggers translating writes to the view
+VIEW_OBSERVATIONS = """CREATE VIEW observations AS SELECT timestamp,
+    CASE typeof(value) WHEN 'integer' THEN value / {scale}.0 ELSE value END
+        AS value,
+    modality, station, source FROM observations_compact""".format(
+    scale=VALUE_SCALE)
+
+# Expression encoding the given value, see VALUE_SCALE
+SQL_ENCODE_VALUE = """CASE WHEN abs({value}) < 1e12 AND
+            round({value} * {scale}) / {scale}.0 = {value}
+        THEN CAST(round({value} * {scale}) AS INTEGER) ELSE {value} END"""
+
+TRIGGER_OBSERVATIONS_INSERT = """CREATE TRIGGER observations_insert
+INSTEAD OF INSERT ON observations BEGIN
+    INSERT OR IGNORE INTO observations_compact VALUES (
+        NEW.modality, NEW.station, NEW.timestamp, NEW.source,
+        {value});
+END;""".format(value=SQL_ENCODE_VALUE.format(value="NEW.value",
+                                             scale=VALUE_SCALE))
+
+# Inserts all rows of a table with the columns of the original observations
+# table at once. Equivalent to inserting them into the view, but avoids
+# running the trigger for each row.
+SQL_INSERT_FROM = """INSERT OR IGNORE INTO observations_compact
+    SELECT modality, station, timestamp, source, {value} FROM {{table}}""".format(
+    value=SQL_ENCODE_VALUE.format(value="value", scale=VALUE_SCALE))
+
+TRIGGER_OBSERVATIONS_DELETE = """CREATE TRIGGER observations_delete
+INSTEAD OF DELETE ON observations BEGIN
+    DELETE FROM observations_compact WHERE modality = OLD.modality AND
+        station = OLD.station AND timestamp = OLD.timestamp AND
+        source = OLD.source;
+END;"""
+
+COMPACT_SCHEMA = [
+    TABLE_SCHEMA_OBSERVATIONS_COMPACT, INDEX_OBSERVATIONS_COMPACT,
+    VIEW_OBSERVATIONS, TRIGGER_OBSERVATIONS_INSERT, TRIGGER_OBSERVATIONS_DELETE
+]
+
+# Number of rows copied per transaction by migrate()
+MIGRATE_CHUNK = 100000
+
+
+def create(conn):
+    """
+    Creates the compact observations table and the "observations" view on the
+    given SQLite connection.
+    """
+    for sql in COMPACT_SCHEMA:
+        conn.execute(sql)
+
+
+def is_compact(conn):
+    """
+    Returns True if the given connection uses the compact observation schema.
+    """
+    res = conn.execute("SELECT type FROM sqlite_master WHERE name = "
+                       "\"observations\"").fetchone()
+    return (not res is None) and res[0] == "view"
+
+
+def migrate(src_file, dst_file, chunk=MIGRATE_CHUNK):
+    """
+    Copies the database src_file into the new database dst_file using the
+    compact schema. All other tables are copied as they are. Returns the number
+    of copied observations.
+    """
+    from .database import Database
+
+    if os.path.exists(dst_file):
+        raise Exception("Target database " + dst_file + " already exists")
+
+    # Create the target database -- Database() creates all other tables
+    with Database(dst_file, compact=True):
+        pass
+
+    n = 0
+    with Database(src_file) as src, Database(dst_file) as dst:
+        # Copy all auxiliary tables
+        tables = src.conn.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = \"table\" AND "
+            "name != \"observations\" AND name NOT LIKE \"sqlite_%\"").fetchall()
+        for name, sql in tables:
+            if dst.conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?",
+                                (name, )).fetchone() is None:
+                dst.conn.execute(sql)
+            rows = src.conn.execute("SELECT * FROM " + name).fetchall()
+            if len(rows) > 0:
+                dst.conn.executemany(
+                    "INSERT OR REPLACE INTO " + name + " VALUES (" + ",".join(
+                        ["?"] * len(rows[0])) + ")", rows)
+        dst.conn.commit()
+
+        # Copy the observations in chunks
+        cursor = src.conn.execute(
+            "SELECT timestamp, value, modality, station, source FROM "
+            "observations")
+        while True:
+            rows = cursor.fetchmany(chunk)
+            if len(rows) == 0:
+                break
+            dst.conn.executemany(
+                "INSERT OR IGNORE INTO observations VALUES (?, ?, ?, ?, ?)",
+                rows)
+            dst.conn.commit()
+            n += len(rows)
+            logger.info("Copied " + str(n) + " observation(s)")
+    return n
+
+
+def _synthetic(filename, compact, years, stations, step):
+    """
+    Creates a synthetic database with observations of seven modalities for
+    the given number of stations every "step" seconds.
+    """
+    import numpy as np
+    from .database import Database, MODALITY_MAP
+
+    rng = np.random.RandomState(4718)
+    t1 = 1.6e9 - (1.6e9 % step)
+    ts = np.arange(t1 - years * 365 * 24 * 60 * 60, t1, step)
+    with Database(filename, compact=compact) as database:
+        for t in ts:
+            rows = []
+            for modality in MODALITY_MAP:
+                values = np.round(rng.uniform(-10.0, 30.0, stations), 1)
+                if modality == "wind_speed":
+                    values = values / 3.6  # Not representable as integer
+                rows.extend(zip([t] * stations, values, [modality] * stations,
+                                range(stations), [100] * stations))
+            database.store_observations(rows)
+        database.conn.commit()
+    return t1
+
+
+def compare(target_dir, years=2.0, stations=180, step=3 * 60 * 60):
+    """
+    Creates a synthetic multi-year dataset in both the original and the compact
+    schema and compares the file size and the latency of the most important
+    queries. Returns a dictionary containing the results.
+    """
+    from .database import Database
+
+    res = {}
+    for name, compact in [("original", False), ("compact", True)]:
+        filename = os.path.join(target_dir, "synthetic_" + name + ".db")
+        if os.path.exists(filename):
+            os.remove(filename)
+        t = time.perf_counter()
+        t1 = _synthetic(filename, compact, years, stations, step)
+        t_ingest = time.perf_counter() - t
+
+        queries = {
+            "latest_observations": lambda db: db.query_observations(
+                "temperature", t1 - 4 * 60 * 60, t1),
+            "station_observations": lambda db: db.query_observations_for_stations(
+                list(range(0, stations, 10)), t1 - 4 * 60 * 60, t1),
+            "station_history_30d": lambda db: db.query_history(
+                17, "temperature", t1 - 30 * 24 * 60 * 60, t1),
+        }
+        latencies = {}
+        with Database(filename) as database:
+            for query, f in queries.items():
+                f(database)  # Warm-up
+                t = time.perf_counter()
+                for _ in range(10):
+                    f(database)
+                latencies[query] = (time.perf_counter() - t) / 10
+        res[name] = {
+            "size": os.path.getsize(filename),
+            "ingest": t_ingest,
+            "latency": latencies
+        }
+    return res
+
+################################################################################
+# MAIN PROGRAM
+################################################################################
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    import sys
+
+    parser = argparse.ArgumentParser(
+        description='Migration to and evaluation of the compact schema')
+    subparsers = parser.add_subparsers(dest='command')
+    parser_migrate = subparsers.add_parser(
+        'migrate', help='Copy a database into a new compact database')
+    parser_migrate.add_argument('src', type=str, help='Source database')
+    parser_migrate.add_argument('dst', type=str, help='Target database')
+    parser_compare = subparsers.add_parser(
+        'compare', help='Compare size and latency on synthetic data')
+    parser_compare.add_argument('dir', type=str, help='Target directory')
+    parser_compare.add_argument('--years', type=float, default=2.0)
+    parser_compare.add_argument('--stations', type=int, default=180)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format='%(filename)s:%(lineno)s %(levelname)s:%(message)s')
+
+    if args.command == "migrate":
+        migrate(args.src, args.dst)
+    elif args.command == "compare":
+        json.dump(compare(args.dir, args.years, args.stations), sys.stdout,
+                  indent=4, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        parser.print_help()
+        sys.exit(1)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+#   Simple REST HTTP Weather Server using DWD weather data for Germany
+#   Copyright (C) 2016 Andreas Stöckel
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import pickle
+
+# Fetch the logger
+import logging
+logger = logging.getLogger("pydwdapi")
+
+# Version of the cache file format, increment whenever the structure of any of
+# the cached objects changes
+CACHE_VERSION = 1
+
+# Suffix appended to the name of the source file and the identifier of the
+# parsed content to obtain the cache file name
+CACHE_SUFFIX = ".cache"
+
+
+def _key(filename, name):
+    stat = os.stat(filename)
+    return (CACHE_VERSION, name, stat.st_mtime_ns, stat.st_size)
+
+
+def load(filename, parse, name):
+    """
+    Returns the result of parse(filename). The result is stored in a pickled
+    cache file next to the source file and read from there as long as the
+    source file is unchanged, which is considerably faster than parsing the
+    original XML or text files. The cache file is trusted to the same extent
+    as the source file. If the cache cannot be written (e.g. because the
+    directory is read-only), the source file is parsed on every call.
+
+    filename : str
+        Source file which should be parsed.
+    parse : callable
+        Function reading the source file, must return a picklable object.
+    name : str
+        Identifier of the parsed content. Different parsers of the same source
+        file (e.g. altitude data read with different floating point types)
+        must use different identifiers; each has its own cache file.
+    """
+    cache_file = filename + "." + name + CACHE_SUFFIX
+    try:
+        key = _key(filename, name)
+    except OSError:
+        # Let the parser report the missing file
+        return parse(filename)
+
+    try:
+        with open(cache_file, "rb") as f:
+            cached_key, res = pickle.load(f)
+        if cached_key == key:
+            return res
+    except FileNotFoundError:
+        pass
+    except Exception:
+        logger.warning("Ignoring invalid cache file " + cache_file)
+
+    res = parse(filename)
+    tmp_file = cache_file + ".tmp." + str(os.getpid())
+    try:
+        with open(tmp_file, "wb") as f:
+            pickle.dump((key, res), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        logger.debug("Could not write cache file " + cache_file)
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+    return res
@@ -17,6 +17,13 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import sqlite3
+import time
+
+from . import compact_schema
+
+# Fetch the logger
+import logging
+logger = logging.getLogger("pydwdapi")
 
 # Table used to store the individual observations from all stations
 TABLE_SCHEMA_OBSERVATIONS = """CREATE TABLE observations (
@@ -42,6 +49,28 @@ TABLE_SCHEMAS = {
     "source_updates": TABLE_SCHEMA_SOURCE_UPDATES
 }
 
+# Indices created on the tables -- the unique index prevents duplicate
+# observations and serves the per-station queries, the second index serves the
+# per-modality range scans. In databases created by older versions, the unique
+# index is created by Database.deduplicate_observations().
+INDEX_OBSERVATIONS_UNIQUE = "observations_unique"
+TABLE_INDICES = {
+    "observations_modality_timestamp": "CREATE INDEX IF NOT EXISTS observations_modality_timestamp ON observations (modality, timestamp)",
+}
+SQL_CREATE_UNIQUE_INDEX = "CREATE UNIQUE INDEX IF NOT EXISTS observations_unique ON observations (station, modality, timestamp, source)"
+
+# Indices superseded by the unique index
+OBSOLETE_INDICES = ["observations_station_modality_timestamp"]
+
+# Number of rowids processed per transaction when removing duplicates
+DEDUP_CHUNK = 20000
+
+# SQL used to remove duplicate observations in a rowid range, keeping the first
+# inserted row. The rows are selected by their rowid, the earlier duplicates
+# are looked up using the (modality, timestamp) index, such that each chunk
+# only touches its own rows.
+SQL_DELETE_DUPLICATES = "DELETE FROM observations WHERE rowid >= ? AND rowid < ? AND EXISTS (SELECT 1 FROM observations AS o INDEXED BY observations_modality_timestamp WHERE o.modality = observations.modality AND o.timestamp = observations.timestamp AND o.station = observations.station AND o.source = observations.source AND o.rowid < observations.rowid)"
+
 # Used to update the source time
 SQL_SET_SOURCE_TIME = "INSERT OR REPLACE INTO source_updates VALUES (?, ?)"
 
@@ -49,7 +78,27 @@ SQL_SET_SOURCE_TIME = "INSERT OR REPLACE INTO source_updates VALUES (?, ?)"
 SQL_GET_SOURCE_TIME = "SELECT timestamp FROM source_updates WHERE source=?"
 
 # SQL used to store observations in the database
-SQL_STORE_OBSERVATION = "INSERT INTO observations VALUES (?, ?, ?, ?, ?)"
+SQL_STORE_OBSERVATION = "INSERT OR IGNORE INTO observations VALUES (?, ?, ?, ?, ?)"
+
+# SQL used to determine the rowids of the observations inserted by a batch
+SQL_QUERY_LAST_ROWID = "SELECT MAX(rowid) FROM observations"
+SQL_QUERY_INSERTED_OBSERVATIONS = "SELECT timestamp, value, modality, station, source FROM observations WHERE rowid > ? ORDER BY rowid"
+
+# SQL used to create the temporary table holding a batch of observations which
+# is mirrored to the observation store. Observations staged more than once are
+# only kept once, like in the observations table.
+SQL_CREATE_STAGED_OBSERVATIONS = "CREATE TEMP TABLE IF NOT EXISTS staged_observations (timestamp real, value real, modality int, station int, source int, PRIMARY KEY(station, modality, timestamp, source))"
+
+# SQL used to fill the temporary table holding a batch of observations
+SQL_STAGE_OBSERVATION = "INSERT OR IGNORE INTO staged_observations VALUES (?, ?, ?, ?, ?)"
+
+# SQL used to select the staged observations which are not yet stored in the
+# database
+SQL_QUERY_STAGED_OBSERVATIONS = "SELECT * FROM staged_observations s WHERE NOT EXISTS (SELECT 1 FROM observations o WHERE o.station = s.station AND o.modality = s.modality AND o.timestamp = s.timestamp AND o.source = s.source)"
+
+# SQL used to store the staged observations in a compact database
+SQL_STORE_STAGED_OBSERVATIONS = compact_schema.SQL_INSERT_FROM.format(
+    table="staged_observations")
 
 # SQL used to retrieve the latest observations
 SQL_QUERY_OBSERVATIONS = "SELECT value, timestamp, station, source FROM observations WHERE modality = ? AND timestamp > ? AND timestamp <= ? ORDER BY timestamp DESC"
@@ -57,6 +106,45 @@ SQL_QUERY_OBSERVATIONS = "SELECT value, timestamp, station, source FROM observat
 # SQL used to retrieve the latest observations
 SQL_QUERY_STATION_OBSERVATIONS = "SELECT value, timestamp, modality, source FROM observations WHERE station = ? AND timestamp > ? AND timestamp <= ? ORDER BY timestamp DESC"
 
+# SQL used to create the temporary table holding the station ids of a bulk query
+SQL_CREATE_QUERY_STATIONS = "CREATE TEMP TABLE IF NOT EXISTS query_stations (station int PRIMARY KEY)"
+
+# SQL used to fill the temporary table holding the station ids of a bulk query
+SQL_INSERT_QUERY_STATION = "INSERT OR IGNORE INTO query_stations VALUES (?)"
+
+# SQL used to retrieve the latest observation per station and modality for all
+# stations in the query_stations table -- SQLite guarantees that the bare
+# columns are taken from the row containing the maximum timestamp. Listing the
+# known modalities allows SQLite to use the (station, modality, timestamp)
+# prefix of the unique index or of the compact primary key.
+SQL_QUERY_STATIONS_OBSERVATIONS = "SELECT value, MAX(timestamp), station, modality, source FROM observations WHERE modality IN ({modalities}) AND station IN (SELECT station FROM query_stations) AND timestamp > ? AND timestamp <= ? GROUP BY station, modality"
+
+# SQL used to retrieve the time series of a single station and modality
+SQL_QUERY_HISTORY = "SELECT timestamp, value FROM observations WHERE station = ? AND modality = ? AND timestamp >= ? AND timestamp < ? ORDER BY timestamp"
+
+# SQL used to retrieve all observations of a modality in a time range
+SQL_QUERY_OBSERVATION_RANGE = "SELECT timestamp, value, station, source FROM observations WHERE modality = ? AND timestamp > ? AND timestamp <= ? ORDER BY timestamp"
+
+# Tables the retention subsystem rolls old observations up into, see
+# retention.py. Each observation is contained in exactly one of the
+# observations, observations_hourly and observations_daily tables.
+AGGREGATE_TABLES = ["observations_hourly", "observations_daily"]
+
+# Bucket size in seconds of the coarsest aggregate table
+MAX_AGGREGATE_BUCKET = 24 * 60 * 60
+
+# SQL used to retrieve the aggregated time series of a single station and
+# modality from an aggregate table, the timestamp is the start of the bucket
+SQL_QUERY_AGGREGATE_HISTORY = "SELECT timestamp, count, mean, min, max, last FROM {table} WHERE station = ? AND modality = ? AND timestamp >= ? AND timestamp < ?"
+
+# SQL used to retrieve the latest observation per bucket of a modality from an
+# aggregate table. The condition on the bucket timestamp allows SQLite to use
+# the (modality, timestamp) index.
+SQL_QUERY_AGGREGATE_RANGE = "SELECT last_ts, last, station, 0 FROM {table} WHERE modality = ? AND timestamp > ? AND timestamp <= ? AND last_ts > ? AND last_ts <= ?"
+
+# SQL used to retrieve the distinct observation timestamps of a modality
+SQL_QUERY_TIMESTAMPS = "SELECT DISTINCT timestamp FROM observations WHERE modality = ? AND timestamp > ? AND timestamp <= ? ORDER BY timestamp"
+
 # Map used by the Database class to map between the individual modality names
 # and the id which is actually stored in the database
 MODALITY_MAP = {
@@ -70,6 +158,9 @@ MODALITY_MAP = {
 }
 MODALITY_ID_MAP = {v: k for k, v in MODALITY_MAP.items()}
 
+SQL_QUERY_STATIONS_OBSERVATIONS = SQL_QUERY_STATIONS_OBSERVATIONS.format(
+    modalities=", ".join(map(str, sorted(MODALITY_ID_MAP.keys()))))
+
 
 class Database:
     """
@@ -78,22 +169,54 @@ class Database:
     providing an abstraction layer over the underlying SQL database.
     """
 
-    def __init__(self, filename):
+    def __init__(self, filename, store=None, compact=False):
         """
         Connects to the databse file specifed by "filename" and creates tables
-        which do not yet exist in the database.
+        which do not yet exist in the database. If an ObservationStore instance
+        is given as "store", all observations written to the database are
+        mirrored to the store. If "compact" is True and the database does not
+        yet contain any observations table, the compact observation schema is
+        used (see compact_schema.py).
         """
 
         # Connect to the database
         self.conn = sqlite3.connect(filename)
+        self.store = store
 
-        # Make sure that all tables exist
-        tables = self.conn.execute(
-            "SELECT name FROM sqlite_master WHERE type=\"table\"").fetchall()
-        tables = set(map(lambda x: x[0], tables))
+        # Make sure that all tables and indices exist
+        names = self.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type IN (\"table\", \"index\", \"view\")").fetchall()
+        names = set(map(lambda x: x[0], names))
+        if compact and not "observations" in names:
+            compact_schema.create(self.conn)
+            names.add("observations")
+        self.compact = compact_schema.is_compact(self.conn)
         for table in TABLE_SCHEMAS:
-            if not table in tables:
+            if not table in names:
                 self.conn.execute(TABLE_SCHEMAS[table])
+        self.aggregate_tables = [t for t in AGGREGATE_TABLES if t in names]
+        self.missing_indices = []
+        self.deduplicated = True
+        if self.compact:
+            return
+
+        # Databases created by older versions may lack indices, contain
+        # duplicate observations and lack the unique index. Since building the
+        # indices and removing the duplicates takes a while on large
+        # databases, this is done by migrate_observations(), which is called
+        # explicitly, e.g. by PyDWDApi.migrate(). Until then, duplicates are
+        # not prevented. The indices are created right away if there are no
+        # observations.
+        self.missing_indices = [i for i in TABLE_INDICES if not i in names]
+        self.deduplicated = INDEX_OBSERVATIONS_UNIQUE in names
+        if (len(self.missing_indices) > 0 or not self.deduplicated) and \
+                self.conn.execute("SELECT rowid FROM observations LIMIT 1"
+                                  ).fetchone() is None:
+            for index in self.missing_indices:
+                self.conn.execute(TABLE_INDICES[index])
+            self.conn.execute(SQL_CREATE_UNIQUE_INDEX)
+            self.missing_indices = []
+            self.deduplicated = True
 
     def __enter__(self):
         return self
@@ -127,6 +250,61 @@ class Database:
             return float(res[0][0])
         return 0.0
 
+    def migrate_observations(self, start=0, chunk=DEDUP_CHUNK, max_time=None):
+        """
+        Creates the missing indices, removes duplicate observations (same
+        station, modality, timestamp and source) and creates the unique index
+        preventing new duplicates. Each index is created in its own
+        transaction. The table is then processed in rowid ranges of the given
+        size, each in its own transaction, such that other connections can
+        access the database in between. The last range and the unique index
+        creation share one transaction, such that no duplicates can be
+        inserted in between.
+
+        Returns None once the unique index exists. If max_time is given, the
+        method returns after about max_time seconds and returns the rowid at
+        which the migration has to be continued by passing it as start.
+        """
+        if self.deduplicated and len(self.missing_indices) == 0:
+            return None
+        t = time.perf_counter()
+        self.conn.commit()
+        while len(self.missing_indices) > 0:
+            index = self.missing_indices.pop(0)
+            logger.info("Creating index " + index)
+            self.conn.execute(TABLE_INDICES[index])
+            self.conn.commit()
+            if not max_time is None and time.perf_counter() - t >= max_time:
+                return start
+        if self.deduplicated:
+            return None
+        while True:
+            end = self.conn.execute(
+                "SELECT MAX(rowid) FROM observations").fetchone()[0]
+            end = start if end is None else end + 1
+            if end - start <= chunk:
+                self.conn.execute("BEGIN IMMEDIATE")
+                end = self.conn.execute(
+                    "SELECT MAX(rowid) FROM observations").fetchone()[0]
+                end = start if end is None else end + 1
+                self.conn.execute(SQL_DELETE_DUPLICATES, (start, end))
+                self.conn.execute(SQL_CREATE_UNIQUE_INDEX)
+                for index in OBSOLETE_INDICES:
+                    self.conn.execute("DROP INDEX IF EXISTS " + index)
+                self.conn.commit()
+                self.deduplicated = True
+                logger.info("Removed duplicate observations")
+                return None
+            removed = self.conn.execute(SQL_DELETE_DUPLICATES,
+                                        (start, start + chunk)).rowcount
+            self.conn.commit()
+            if removed > 0:
+                logger.info("Removed " + str(removed) +
+                            " duplicate observation(s)")
+            start += chunk
+            if not max_time is None and time.perf_counter() - t >= max_time:
+                return start
+
     def store_observation(self, ts, value, modality, station_id, source_id):
         """
         Stores a single observation for a single modality in the database.
@@ -142,9 +320,53 @@ class Database:
         source_id : int
             id of the data source
         """
-        self.conn.execute(SQL_STORE_OBSERVATION,
-                          (float(ts), float(value), MODALITY_MAP[modality],
-                           int(station_id), int(source_id)))
+        return self.store_observations([(ts, value, modality, station_id,
+                                         source_id)])
+
+    def store_observations(self, observations):
+        """
+        Stores multiple observations at once. Observations which are already
+        stored in the database are ignored. Returns the number of observations
+        which have actually been inserted.
+
+        observations : list
+            List of tuples (ts, value, modality, station_id, source_id), see
+            store_observation().
+        """
+        rows = [(float(ts), float(value), MODALITY_MAP[modality],
+                 int(station_id), int(source_id))
+                for ts, value, modality, station_id, source_id in observations]
+        if self.store is None:
+            changes = self.conn.total_changes
+            self.conn.executemany(SQL_STORE_OBSERVATION, rows)
+            return self.conn.total_changes - changes
+
+        # Mirror the new observations to the store -- rows ignored as
+        # duplicates are already contained in the store. New rows are
+        # assigned rowids larger than all existing ones.
+        if not self.compact:
+            last = self.conn.execute(SQL_QUERY_LAST_ROWID).fetchone()[0]
+            changes = self.conn.total_changes
+            self.conn.executemany(SQL_STORE_OBSERVATION, rows)
+            changes = self.conn.total_changes - changes
+            if changes > 0:
+                self.store.append(*zip(*self.conn.execute(
+                    SQL_QUERY_INSERTED_OBSERVATIONS, (last or 0, ))))
+            return changes
+
+        # The compact table has no rowid. Stage the batch in a temporary
+        # table instead, such that the new rows can be determined and
+        # inserted into the compact table using one statement each.
+        self.conn.execute(SQL_CREATE_STAGED_OBSERVATIONS)
+        self.conn.executemany(SQL_STAGE_OBSERVATION, rows)
+        inserted = self.conn.execute(SQL_QUERY_STAGED_OBSERVATIONS).fetchall()
+        changes = self.conn.total_changes
+        self.conn.execute(SQL_STORE_STAGED_OBSERVATIONS)
+        changes = self.conn.total_changes - changes
+        self.conn.execute("DELETE FROM staged_observations")
+        if len(inserted) > 0:
+            self.store.append(*zip(*inserted))
+        return changes
 
     def query_observations(self, modality, since=0.0, max_ts=1e20):
         """
@@ -185,3 +407,95 @@ class Database:
                     res[modality] = (row[0], row[1], row[3])
         return res
 
+    def query_observations_for_stations(self, station_ids, since=0.0,
+                                        max_ts=1e20):
+        """
+        Queries the latest observation of each modality for all of the given
+        station ids using a single SQL query. Returns a map from station id to
+        a map from modality to tuples (value, timestamp, source_id). Stations
+        without observations are not included in the result.
+        """
+        self.conn.execute(SQL_CREATE_QUERY_STATIONS)
+        self.conn.execute("DELETE FROM query_stations")
+        self.conn.executemany(SQL_INSERT_QUERY_STATION,
+                              ((int(x), ) for x in station_ids))
+        response = self.conn.execute(SQL_QUERY_STATIONS_OBSERVATIONS,
+                                     (since, max_ts)).fetchall()
+        res = {}
+        for value, ts, station_id, modality_id, source_id in response:
+            if modality_id in MODALITY_ID_MAP:
+                if not station_id in res:
+                    res[station_id] = {}
+                res[station_id][MODALITY_ID_MAP[modality_id]] = (value, ts,
+                                                                  source_id)
+        return res
+
+    def query_history(self, station_id, modality, since=0.0, max_ts=1e20):
+        """
+        Returns all observations of the given station and modality as a list of
+        (timestamp, value) tuples sorted by timestamp.
+
+        since : float
+            lower bound (inclusive) for the observation timestamp
+        max_ts : float
+            upper bound (exclusive) for the observation timestamp
+        """
+        return self.conn.execute(
+            SQL_QUERY_HISTORY,
+            (int(station_id), MODALITY_MAP[modality], since, max_ts)).fetchall()
+
+    def query_aggregate_history(self, station_id, modality, since=0.0,
+                                max_ts=1e20):
+        """
+        Returns the aggregates of the given station and modality the
+        retention subsystem rolled old observations up into as a list of
+        (timestamp, count, mean, min, max, last) tuples sorted by timestamp.
+        The timestamp is the start of the aggregated bucket.
+
+        since : float
+            lower bound (inclusive) for the bucket timestamp
+        max_ts : float
+            upper bound (exclusive) for the bucket timestamp
+        """
+        res = []
+        for table in self.aggregate_tables:
+            res += self.conn.execute(
+                SQL_QUERY_AGGREGATE_HISTORY.format(table=table),
+                (int(station_id), MODALITY_MAP[modality], since,
+                 max_ts)).fetchall()
+        return sorted(res)
+
+    def query_aggregate_range(self, modality, since=0.0, max_ts=1e20):
+        """
+        Returns the latest observation of each aggregate of the given modality
+        the retention subsystem rolled old observations up into, in the same
+        format as query_observation_range(). The source id is not retained in
+        the aggregates and always zero.
+        """
+        res = []
+        for table in self.aggregate_tables:
+            res += self.conn.execute(
+                SQL_QUERY_AGGREGATE_RANGE.format(table=table),
+                (MODALITY_MAP[modality], since - MAX_AGGREGATE_BUCKET, max_ts,
+                 since, max_ts)).fetchall()
+        return sorted(res)
+
+    def query_timestamps(self, modality, since=0.0, max_ts=1e20):
+        """
+        Returns the sorted list of distinct timestamps at which observations of
+        the given modality are available in the given time range.
+        """
+        return [
+            row[0] for row in self.conn.execute(
+                SQL_QUERY_TIMESTAMPS, (MODALITY_MAP[modality], since, max_ts))
+        ]
+
+    def query_observation_range(self, modality, since=0.0, max_ts=1e20):
+        """
+        Returns all observations of the given modality in the given time range
+        as a list of (timestamp, value, station_id, source_id) tuples sorted by
+        timestamp.
+        """
+        return self.conn.execute(
+            SQL_QUERY_OBSERVATION_RANGE,
+            (MODALITY_MAP[modality], since, max_ts)).fetchall()
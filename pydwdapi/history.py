@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#   Simple REST HTTP Weather Server using DWD weather data for Germany
+#   Copyright (C) 2016 Andreas Stöckel
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+# Aggregation functions supported by downsample()
+AGGREGATIONS = ["mean", "min", "max", "last"]
+
+# Maximum number of steps in a single history query
+MAX_HISTORY_STEPS = 100000
+
+
+def steps(start, end, step):
+    """
+    Returns the array of timestamps start, start + step, ... before end, i.e.
+    the steps in the half-open range [start, end) also used by downsample().
+    """
+    if step <= 0.0:
+        raise Exception("Step must be positive")
+    n = int(np.ceil((end - start) / step - 1e-9))
+    if n > MAX_HISTORY_STEPS:
+        raise Exception("Too many steps in the given time range")
+    return start + step * np.arange(max(0, n))
+
+
+def downsample(ts, values, start, end, step, agg="mean"):
+    """
+    Aggregates the given time series into buckets [start + i * step,
+    start + (i + 1) * step). Returns the bucket start times and the aggregated
+    values for all non-empty buckets.
+
+    ts : array
+        Observation timestamps in ascending order.
+    values : array
+        Observed values.
+    agg : str
+        Aggregation function, one of "mean", "min", "max" or "last".
+    """
+    values = np.asarray(values, dtype=np.float64)
+    return downsample_aggregates(ts, np.ones(len(values)), values, values,
+                                 values, values, start, end, step, agg)
+
+
+def downsample_aggregates(ts, counts, means, mins, maxs, lasts, start, end,
+                          step, agg="mean"):
+    """
+    Like downsample(), but aggregates a series of already aggregated values,
+    such as the hourly and daily aggregates written by the retention
+    subsystem. Each aggregate is assigned to the bucket containing its
+    timestamp; the means are weighted by the number of aggregated
+    observations.
+
+    ts : array
+        Timestamps of the aggregates in ascending order.
+    counts : array
+        Number of observations in each aggregate.
+    means, mins, maxs, lasts : array
+        Mean, minimum, maximum and latest value of each aggregate.
+    """
+    if not agg in AGGREGATIONS:
+        raise Exception("Unknown aggregation \"" + str(agg) + "\"")
+    ts = np.asarray(ts, dtype=np.float64)
+    mask = (ts >= start) & (ts < end)
+    ts = ts[mask]
+    if len(ts) == 0:
+        return np.zeros(0), np.zeros(0)
+
+    # The time series is sorted, so the buckets are contiguous slices
+    buckets = np.floor((ts - start) / step).astype(np.int64)
+    first = np.flatnonzero(np.concatenate(((True, ), buckets[1:] !=
+                                           buckets[:-1])))
+    if agg == "mean":
+        counts = np.asarray(counts, dtype=np.float64)[mask]
+        means = np.asarray(means, dtype=np.float64)[mask]
+        res = (np.add.reduceat(counts * means, first) /
+               np.add.reduceat(counts, first))
+    elif agg == "min":
+        res = np.minimum.reduceat(
+            np.asarray(mins, dtype=np.float64)[mask], first)
+    elif agg == "max":
+        res = np.maximum.reduceat(
+            np.asarray(maxs, dtype=np.float64)[mask], first)
+    else:
+        res = np.asarray(lasts, dtype=np.float64)[mask][np.append(
+            first[1:], len(ts)) - 1]
+    return start + buckets[first] * step, res
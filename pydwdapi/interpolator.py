@@ -15,9 +15,10 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import math
+import threading
 import numpy as np
-import scipy.interpolate
 import time
 
 # Weight of the altitude dimension for the individual modalities
@@ -31,11 +32,40 @@ MODALITY_ALTITUDE_WEIGHT = {
     "wind_direction": 0.0
 }
 
+# Interpolation engine used for the individual modalities, see ENGINES.
+# Modalities not listed here use the global radial basis function interpolator.
+MODALITY_ENGINE = {}
+
 # Number of dimensions used when interpolating a modality
 MODALITY_DIMENSIONS = {"wind_direction": 2}
 
 MODALITY_NO_CLAMP = set(["wind_direction"])
 
+# Maximum number of query points for which the kernel matrix is evaluated at
+# once -- limits the memory consumption when interpolating large grids
+KERNEL_BLOCK_SIZE = 4096
+
+# Maximum number of stations which may be added to or removed from the station
+# set of a cached kernel factorization before the kernel matrix is factorized
+# from scratch
+MAX_UPDATE_RANK = 32
+
+# Maximum number of kernel factorizations kept by a FactorizationCache. Each
+# factorization requires number of stations^2 x 8 bytes.
+MAX_FACTORIZATIONS = 8
+
+# Default number of stations the local interpolation engines take into account
+# for each query point
+DEFAULT_NEIGHBOURS = 16
+
+# Exponent of the inverse distance weighting used by the "local_idw" engine
+IDW_POWER = 2.0
+
+# Factor of the bound on the deviation of values interpolated using a float32
+# kernel from the float64 result, see Interpolator.float32_error_bound().
+# Measured deviations stay below a third of the bound.
+FLOAT32_ERROR_FACTOR = 4.0
+
 
 def haversine(lat1, lon1, lat2, lon2):
     """
@@ -72,6 +102,224 @@ class Norm:
         d_alt = (alts1 - alts2) / 1000.0 * self.altitude_weight
         return np.sqrt(d_ground**2 + d_alt**2)
 
+    def pairwise(self, pts1, pts2, dtype=np.float64):
+        """
+        Returns the matrix of distances between each of the N points in pts1
+        and the M points in pts2. Both arrays are expected to have the shape
+        (N, 3) and (M, 3) respectively, with the columns containing latitude,
+        longitude and altitude. The result has the shape (N, M). The distances
+        are calculated using the given floating point type.
+        """
+        pts1 = np.asarray(pts1, dtype=dtype)
+        pts2 = np.asarray(pts2, dtype=dtype)
+        return self(pts1.T[:, :, None], pts2.T[:, None, :])
+
+
+def kernel_matrix(pts1, pts2, altitude_weight, dtype=np.float64):
+    """
+    Evaluates the (linear) radial basis function kernel between all pairs of
+    points in pts1 and pts2, see Norm.pairwise().
+    """
+    return Norm(altitude_weight).pairwise(pts1, pts2, dtype)
+
+
+class KernelFactorization:
+    """
+    LU factorization of the kernel matrix between a set of stations. Solving
+    the interpolation system for new station values only requires O(N^2)
+    operations instead of the O(N^3) of a full solve.
+    """
+
+    def __init__(self, station_ids, pts, altitude_weight):
+        """
+        station_ids : array
+            Sorted ids of the stations.
+        pts : array
+            Array of shape (N, 3) containing the latitude, longitude and
+            altitude of each station.
+        altitude_weight : float
+            Weight of the altitude dimension, see Norm.
+        """
+        import scipy.linalg
+        self.station_ids = station_ids
+        self.pts = pts
+        self.altitude_weight = altitude_weight
+        self.rank = 0
+        self.lu = scipy.linalg.lu_factor(
+            kernel_matrix(pts, pts, altitude_weight))
+
+    def solve(self, rhs):
+        """
+        Returns the solution x of A * x = rhs, where A is the kernel matrix.
+        """
+        import scipy.linalg
+        return scipy.linalg.lu_solve(self.lu, rhs)
+
+
+class UpdatedFactorization:
+    """
+    Solves the kernel system for a station set which differs from that of a
+    KernelFactorization by a few added or removed stations, without
+    factorizing the new kernel matrix. Removed stations are eliminated using
+    the capacitance matrix of the base factorization, added stations are
+    appended as a block whose Schur complement is factorized. Construction
+    requires O(N^2 * k) operations for k changed stations, solving O(N^2).
+    """
+
+    def __init__(self, base, station_ids, pts):
+        """
+        base : KernelFactorization
+            Factorization of the kernel matrix of the original station set.
+        station_ids : array
+            Sorted ids of the new station set.
+        pts : array
+            Coordinates of the new station set, see KernelFactorization.
+        """
+        import scipy.linalg
+        self.base = base
+        self.station_ids = station_ids
+        self.pts = pts
+        self.altitude_weight = base.altitude_weight
+
+        # Split the new station set into stations present in the base
+        # factorization and added stations
+        keep = np.isin(base.station_ids, station_ids, assume_unique=True)
+        added = ~np.isin(station_ids, base.station_ids, assume_unique=True)
+        self.keep = np.flatnonzero(keep)
+        self.removed = np.flatnonzero(~keep)
+        self.rank = len(self.removed) + int(np.sum(added))
+        if not np.array_equal(base.pts[self.keep], pts[~added]):
+            raise Exception("Station coordinates differ from the base")
+
+        # The system is solved with the kept stations first, followed by the
+        # added stations; order maps back to the sorted station ids
+        internal_ids = np.concatenate(
+            (base.station_ids[self.keep], station_ids[added]))
+        self.order = np.argsort(internal_ids, kind="stable")
+
+        # Capacitance matrix used to solve for the kept stations only: a
+        # solution y of the full system with y[removed] = 0 solves the system
+        # restricted to the kept stations
+        if len(self.removed) > 0:
+            E = np.zeros((len(base.station_ids), len(self.removed)))
+            E[self.removed, np.arange(len(self.removed))] = 1.0
+            self.W = base.solve(E)
+            self.capacitance = scipy.linalg.lu_factor(self.W[self.removed])
+
+        # Schur complement of the kernel block of the added stations
+        self.n_added = int(np.sum(added))
+        if self.n_added > 0:
+            pts_keep, pts_added = pts[~added], pts[added]
+            self.B = kernel_matrix(pts_keep, pts_added, self.altitude_weight)
+            C = kernel_matrix(pts_added, pts_added, self.altitude_weight)
+            self.Z = self._solve_kept(self.B)
+            self.schur = scipy.linalg.lu_factor(C - self.B.T @ self.Z)
+
+    def _solve_kept(self, rhs):
+        """
+        Solves the kernel system restricted to the kept stations.
+        """
+        import scipy.linalg
+        b = np.zeros((len(self.base.station_ids), ) + rhs.shape[1:])
+        b[self.keep] = rhs
+        y = self.base.solve(b)
+        if len(self.removed) > 0:
+            mu = scipy.linalg.lu_solve(self.capacitance, -y[self.removed])
+            y = y + self.W @ mu
+        return y[self.keep]
+
+    def solve(self, rhs):
+        """
+        Returns the solution x of A * x = rhs, where A is the kernel matrix of
+        the new station set.
+        """
+        import scipy.linalg
+        b = np.empty_like(rhs, dtype=np.float64)
+        b[self.order] = rhs
+        n_keep = len(self.keep)
+        x = self._solve_kept(b[:n_keep])
+        if self.n_added > 0:
+            x_added = scipy.linalg.lu_solve(self.schur,
+                                            b[n_keep:] - self.B.T @ x)
+            x = np.concatenate((x - self.Z @ x_added, x_added))
+        return x[self.order]
+
+
+class FactorizationCache:
+    """
+    Keeps the kernel factorizations of the most recently interpolated station
+    sets. If new observations are available for the same set of stations,
+    only the right hand side has to be solved for. If a few stations have been
+    added or removed, the factorization is updated instead of being
+    recomputed, see UpdatedFactorization.
+    """
+
+    def __init__(self,
+                 max_factorizations=MAX_FACTORIZATIONS,
+                 max_update_rank=MAX_UPDATE_RANK):
+        self.max_factorizations = max_factorizations
+        self.max_update_rank = max_update_rank
+        self.factorizations = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.counts = {"hits": 0, "updates": 0, "factorizations": 0}
+
+    def get(self, station_ids, pts, altitude_weight):
+        """
+        Returns a factorization of the kernel matrix for the given stations.
+
+        station_ids : array
+            Sorted ids of the stations.
+        pts : array
+            Array of shape (N, 3) containing the station coordinates.
+        altitude_weight : float
+            Weight of the altitude dimension.
+        """
+        key = (altitude_weight, station_ids.tobytes())
+        with self.lock:
+            if key in self.factorizations:
+                self.factorizations.move_to_end(key)
+                self.counts["hits"] += 1
+                return self.factorizations[key]
+
+            # Select the base factorization with the fewest changed stations
+            base, base_rank = None, min(self.max_update_rank,
+                                        len(station_ids) // 8)
+            for f in self.factorizations.values():
+                if f.rank > 0 or f.altitude_weight != altitude_weight:
+                    continue
+                n_common = len(np.intersect1d(f.station_ids, station_ids,
+                                              assume_unique=True))
+                rank = (len(f.station_ids) - n_common) + (len(station_ids) -
+                                                          n_common)
+                if rank <= base_rank:
+                    base, base_rank = f, rank
+
+        factorization = None
+        if not base is None:
+            try:
+                factorization = UpdatedFactorization(base, station_ids, pts)
+            except Exception:
+                factorization = None
+        if factorization is None:
+            factorization = KernelFactorization(station_ids, pts,
+                                                altitude_weight)
+
+        with self.lock:
+            self.counts["factorizations" if factorization.rank == 0 else
+                        "updates"] += 1
+            self.factorizations[key] = factorization
+            while len(self.factorizations) > self.max_factorizations:
+                self.factorizations.popitem(last=False)
+        return factorization
+
+    def stats(self):
+        """
+        Returns the number of reused, updated and newly computed
+        factorizations.
+        """
+        with self.lock:
+            return dict(self.counts)
+
 
 class Interpolator:
     """
@@ -82,7 +330,11 @@ class Interpolator:
     locations (latitude, longitude, altitude) from the function.
     """
 
-    def __init__(self, observations, stations, modality=""):
+    # Name of the interpolation engine, see ENGINES
+    engine = "rbf"
+
+    def __init__(self, observations, stations, modality="",
+                 factorizations=None, altitude_weight=None):
         """
         Constructor of the Interpolator, creates the radial basis functions from
         which the "interpolate" method will sample.
@@ -97,8 +349,38 @@ class Interpolator:
             Modality of the underlying values -- some modalities require special
             treatment, such as the wind_direction, which is split into a x- and
             y-component which are treated independently.
+        factorizations : FactorizationCache
+            If given, the kernel factorization is taken from or stored in this
+            cache, such that interpolators for the same or a similar set of
+            stations are solved in O(N^2).
+        altitude_weight : float
+            Overrides the altitude weight of the modality given in
+            MODALITY_ALTITUDE_WEIGHT, used for parameter studies.
         """
 
+        self._init_table(observations, stations, modality, altitude_weight)
+
+        # Calculate the radial basis function weights for each dimension by
+        # solving the linear system A * nodes = values, where A contains the
+        # kernel evaluated between all pairs of stations. This is equivalent to
+        # scipy.interpolate.Rbf with function="linear". SciPy is only imported
+        # here, such that loading the package and restoring snapshots is fast.
+        if not factorizations is None:
+            self.nodes = factorizations.get(
+                self.station_ids, self.tbl[:, 0:3],
+                self.altitude_weight).solve(self.tbl[:, 3:])
+            return
+        import scipy.linalg
+        A = kernel_matrix(self.tbl[:, 0:3], self.tbl[:, 0:3],
+                          self.altitude_weight)
+        self.nodes = scipy.linalg.solve(A, self.tbl[:, 3:])
+
+    def _init_table(self, observations, stations, modality,
+                    altitude_weight=None):
+        """
+        Fills the table containing the location and value of each station and
+        reads the value range and altitude weight of the modality.
+        """
         # Fetch the minimum/maximum value
         self.min_value = min(map(lambda x: x[0], observations.values()))
         self.max_value = max(map(lambda x: x[0], observations.values()))
@@ -109,39 +391,48 @@ class Interpolator:
 
         # Write the observations into a NumPy array containg the value and
         # the latitude/longitude/altitude, if necessary expand the values
-        # into multiple dimensions
+        # into multiple dimensions. Stations are sorted by their id, such that
+        # interpolators for the same set of stations share the same kernel.
         self.modality = modality
         self.tbl = np.zeros((len(observations), 3 + dims))
+        self.station_ids = np.zeros(len(observations), dtype=np.int64)
         i = 0
-        for station_id, station_data in observations.items():
+        for station_id, station_data in sorted(observations.items()):
             if not station_id in stations.coords:
                 continue
             lat, lon, alt = stations.coords[station_id]
             value = self._split_value(station_data[0])
             self.tbl[i] = (lat, lon, alt) + value
+            self.station_ids[i] = station_id
             i = i + 1
         if i == 0:
             raise Exception("No valid stations found!")
         self.tbl = self.tbl[0:i]
+        self.station_ids = self.station_ids[0:i]
 
         # Read the altitude weight factor for this modality
-        altitude_weight = (MODALITY_ALTITUDE_WEIGHT[modality]
-                           if modality in MODALITY_ALTITUDE_WEIGHT else 1.0)
-
-        # Calculate the radial basis functions for each dimension
-        self.rbfis = []
-        for dim in range(dims):
-            obs_lats = self.tbl[:, 0]
-            obs_lons = self.tbl[:, 1]
-            obs_alts = self.tbl[:, 2]
-            obs_values = self.tbl[:, 3 + dim]
-            self.rbfis.append(
-                scipy.interpolate.Rbf(obs_lats,
-                                      obs_lons,
-                                      obs_alts,
-                                      obs_values,
-                                      function="linear",
-                                      norm=Norm(altitude_weight)))
+        self.altitude_weight = (MODALITY_ALTITUDE_WEIGHT[modality]
+                                if modality in MODALITY_ALTITUDE_WEIGHT else
+                                1.0)
+        if not altitude_weight is None:
+            self.altitude_weight = altitude_weight
+
+    @classmethod
+    def from_state(cls, modality, tbl, station_ids, nodes, min_value,
+                   max_value, altitude_weight):
+        """
+        Creates an interpolator from previously solved state, e.g. loaded from
+        a snapshot file, without solving the linear system again.
+        """
+        self = cls.__new__(cls)
+        self.modality = modality
+        self.tbl = tbl
+        self.station_ids = station_ids
+        self.nodes = nodes
+        self.min_value = min_value
+        self.max_value = max_value
+        self.altitude_weight = altitude_weight
+        return self
 
     def _split_value(self, v):
         """
@@ -161,22 +452,337 @@ class Interpolator:
         else:
             return vs[0]
 
-    def interpolate(self, lats, lons, alts):
+    def _finalize(self, vs):
+        """
+        Joins the individual value dimensions and clamps the result to the range
+        of the observed values.
+        """
+        res = self._join_values(vs)
+        if not self.modality in MODALITY_NO_CLAMP:
+            res = np.maximum(np.minimum(res, self.max_value), self.min_value)
+        return res
+
+    def kernel(self, lats, lons, alts, dtype=np.float64):
+        """
+        Returns the kernel matrix between the given query points and the
+        stations used by this interpolator. The matrix can be passed to
+        interpolate_kernel() in order to evaluate interpolators for the same
+        set of stations and altitude weight without recomputing the kernel.
+
+        dtype : type
+            Floating point type the kernel is evaluated and stored in. A
+            np.float32 kernel requires half the memory and is evaluated
+            faster, see float32_error_bound() for the resulting deviation.
+        """
+        pts = np.stack((np.ravel(lats), np.ravel(lons), np.ravel(alts)), 1)
+        res = np.empty((pts.shape[0], self.tbl.shape[0]), dtype=dtype)
+        for i in range(0, pts.shape[0], KERNEL_BLOCK_SIZE):
+            res[i:(i + KERNEL_BLOCK_SIZE)] = kernel_matrix(
+                pts[i:(i + KERNEL_BLOCK_SIZE)], self.tbl[:, 0:3],
+                self.altitude_weight, dtype)
+        return res
+
+    def kernel_nbytes(self, n, dtype=np.float64):
+        """
+        Returns the size in bytes of the result of kernel() for n query points.
+        """
+        return n * self.tbl.shape[0] * np.dtype(dtype).itemsize
+
+    def float32_error_bound(self, kernel):
+        """
+        Returns the bound on the deviation of the (split) values interpolated
+        using a np.float32 kernel from the values interpolated using the given
+        np.float64 kernel: FLOAT32_ERROR_FACTOR * eps * max(kernel row) *
+        sum(abs(nodes)), where eps is the machine epsilon of np.float32. The
+        result has the shape (number of query points, number of dimensions).
+        """
+        return (FLOAT32_ERROR_FACTOR * np.finfo(np.float32).eps *
+                np.max(kernel, axis=1)[:, None] *
+                np.sum(np.abs(self.nodes), axis=0))
+
+    def interpolate_kernel(self, kernel, shape=None):
+        """
+        Evaluates the interpolator using a kernel matrix previously computed
+        by kernel(). The result is reshaped to the given shape and has the
+        floating point type of the kernel. The nodes are always solved for in
+        double precision and only rounded for the evaluation.
+        """
+        vs = kernel @ self.nodes.astype(kernel.dtype, copy=False)
+        if not shape is None:
+            vs = np.reshape(vs, tuple(shape) + (vs.shape[1], ))
+        return self._finalize(np.moveaxis(vs, -1, 0)).astype(kernel.dtype,
+                                                             copy=False)
+
+    def leave_one_out(self):
+        """
+        Returns the values predicted at each station by the interpolator built
+        from all other stations. Instead of solving N systems, the residuals
+        are computed in closed form from a single inverse of the kernel matrix
+        (Rippa, 1999): the residual of station i is nodes[i] / inv(A)[i, i].
+        The result has the shape (N, dims) and contains the split values, see
+        _split_value().
+        """
+        import scipy.linalg
+        A_inv = scipy.linalg.inv(
+            kernel_matrix(self.tbl[:, 0:3], self.tbl[:, 0:3],
+                          self.altitude_weight))
+        nodes = A_inv @ self.tbl[:, 3:]
+        return self.tbl[:, 3:] - nodes / np.diag(A_inv)[:, None]
+
+    def interpolate(self, lats, lons, alts, dtype=np.float64):
         """
         Returns interpolated data for the given observation modality and an
-        array of latitudes, longitudes and altitudes.
+        array of latitudes, longitudes and altitudes. The kernel is evaluated
+        using the given floating point type, see kernel().
         """
+        lats, lons, alts = np.broadcast_arrays(np.asarray(lats, dtype=float),
+                                               np.asarray(lons, dtype=float),
+                                               np.asarray(alts, dtype=float))
 
-        # Perform the actual interpolation for each value dimension
-        vs = []
-        for rbfi in self.rbfis:
-            vs.append(rbfi(lats, lons, alts))
+        # Perform the actual interpolation block-wise for each value dimension
+        pts = np.stack((lats.ravel(), lons.ravel(), alts.ravel()), 1)
+        nodes = self.nodes.astype(dtype, copy=False)
+        vs = np.empty((pts.shape[0], self.nodes.shape[1]), dtype=dtype)
+        for i in range(0, pts.shape[0], KERNEL_BLOCK_SIZE):
+            vs[i:(i + KERNEL_BLOCK_SIZE)] = kernel_matrix(
+                pts[i:(i + KERNEL_BLOCK_SIZE)], self.tbl[:, 0:3],
+                self.altitude_weight, dtype) @ nodes
+        vs = np.reshape(vs, lats.shape + (vs.shape[1], ))
+        return self._finalize(np.moveaxis(vs, -1, 0)).astype(dtype,
+                                                             copy=False)
 
-        # Join the dimensions into a single value
-        res = self._join_values(vs)
 
-        # Clamp the values to the naturally occuring values
-        if not self.modality in MODALITY_NO_CLAMP:
-            res = np.maximum(np.minimum(res, self.max_value), self.min_value)
+class LocalInterpolator(Interpolator):
+    """
+    Interpolator which only takes the k stations nearest to each query point
+    into account. Neighbours are found using a KD-tree over the station ECEF
+    coordinates extended by the weighted altitude, such that the neighbourhood
+    matches the norm used by the global interpolator. The "local_rbf" engine
+    fits a linear radial basis function over the neighbours, the "local_idw"
+    engine uses inverse distance weighting. Building the interpolator is
+    O(N log N), a query O(log N + k^2) plus O(k^3) for each distinct
+    neighbourhood, which allows networks of tens of thousands of stations.
+    """
+
+    def __init__(self,
+                 observations,
+                 stations,
+                 modality="",
+                 engine="local_rbf",
+                 neighbours=DEFAULT_NEIGHBOURS,
+                 altitude_weight=None):
+        """
+        observations, stations, modality :
+            See Interpolator.
+        engine : str
+            Either "local_rbf" or "local_idw".
+        neighbours : int
+            Number of stations used for each query point.
+        altitude_weight : float
+            Overrides the altitude weight of the modality.
+        """
+        self._init_table(observations, stations, modality, altitude_weight)
+        self._init_index(engine, neighbours)
+
+    def _init_index(self, engine, neighbours):
+        if not engine in ["local_rbf", "local_idw"]:
+            raise Exception("Unknown local engine \"" + str(engine) + "\"")
+        import scipy.spatial
+        self.engine = engine
+        self.neighbours = min(int(neighbours), self.tbl.shape[0])
+        self.index = scipy.spatial.cKDTree(self._index_coords(
+            self.tbl[:, 0], self.tbl[:, 1], self.tbl[:, 2]))
+
+    @classmethod
+    def from_state(cls, modality, tbl, station_ids, min_value, max_value,
+                   altitude_weight, engine, neighbours):
+        """
+        Creates a local interpolator from previously stored state, see
+        Interpolator.from_state().
+        """
+        self = cls.__new__(cls)
+        self.modality = modality
+        self.tbl = tbl
+        self.station_ids = station_ids
+        self.min_value = min_value
+        self.max_value = max_value
+        self.altitude_weight = altitude_weight
+        self._init_index(engine, neighbours)
+        return self
+
+    def _index_coords(self, lats, lons, alts):
+        from .stations import ecef
+        return np.concatenate(
+            (ecef(lats, lons), (np.asarray(alts, dtype=np.float64) / 1000.0 *
+                                self.altitude_weight)[..., None]), -1)
+
+    def _weights(self, pts, exclude=None):
+        """
+        Returns the indices of the neighbouring stations and their weights for
+        each of the given query points. If given, exclude contains the index
+        of a station which must not be used for each query point.
+        """
+        coords = self._index_coords(pts[:, 0], pts[:, 1], pts[:, 2])
+        if exclude is None:
+            k = self.neighbours
+            _, idcs = self.index.query(coords, k=k)
+            idcs = np.reshape(idcs, (pts.shape[0], k))
+        else:
+            k = min(self.neighbours, self.tbl.shape[0] - 1)
+            _, idcs = self.index.query(coords, k=k + 1)
+            idcs = np.reshape(idcs, (pts.shape[0], k + 1))
+            keep = np.argsort(idcs == np.asarray(exclude)[:, None],
+                              axis=1,
+                              kind="stable")[:, :k]
+            idcs = np.take_along_axis(idcs, keep, 1)
+        if self.engine == "local_rbf":
+            idcs = np.sort(idcs, axis=1)
+
+        # Distances between the query points and their neighbours
+        norm = Norm(self.altitude_weight)
+        d = norm(np.moveaxis(pts, -1, 0)[:, :, None],
+                 np.moveaxis(self.tbl[:, 0:3][idcs], -1, 0))
+
+        if self.engine == "local_idw":
+            with np.errstate(divide="ignore"):
+                w = 1.0 / d**IDW_POWER
+            exact = np.isinf(w)
+            rows = np.any(exact, axis=1)
+            w[rows] = exact[rows]
+            return idcs, w / np.sum(w, axis=1, keepdims=True)
+
+        # Solve the local kernel system once for each distinct neighbourhood.
+        # The linear kernel is only conditionally positive definite, the
+        # system is thus augmented by a constant term, which keeps the local
+        # fits well-behaved between the neighbours. Since the augmented
+        # matrices are symmetric, the weights of a query point are given by
+        # the inverse matrix times its (augmented) kernel row.
+        sets, inverse = np.unique(idcs, axis=0, return_inverse=True)
+        set_pts = np.moveaxis(self.tbl[:, 0:3][sets], -1, 0)
+        A = np.ones((sets.shape[0], k + 1, k + 1))
+        A[:, k, k] = 0.0
+        A[:, :k, :k] = norm(set_pts[:, :, :, None], set_pts[:, :, None, :])
+        try:
+            A_inv = np.linalg.inv(A)
+        except np.linalg.LinAlgError:
+            A_inv = np.linalg.pinv(A)
+        d = np.concatenate((d, np.ones((d.shape[0], 1))), 1)
+        return idcs, np.einsum("mij,mj->mi", A_inv[np.ravel(inverse)][:, :k],
+                               d)
+
+    def kernel(self, lats, lons, alts, dtype=np.float64):
+        """
+        Returns the neighbour indices and weights for the given query points,
+        see Interpolator.kernel(). The result only depends on the station set
+        and can be reused for other observations of the same stations. The
+        weights are always calculated in double precision and stored using
+        the given floating point type.
+        """
+        pts = np.stack((np.ravel(lats), np.ravel(lons), np.ravel(alts)),
+                       1).astype(np.float64)
+        k = self.neighbours
+        idcs = np.empty((pts.shape[0], k), dtype=np.intp)
+        weights = np.empty((pts.shape[0], k), dtype=dtype)
+        for i in range(0, pts.shape[0], KERNEL_BLOCK_SIZE):
+            idcs[i:(i + KERNEL_BLOCK_SIZE)], weights[i:(
+                i + KERNEL_BLOCK_SIZE)] = self._weights(
+                    pts[i:(i + KERNEL_BLOCK_SIZE)])
+        return idcs, weights
+
+    def leave_one_out(self):
+        """
+        Returns the values predicted at each station if the station itself is
+        not used, see Interpolator.leave_one_out(). Since each prediction only
+        depends on the neighbours, no refit is necessary.
+        """
+        n = self.tbl.shape[0]
+        res = np.empty((n, self.tbl.shape[1] - 3))
+        for i in range(0, n, KERNEL_BLOCK_SIZE):
+            rows = np.arange(i, min(n, i + KERNEL_BLOCK_SIZE))
+            idcs, weights = self._weights(self.tbl[rows, 0:3], rows)
+            res[rows] = np.einsum("mk,mkd->md", weights,
+                                  self.tbl[:, 3:][idcs])
         return res
 
+    def kernel_nbytes(self, n, dtype=np.float64):
+        """
+        Returns the size in bytes of the result of kernel() for n query points.
+        """
+        return n * self.neighbours * (np.dtype(np.intp).itemsize +
+                                      np.dtype(dtype).itemsize)
+
+    def float32_error_bound(self, kernel):
+        """
+        Returns the bound on the deviation of the (split) values interpolated
+        using np.float32 weights from the values interpolated using the given
+        np.float64 kernel, see Interpolator.float32_error_bound(). The
+        rounding errors of the weighted sum grow with the number of
+        neighbours k, the bound is (FLOAT32_ERROR_FACTOR + k / 2) * eps *
+        sum(abs(weights) * abs(values)).
+        """
+        idcs, weights = kernel
+        return ((FLOAT32_ERROR_FACTOR + 0.5 * self.neighbours) *
+                np.finfo(np.float32).eps *
+                np.einsum("mk,mkd->md", np.abs(weights),
+                          np.abs(self.tbl[:, 3:])[idcs]))
+
+    def interpolate_kernel(self, kernel, shape=None):
+        """
+        Evaluates the interpolator using neighbour indices and weights
+        previously computed by kernel().
+        """
+        idcs, weights = kernel
+        vs = np.einsum("mk,mkd->md", weights,
+                       self.tbl[:, 3:].astype(weights.dtype)[idcs])
+        if not shape is None:
+            vs = np.reshape(vs, tuple(shape) + (vs.shape[1], ))
+        return self._finalize(np.moveaxis(vs, -1, 0)).astype(weights.dtype,
+                                                             copy=False)
+
+    def interpolate(self, lats, lons, alts, dtype=np.float64):
+        """
+        Returns interpolated data for the given latitudes, longitudes and
+        altitudes, see Interpolator.interpolate().
+        """
+        lats, lons, alts = np.broadcast_arrays(np.asarray(lats, dtype=float),
+                                               np.asarray(lons, dtype=float),
+                                               np.asarray(alts, dtype=float))
+
+        # Evaluate block-wise, such that the neighbour indices and weights
+        # of large grids are never held in memory at once
+        shape = lats.shape
+        lats, lons, alts = lats.ravel(), lons.ravel(), alts.ravel()
+        vs = [
+            self.interpolate_kernel(
+                self.kernel(lats[i:(i + KERNEL_BLOCK_SIZE)],
+                            lons[i:(i + KERNEL_BLOCK_SIZE)],
+                            alts[i:(i + KERNEL_BLOCK_SIZE)], dtype))
+            for i in range(0, len(lats), KERNEL_BLOCK_SIZE)
+        ]
+        return np.reshape(np.concatenate(vs, -1) if len(vs) > 0 else
+                          np.zeros(0, dtype=dtype), shape)
+
+
+# Available interpolation engines
+ENGINES = ["rbf", "local_rbf", "local_idw"]
+
+
+def create_interpolator(observations,
+                        stations,
+                        modality="",
+                        engine="rbf",
+                        factorizations=None,
+                        neighbours=DEFAULT_NEIGHBOURS,
+                        altitude_weight=None):
+    """
+    Creates an interpolator using the given engine: "rbf" is the global
+    radial basis function interpolator, "local_rbf" and "local_idw" the local
+    neighbourhood interpolators, see LocalInterpolator.
+    """
+    if engine == "rbf":
+        return Interpolator(observations, stations, modality, factorizations,
+                            altitude_weight)
+    elif engine in ENGINES:
+        return LocalInterpolator(observations, stations, modality, engine,
+                                 neighbours, altitude_weight)
+    raise Exception("Unknown interpolation engine \"" + str(engine) + "\"")
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+#   Simple REST HTTP Weather Server using DWD weather data for Germany
+#   Copyright (C) 2016 Andreas Stöckel
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import json
+import os
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets in seconds
+DEFAULT_BUCKETS = [
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+    5.0, 10.0, 30.0
+]
+
+# Descriptions of the individual metrics, written as HELP lines
+METRIC_HELP = {
+    "pydwdapi_stage_seconds": "Time spent in the individual processing stages",
+    "pydwdapi_request_seconds": "Time spent handling HTTP requests",
+    "pydwdapi_interpolator_cache_hits_total":
+    "Number of interpolators found in the cache",
+    "pydwdapi_interpolator_cache_misses_total":
+    "Number of interpolators which had to be built",
+    "pydwdapi_station_observations_total":
+    "Number of latest observations per station returned by the store or the "
+    "database",
+    "pydwdapi_ftp_bytes_total": "Number of bytes downloaded from the FTP server",
+    "pydwdapi_ingest_rows_total": "Number of observations written to the database",
+    "pydwdapi_kernel_factorizations":
+    "Number of reused, updated and newly computed kernel factorizations",
+}
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Minimum interval in seconds in which a process writes its metrics to the
+# shared directory, see Metrics.share()
+FLUSH_INTERVAL = 1.0
+
+
+class _NullTimer:
+    """
+    Timer returned while the metrics are disabled, does nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "labels", "t0")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.observe(self.name, time.perf_counter() - self.t0,
+                             self.labels)
+        return False
+
+
+class Metrics:
+    """
+    Minimal registry of counters and latency histograms which can be rendered
+    in the Prometheus text format. While the registry is disabled, all
+    recording methods return immediately. Registries of multiple processes can
+    be aggregated using a shared directory, see share().
+    """
+
+    def __init__(self, enabled=False, buckets=DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.buckets = list(buckets)
+        self.lock = threading.Lock()
+        self.counters = {}  # Map from (name, labels) to the counter value
+        self.histograms = {}  # Map from (name, labels) to [counts, sum]
+        self.shared_dir = None
+        self.flushed = 0.0
+
+    def inc(self, name, value=1, labels=()):
+        """
+        Increments the counter with the given name. Labels are given as tuple
+        of (key, value) pairs.
+        """
+        if not self.enabled:
+            return
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        """
+        Records a value in the histogram with the given name.
+        """
+        if not self.enabled:
+            return
+        key = (name, labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if not key in self.histograms:
+                self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram = self.histograms[key]
+            histogram[0][i] += 1
+            histogram[1] += value
+
+    def timer(self, name, labels=()):
+        """
+        Returns a context manager which records the time spent in its body in
+        the histogram with the given name.
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def stage(self, stage):
+        """
+        Returns a timer for the given processing stage.
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        return _Timer(self, "pydwdapi_stage_seconds", (("stage", stage), ))
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+        self.flushed = 0.0
+
+    def share(self, shared_dir):
+        """
+        Aggregates the metrics of all processes writing to the given directory.
+        Each process periodically writes its counters, histograms and gauges
+        to a file named after its process id, see flush(); render() adds up
+        the values of all files. None disables the aggregation.
+        """
+        self.shared_dir = shared_dir
+        self.flushed = 0.0
+
+    def _shared_file(self, pid):
+        return os.path.join(self.shared_dir, str(pid) + ".json")
+
+    def flush(self, gauges=None, force=False):
+        """
+        Writes the metrics of this process to the shared directory, at most
+        once every FLUSH_INTERVAL seconds unless force is True. gauges is a
+        function returning additional gauges, see render().
+        """
+        if (not self.enabled or self.shared_dir is None or
+            (not force and time.monotonic() - self.flushed < FLUSH_INTERVAL)):
+            return
+        self.flushed = time.monotonic()
+        counters, histograms = self._copy()
+        gauges = {} if gauges is None else gauges()
+        data = {
+            "counters": [[n, l, v] for (n, l), v in counters.items()],
+            "histograms": [[n, l, c, t]
+                           for (n, l), (c, t) in histograms.items()],
+            "gauges": [[n, l, v] for (n, l), v in gauges.items()],
+        }
+        filename = self._shared_file(os.getpid())
+        with open(filename + ".tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(filename + ".tmp", filename)
+
+    def retire(self, pid):
+        """
+        Adds the counters and histograms last written by the exited process
+        with the given id to this registry, such that they do not vanish from
+        the aggregated metrics. The gauges of the process are discarded.
+        """
+        if self.shared_dir is None:
+            return
+        filename = self._shared_file(pid)
+        try:
+            with open(filename, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        with self.lock:
+            self._merge(self.counters, self.histograms, {}, data)
+        os.remove(filename)
+
+    @staticmethod
+    def _merge(counters, histograms, gauges, data):
+        """
+        Adds the values read from a shared file to the given maps.
+        """
+        key = lambda n, l: (n, tuple(tuple(label) for label in l))
+        for n, l, v in data.get("counters", []):
+            counters[key(n, l)] = counters.get(key(n, l), 0) + v
+        for n, l, c, t in data.get("histograms", []):
+            if not key(n, l) in histograms:
+                histograms[key(n, l)] = [[0] * len(c), 0.0]
+            histogram = histograms[key(n, l)]
+            histogram[0] = [a + b for a, b in zip(histogram[0], c)]
+            histogram[1] += t
+        for n, l, v in data.get("gauges", []):
+            gauges[key(n, l)] = gauges.get(key(n, l), 0) + v
+        return counters, histograms, gauges
+
+    def _copy(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {
+                key: (list(value[0]), value[1])
+                for key, value in self.histograms.items()
+            }
+        return counters, histograms
+
+    def _aggregate(self, gauges):
+        """
+        Returns the counters, histograms and gauges of all processes writing
+        to the shared directory.
+        """
+        self.flush(lambda: gauges, force=True)
+        counters, histograms, gauges = {}, {}, {}
+        for filename in sorted(os.listdir(self.shared_dir)):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.shared_dir, filename), "r") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            self._merge(counters, histograms, gauges, data)
+        return counters, histograms, gauges
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if len(labels) == 0:
+            return ""
+        return "{" + ",".join(
+            k + "=\"" + str(v).replace("\\", "\\\\").replace("\"", "\\\"") +
+            "\"" for k, v in labels) + "}"
+
+    def render(self, gauges={}):
+        """
+        Returns all metrics in the Prometheus text exposition format. Additional
+        gauges can be passed as map from (name, labels) to values. If a shared
+        directory is set, the values of all processes are added up.
+        """
+        if self.shared_dir is None:
+            counters, histograms = self._copy()
+        else:
+            counters, histograms, gauges = self._aggregate(gauges)
+
+        lines = []
+        written = set()
+
+        def header(name, kind):
+            if not name in written:
+                written.add(name)
+                if name in METRIC_HELP:
+                    lines.append("# HELP " + name + " " + METRIC_HELP[name])
+                lines.append("# TYPE " + name + " " + kind)
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, "counter")
+            lines.append(name + self._labels(labels) + " " + repr(value))
+        for (name, labels), value in sorted(gauges.items()):
+            header(name, "gauge")
+            lines.append(name + self._labels(labels) + " " + repr(value))
+        for (name, labels), (counts, total) in sorted(histograms.items()):
+            header(name, "histogram")
+            n = 0
+            for bound, count in zip(self.buckets + ["+Inf"], counts):
+                n += count
+                lines.append(name + "_bucket" + self._labels(labels, (
+                    ("le", bound), )) + " " + str(n))
+            lines.append(name + "_sum" + self._labels(labels) + " " +
+                         repr(total))
+            lines.append(name + "_count" + self._labels(labels) + " " +
+                         str(n))
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide registry used by all pydwdapi components
+registry = Metrics()
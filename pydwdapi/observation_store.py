@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+#   Simple REST HTTP Weather Server using DWD weather data for Germany
+#   Copyright (C) 2016 Andreas Stöckel
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import threading
+
+from .database import MODALITY_MAP, MODALITY_ID_MAP
+
+# Initial number of rows the ring buffer can hold
+INITIAL_CAPACITY = 4096
+
+# SQL used to load the recent observations into the store
+SQL_LOAD_OBSERVATIONS = "SELECT timestamp, value, modality, station, source FROM observations WHERE timestamp > ?"
+
+
+class ObservationStore:
+    """
+    In-memory, columnar mirror of the recent rows of the observations table.
+    The rows are stored in a NumPy ring buffer -- once the buffer is full, rows
+    older than the retention window are overwritten, otherwise the buffer grows.
+    The SQLite database stays the durable log; the store only answers queries
+    for the latest value per station and modality within the retention window.
+    All public methods are thread-safe.
+    """
+
+    def __init__(self, window, capacity=INITIAL_CAPACITY):
+        """
+        window : float
+            Retention window in seconds. Queries reaching further into the past
+            than the window cannot be answered by the store, see covers().
+        capacity : int
+            Initial number of rows in the ring buffer.
+        """
+        self.window = window
+        self.since = np.inf  # Lower bound (exclusive) of the stored data
+        self.latest_ts = -np.inf
+        self.head = 0  # Index of the next row that is written
+        self.size = 0  # Number of valid rows
+        self.lock = threading.RLock()
+        self._alloc(capacity)
+
+    def _alloc(self, capacity):
+        self.ts = np.full(capacity, -np.inf)
+        self.value = np.zeros(capacity)
+        self.modality = np.zeros(capacity, dtype=np.int32)
+        self.station = np.zeros(capacity, dtype=np.int64)
+        self.source = np.zeros(capacity, dtype=np.int32)
+
+    def _columns(self):
+        return [self.ts, self.value, self.modality, self.station, self.source]
+
+    def _grow(self, capacity):
+        """
+        Copies the valid rows into a larger buffer, oldest row first.
+        """
+        idcs = (self.head - self.size + np.arange(self.size)) % len(self.ts)
+        old = [col[idcs] for col in self._columns()]
+        self._alloc(capacity)
+        for col, data in zip(self._columns(), old):
+            col[0:self.size] = data
+        self.head = self.size
+
+    def load(self, database, now):
+        """
+        (Re)loads all observations newer than now - window from the database.
+        """
+        since = now - self.window
+        rows = database.conn.execute(SQL_LOAD_OBSERVATIONS,
+                                     (since, )).fetchall()
+        with self.lock:
+            self._load(since, rows)
+
+    def _load(self, since, rows):
+        self.head = 0
+        self.size = 0
+        self.latest_ts = -np.inf
+        self._alloc(max(INITIAL_CAPACITY, 2 * len(rows)))
+        self.since = since
+        if len(rows) > 0:
+            tbl = np.array(rows, dtype=np.float64)
+            self._append(tbl[:, 0], tbl[:, 1], tbl[:, 2], tbl[:, 3],
+                         tbl[:, 4])
+
+    def append(self, ts, value, modality_id, station_id, source_id):
+        """
+        Appends one or more rows to the store. All arguments may either be
+        scalars or arrays of the same length. Modalities are given as the ids
+        stored in the database.
+        """
+        with self.lock:
+            self._append(ts, value, modality_id, station_id, source_id)
+
+    def _append(self, ts, value, modality_id, station_id, source_id):
+        cols = np.broadcast_arrays(np.atleast_1d(ts), np.atleast_1d(value),
+                                   np.atleast_1d(modality_id),
+                                   np.atleast_1d(station_id),
+                                   np.atleast_1d(source_id))
+        n = len(cols[0])
+        if n == 0:
+            return
+        self.latest_ts = max(self.latest_ts, np.max(cols[0]))
+
+        # Make sure there is enough space in the buffer. Only overwrite the
+        # oldest rows if they are outside of the retention window, otherwise
+        # grow the buffer.
+        capacity = len(self.ts)
+        free = capacity - self.size
+        if n > free:
+            n_drop = min(self.size, n - free)
+            drop = (self.head - self.size + np.arange(n_drop)) % capacity
+            horizon = self.latest_ts - self.window
+            if n > capacity or np.any(self.ts[drop] > horizon):
+                self._grow(max(2 * capacity, self.size + n))
+            else:
+                self.since = max(self.since, np.max(self.ts[drop]))
+                self.size -= n_drop
+
+        # Write the rows
+        idcs = (self.head + np.arange(n)) % len(self.ts)
+        for col, data in zip(self._columns(), cols):
+            col[idcs] = data
+        self.head = (self.head + n) % len(self.ts)
+        self.size += n
+
+    def append_observation(self, ts, value, modality, station_id, source_id):
+        """
+        Appends a single observation, the modality is given by its name.
+        """
+        self.append(ts, value, MODALITY_MAP[modality], station_id, source_id)
+
+    def covers(self, since):
+        """
+        Returns True if the store contains all observations newer than the
+        given timestamp.
+        """
+        return since >= self.since
+
+    def _latest(self, mask, key):
+        """
+        Returns the indices of the latest row for each distinct value of key
+        among the rows selected by mask.
+        """
+        idcs = np.flatnonzero(mask)
+        if len(idcs) == 0:
+            return idcs
+        keys = key[idcs]
+        order = np.lexsort((-self.ts[idcs], keys))
+        keys = keys[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        return idcs[order[first]]
+
+    def query_observations(self, modality, since=0.0, max_ts=1e20):
+        """
+        Returns the latest observation per station for the given modality within
+        the given time range. The result has the same format as
+        Database.query_observations().
+        """
+        with self.lock:
+            mask = ((self.modality == MODALITY_MAP[modality]) &
+                    (self.ts > since) & (self.ts <= max_ts))
+            idcs = self._latest(mask, self.station)
+            return {
+                int(s): (float(v), float(t), int(src))
+                for s, v, t, src in zip(self.station[idcs], self.value[idcs],
+                                        self.ts[idcs], self.source[idcs])
+            }
+
+    def query_observations_for_stations(self, station_ids, since=0.0,
+                                        max_ts=1e20):
+        """
+        Returns the latest observation per modality for each of the given
+        stations within the given time range. The result has the same format as
+        Database.query_observations_for_stations().
+        """
+        station_ids = np.asarray(list(station_ids), dtype=np.int64)
+        with self.lock:
+            mask = (np.isin(self.station, station_ids) &
+                    (self.ts > since) & (self.ts <= max_ts))
+            key = self.station * (1 << 20) + self.modality
+            idcs = self._latest(mask, key)
+            ts, value = self.ts[idcs], self.value[idcs]
+            modality, station = self.modality[idcs], self.station[idcs]
+            source = self.source[idcs]
+        res = {}
+        for i in range(len(idcs)):
+            modality_id = int(modality[i])
+            if not modality_id in MODALITY_ID_MAP:
+                continue
+            station_id = int(station[i])
+            if not station_id in res:
+                res[station_id] = {}
+            res[station_id][MODALITY_ID_MAP[modality_id]] = (
+                float(value[i]), float(ts[i]), int(source[i]))
+        return res
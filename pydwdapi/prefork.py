@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#   Simple REST HTTP Weather Server using DWD weather data for Germany
+#   Copyright (C) 2016 Andreas Stöckel
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import select
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+from . import metrics
+from .server import create_server, gauges
+
+# Fetch the logger
+import logging
+logger = logging.getLogger("pydwdapi")
+
+# Default interval in seconds in which the parent process downloads new data
+DEFAULT_UPDATE_INTERVAL = 60.0
+
+# Interval in seconds in which the parent process checks for exited workers
+SUPERVISE_INTERVAL = 1.0
+
+# Time in seconds the parent process spends on migrating a database created by
+# an older version per supervision interval, see PyDWDApi.migrate()
+MIGRATE_TIME = 0.5
+
+
+def _worker(api, httpd):
+    """
+    Main loop of a worker process. Workers never download data themselves but
+    follow the snapshot file written by the parent process.
+    """
+    # Workers are stopped by the parent process, ignore CTRL+C sent to the
+    # entire process group
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    api.follow_snapshot = True
+    api.ftp_user, api.ftp_password = "", ""
+    api.snapshot_stat = None
+
+    # Do not count the metrics recorded by the parent process twice
+    metrics.registry.reset()
+    api.update()
+
+    # All workers wait for connections on the same socket. The socket is
+    # non-blocking, such that workers which lose the race for a connection
+    # return to select() instead of blocking in accept(). Since this sets the
+    # socket timeout to zero, handle_request() would not block at all; wait
+    # in select() here instead. The timeout makes idle workers publish their
+    # metrics regularly.
+    httpd.socket.setblocking(False)
+    while True:
+        ready, _, _ = select.select([httpd], [], [], metrics.FLUSH_INTERVAL)
+        if ready:
+            httpd._handle_request_noblock()
+        metrics.registry.flush(lambda: gauges(api))
+
+
+def _spawn(api, httpd):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            _worker(api, httpd)
+        except BaseException:
+            logger.exception("Worker " + str(os.getpid()) + " failed")
+        finally:
+            os._exit(1)
+    logger.info("Started worker " + str(pid))
+    return pid
+
+
+def serve_prefork(api,
+                  port=8080,
+                  interface="127.0.0.1",
+                  workers=None,
+                  update_interval=DEFAULT_UPDATE_INTERVAL):
+    """
+    Serves the api using multiple worker processes. The calling process binds
+    the socket, writes an initial snapshot of the interpolators and forks the
+    workers, which accept connections on the shared socket. Everything loaded
+    before the fork (stations, altitude data) is shared copy-on-write, the
+    interpolators are memory-mapped from the snapshot file and thus shared via
+    the page cache. Only the parent process downloads new data; each update
+    replaces the snapshot file, which the workers pick up before handling the
+    next request. Exited workers are restarted. If metrics are enabled, all
+    processes write their metrics to a shared temporary directory, such that
+    /metrics reports the sum over the parent and all workers. Does not return
+    until the process is interrupted or terminated.
+
+    api : PyDWDApi
+        Fully initialized instance of the PyDWDApi class.
+    workers : int
+        Number of worker processes, defaults to the number of CPU cores.
+    update_interval : float
+        Interval in seconds in which the parent process downloads new data.
+    """
+    if not hasattr(os, "fork"):
+        raise Exception("The pre-fork server requires os.fork()")
+    if not api.snapshot_file:
+        raise Exception("The pre-fork server requires a snapshot file")
+    workers = (os.cpu_count() or 1) if workers is None else workers
+
+    # Bind the socket, load the altitude data such that it is shared with the
+    # workers and publish the initial snapshot
+    httpd = create_server(api, port, interface)
+    api.preload()
+    try:
+        api.update()
+    except Exception:
+        logger.exception("Exception while updating the data")
+    api.save_snapshot()
+
+    # Terminate gracefully upon SIGTERM
+    def terminate(signum, frame):
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    # Aggregate the metrics of all processes
+    shared_dir = None
+    if metrics.registry.enabled:
+        shared_dir = tempfile.mkdtemp(prefix="pydwdapi-metrics-")
+        metrics.registry.share(shared_dir)
+
+    pids = set()
+    try:
+        next_update = time.time() + update_interval
+        while True:
+            # Restart exited workers
+            while len(pids) < workers:
+                pids.add(_spawn(api, httpd))
+            time.sleep(SUPERVISE_INTERVAL)
+            while len(pids) > 0:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                logger.warning("Worker " + str(pid) + " exited with status " +
+                               str(status))
+                pids.discard(pid)
+                metrics.registry.retire(pid)
+
+            # Continue migrating the database. This is done in small steps
+            # in the parent process itself, such that no thread is running
+            # when workers are forked.
+            api.migrate(max_time=MIGRATE_TIME)
+
+            # Download new data, this writes a new snapshot if there are any
+            # changes
+            if time.time() >= next_update:
+                try:
+                    api.update()
+                except Exception:
+                    logger.exception("Exception while updating the data")
+                next_update = time.time() + update_interval
+
+            # Publish the metrics of the parent process (updates, downloads,
+            # ingest)
+            metrics.registry.flush(lambda: gauges(api))
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        httpd.server_close()
+        if not shared_dir is None:
+            metrics.registry.share(None)
+            shutil.rmtree(shared_dir, ignore_errors=True)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#   Simple REST HTTP Weather Server using DWD weather data for Germany
+#   Copyright (C) 2016 Andreas Stöckel
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import threading
+import time
+
+# Fetch the logger
+import logging
+logger = logging.getLogger("pydwdapi")
+
+# Default number of functions listed in a textual profile report
+DEFAULT_REPORT_LIMIT = 40
+
+
+class Profiler:
+    """
+    Runs sampled HTTP requests or update cycles under cProfile. Every
+    request_every-th request and every update_every-th update is profiled, zero
+    disables sampling. Profiles are written as pstats files to output_dir, if
+    given, and can be inspected using "python3 -m pstats <FILE>". If a
+    query_token is given, clients connecting from localhost may request a
+    profile of an individual request by passing the token in the "profile"
+    query parameter.
+    """
+
+    def __init__(self,
+                 request_every=0,
+                 update_every=0,
+                 output_dir=None,
+                 query_token=None,
+                 sort="cumulative",
+                 limit=DEFAULT_REPORT_LIMIT):
+        """
+        request_every : int
+            Profile one in request_every requests.
+        update_every : int
+            Profile one in update_every update cycles.
+        output_dir : str
+            Directory the profiles are written to. If None, sampled profiles
+            are only summarized in the log.
+        query_token : str
+            Secret that must be passed in the "profile" query parameter to
+            obtain the profile of a request instead of the response. Requests
+            are only accepted from localhost, which is not a sufficient
+            restriction behind a local reverse proxy. None disables profiling
+            via the query parameter.
+        sort : str
+            Sort key used for the textual reports, see pstats.Stats.sort_stats.
+        limit : int
+            Number of functions listed in the textual reports.
+        """
+        self.every = {"request": request_every, "update": update_every}
+        self.output_dir = output_dir
+        self.query_token = query_token
+        self.sort = sort
+        self.limit = limit
+        self.counts = {}
+        self.written = 0
+        self.lock = threading.Lock()
+        if not output_dir is None:
+            os.makedirs(output_dir, exist_ok=True)
+
+    def check_token(self, token):
+        """
+        Returns True if the given token matches the query_token. The
+        comparison takes constant time to not leak the token.
+        """
+        if not self.query_token:
+            return False
+        return hmac.compare_digest(token.encode("utf-8"),
+                                   self.query_token.encode("utf-8"))
+
+    def sample(self, kind):
+        """
+        Returns True if the next event of the given kind ("request" or
+        "update") should be profiled.
+        """
+        every = self.every.get(kind, 0)
+        if every <= 0:
+            return False
+        with self.lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+            return self.counts[kind] % every == 0
+
+    def run(self, f, name):
+        """
+        Calls f() under the profiler. Returns the result of f() and the
+        cProfile.Profile instance. If an output directory is set, the profile
+        is written to a file starting with the given name.
+        """
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            res = f()
+        finally:
+            profile.disable()
+            self._write(profile, name)
+        return res, profile
+
+    def _write(self, profile, name):
+        if self.output_dir is None:
+            logger.info("Profile of " + name + ":\n" + self.report(profile))
+            return
+        with self.lock:
+            self.written += 1
+            seq = self.written
+        filename = os.path.join(
+            self.output_dir, "{}-{:.0f}-{}-{}.prof".format(
+                name, time.time() * 1000.0, os.getpid(), seq))
+        profile.dump_stats(filename)
+        logger.info("Wrote profile of " + name + " to " + filename)
+
+    def report(self, profile):
+        """
+        Returns a textual summary of the given profile.
+        """
+        f = io.StringIO()
+        stats = pstats.Stats(profile, stream=f)
+        stats.sort_stats(self.sort).print_stats(self.limit)
+        return f.getvalue()
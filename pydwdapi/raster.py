@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+#   Simple REST HTTP Weather Server using DWD weather data for Germany
+#   Copyright (C) 2016 Andreas Stöckel
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import struct
+import zlib
+import numpy as np
+
+# Piecewise linear colormap definitions -- for each of the red, green and blue
+# channel a list of (x, value) pairs. These are the same control points as used
+# by the matplotlib "jet" and "hsv" colormaps.
+COLORMAPS = {
+    "jet": (
+        [(0.0, 0.0), (0.35, 0.0), (0.66, 1.0), (0.89, 1.0), (1.0, 0.5)],
+        [(0.0, 0.0), (0.125, 0.0), (0.375, 1.0), (0.64, 1.0), (0.91, 0.0),
+         (1.0, 0.0)],
+        [(0.0, 0.5), (0.11, 1.0), (0.34, 1.0), (0.65, 0.0), (1.0, 0.0)],
+    ),
+    "hsv": (
+        [(0.0, 1.0), (0.158730, 1.0), (0.174603, 0.968750),
+         (0.333333, 0.031250), (0.349206, 0.0), (0.666667, 0.0),
+         (0.682540, 0.031250), (0.841270, 0.968750), (0.857143, 1.0),
+         (1.0, 1.0)],
+        [(0.0, 0.0), (0.158730, 0.937500), (0.174603, 1.0), (0.507937, 1.0),
+         (0.666667, 0.062500), (0.682540, 0.0), (1.0, 0.0)],
+        [(0.0, 0.0), (0.333333, 0.0), (0.349206, 0.062500), (0.507937, 1.0),
+         (0.841270, 1.0), (0.857143, 0.937500), (1.0, 0.09375)],
+    ),
+}
+
+# Number of entries in the colormap lookup tables
+LUT_SIZE = 256
+
+# Colors used for the overlay
+BORDER_COLOR = (0xdd, 0xdd, 0xdd)
+STATION_COLOR = (0x00, 0x00, 0x00)
+
+
+def colormap_lut(name, size=LUT_SIZE):
+    """
+    Returns a size x 3 uint8 lookup table for the colormap with the given name.
+    """
+    if not name in COLORMAPS:
+        raise Exception("Unknown colormap \"" + str(name) + "\"")
+    xs = np.linspace(0.0, 1.0, size)
+    lut = np.zeros((size, 3), dtype=np.uint8)
+    for i, channel in enumerate(COLORMAPS[name]):
+        cxs, cys = zip(*channel)
+        lut[:, i] = np.round(np.interp(xs, cxs, cys) * 255.0)
+    return lut
+
+
+def apply_colormap(zzs, vmin, vmax, cmap="jet"):
+    """
+    Maps the given two-dimensional array onto an RGB image using the colormap
+    with the given name. Returns an array of shape zzs.shape + (3, ).
+    """
+    lut = colormap_lut(cmap)
+    scale = (len(lut) - 1) / max(vmax - vmin, 1e-12)
+    idcs = np.clip((np.nan_to_num(zzs, nan=vmin) - vmin) * scale, 0,
+                   len(lut) - 1)
+    return lut[idcs.astype(np.intp)]
+
+
+def _stamp(img, xs, ys, color, radius):
+    """
+    Draws a square of the given radius centered at each of the given pixel
+    coordinates.
+    """
+    h, w = img.shape[0:2]
+    xs = np.round(xs).astype(np.intp)
+    ys = np.round(ys).astype(np.intp)
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            pxs, pys = xs + dx, ys + dy
+            valid = (pxs >= 0) & (pxs < w) & (pys >= 0) & (pys < h)
+            img[pys[valid], pxs[valid]] = color
+
+
+def draw_polyline(img, xs, ys, color, width=1):
+    """
+    Rasterizes the polyline with the given pixel coordinates into the image.
+    """
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+
+    # Sample each segment with at least two points per pixel
+    n = np.maximum(np.ceil(2.0 * np.hypot(np.diff(xs), np.diff(ys))), 1)
+    n = n.astype(np.intp)
+    seg = np.repeat(np.arange(len(n)), n)
+    t = (np.arange(len(seg)) - np.repeat(np.cumsum(n) - n, n)) / np.repeat(
+        n, n)
+    pxs = xs[seg] + (xs[seg + 1] - xs[seg]) * t
+    pys = ys[seg] + (ys[seg + 1] - ys[seg]) * t
+    _stamp(img, pxs, pys, color, max(0, (width - 1) // 2))
+
+
+def draw_crosses(img, xs, ys, color, size=3):
+    """
+    Draws a "+" marker at each of the given pixel coordinates.
+    """
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    for d in range(-size, size + 1):
+        _stamp(img, xs + d, ys, color, 0)
+        _stamp(img, xs, ys + d, color, 0)
+
+
+def encode_png(img, text=None, level=6):
+    """
+    Encodes the given uint8 RGB image of shape (height, width, 3) as PNG file
+    and returns the corresponding bytes. "text" may be a dictionary containing
+    keyword/value pairs which are stored as tEXt chunks.
+    """
+
+    def chunk(tag, data):
+        return (struct.pack(">I", len(data)) + tag + data + struct.pack(
+            ">I", zlib.crc32(tag + data) & 0xFFFFFFFF))
+
+    img = np.ascontiguousarray(img, dtype=np.uint8)
+    h, w = img.shape[0:2]
+
+    # Prepend the filter type byte (0, no filter) to each scanline
+    raw = np.zeros((h, w * 3 + 1), dtype=np.uint8)
+    raw[:, 1:] = img.reshape(h, w * 3)
+
+    res = [b"\x89PNG\r\n\x1a\n",
+           chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 2, 0, 0, 0))]
+    for key, value in (text or {}).items():
+        res.append(chunk(b"tEXt", key.encode("latin-1") + b"\x00" +
+                         str(value).encode("latin-1", "replace")))
+    res.append(chunk(b"IDAT", zlib.compress(raw.tobytes(), level)))
+    res.append(chunk(b"IEND", b""))
+    return b"".join(res)
+
+
+def render(zzs,
+           extents,
+           vmin,
+           vmax,
+           cmap="jet",
+           border=None,
+           stations=None,
+           colorbar=True):
+    """
+    Renders the given interpolated field into an RGB image. zzs is indexed
+    as (longitude, latitude) with ascending coordinates, as returned by
+    PyDWDApi.interpolate_grid.
+
+    extents : tuple
+        Map extents (min_lat, max_lat, min_lon, max_lon).
+    border : list or None
+        List of (lon, lat) pairs describing a polyline that should be drawn
+        on top of the map.
+    stations : list or None
+        List of (lat, lon) pairs at which a marker should be drawn.
+    colorbar : bool
+        If True, a colorbar is appended to the bottom of the image.
+    """
+    min_lat, max_lat, min_lon, max_lon = extents
+
+    # Latitude should grow from the bottom to the top of the image
+    img = apply_colormap(zzs.T[::-1], vmin, vmax, cmap)
+    h, w = img.shape[0:2]
+
+    def to_px(lats, lons):
+        xs = (np.asarray(lons) - min_lon) / (max_lon - min_lon) * (w - 1)
+        ys = (max_lat - np.asarray(lats)) / (max_lat - min_lat) * (h - 1)
+        return xs, ys
+
+    if not border is None:
+        border = np.asarray(border)
+        xs, ys = to_px(border[:, 1], border[:, 0])
+        draw_polyline(img, xs, ys, BORDER_COLOR, max(1, w // 128))
+    if not stations is None and len(stations) > 0:
+        stations = np.asarray(stations)
+        xs, ys = to_px(stations[:, 0], stations[:, 1])
+        draw_crosses(img, xs, ys, STATION_COLOR, max(1, w // 128))
+    if colorbar:
+        bar = apply_colormap(np.linspace(vmin, vmax, w)[None, :], vmin, vmax,
+                             cmap)
+        img = np.concatenate((img, np.full((max(1, h // 64), w, 3), 255,
+                                           dtype=np.uint8),
+                              np.repeat(bar, max(2, h // 32), axis=0)))
+    return img
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#   Simple REST HTTP Weather Server using DWD weather data for Germany
+#   Copyright (C) 2016 Andreas Stöckel
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+from .database import Database, MODALITY_ID_MAP
+
+# Fetch the logger
+import logging
+logger = logging.getLogger("pydwdapi")
+
+# Schema shared by the aggregate tables. "last" is the value of the latest
+# observation within the bucket, "last_ts" the corresponding timestamp.
+TABLE_SCHEMA_AGGREGATES = """CREATE TABLE IF NOT EXISTS {table} (
+    timestamp real,
+    modality int,
+    station int,
+    count int,
+    mean real,
+    min real,
+    max real,
+    last real,
+    last_ts real,
+    PRIMARY KEY(modality, station, timestamp)
+);"""
+
+# Index on the aggregate tables used to find and process the oldest buckets of
+# a modality without scanning the whole table
+TABLE_INDEX_AGGREGATES = "CREATE INDEX IF NOT EXISTS {table}_modality_timestamp ON {table} (modality, timestamp)"
+
+# Names of the aggregate tables and the corresponding bucket size in seconds
+AGGREGATE_TABLES = {
+    "observations_hourly": 60 * 60,
+    "observations_daily": 24 * 60 * 60,
+}
+
+# Keeps an already existing aggregate for the same bucket. Buckets are always
+# rolled up as a whole, so an existing aggregate means that the bucket has
+# already been processed and the rows being rolled up were ingested again
+# (e.g. by replaying an archive), merging them would count them twice.
+SQL_MERGE_AGGREGATE = "ON CONFLICT(modality, station, timestamp) DO NOTHING"
+
+# Rolls up the raw observations in a time range into hourly aggregates. Rows
+# belonging to a day which has already been rolled up into a daily aggregate
+# are skipped.
+SQL_ROLLUP_RAW = """INSERT INTO observations_hourly
+SELECT CAST(o.timestamp / :bucket AS INTEGER) * :bucket AS bucket, o.modality,
+    o.station, COUNT(*), AVG(o.value), MIN(o.value), MAX(o.value),
+    (SELECT l.value FROM observations l WHERE l.station = o.station AND
+        l.modality = o.modality AND l.timestamp >= :t0 AND l.timestamp < :t1
+        AND CAST(l.timestamp / :bucket AS INTEGER) * :bucket =
+            CAST(o.timestamp / :bucket AS INTEGER) * :bucket
+        ORDER BY l.timestamp DESC LIMIT 1),
+    MAX(o.timestamp)
+FROM observations o WHERE o.modality = :modality AND o.timestamp >= :t0 AND
+    o.timestamp < :t1 AND NOT EXISTS (SELECT 1 FROM observations_daily d
+        WHERE d.modality = o.modality AND d.station = o.station AND
+        d.timestamp = CAST(o.timestamp / :daily AS INTEGER) * :daily)
+GROUP BY bucket, o.modality, o.station """ + SQL_MERGE_AGGREGATE
+
+# Rolls up hourly aggregates in a time range into daily aggregates
+SQL_ROLLUP_HOURLY = """INSERT INTO observations_daily
+SELECT CAST(o.timestamp / :bucket AS INTEGER) * :bucket AS bucket, o.modality,
+    o.station, SUM(o.count), SUM(o.mean * o.count) / SUM(o.count), MIN(o.min),
+    MAX(o.max),
+    (SELECT l.last FROM observations_hourly l WHERE l.station = o.station AND
+        l.modality = o.modality AND l.timestamp >= :t0 AND l.timestamp < :t1
+        AND CAST(l.timestamp / :bucket AS INTEGER) * :bucket =
+            CAST(o.timestamp / :bucket AS INTEGER) * :bucket
+        ORDER BY l.last_ts DESC LIMIT 1),
+    MAX(o.last_ts)
+FROM observations_hourly o WHERE o.modality = :modality AND
+    o.timestamp >= :t0 AND o.timestamp < :t1
+GROUP BY bucket, o.modality, o.station """ + SQL_MERGE_AGGREGATE
+
+# Default retention windows
+DEFAULT_RAW_WINDOW = 30 * 24 * 60 * 60
+DEFAULT_HOURLY_WINDOW = 365 * 24 * 60 * 60
+
+# Default amount of data (in seconds) processed in a single batch
+DEFAULT_BATCH_SPAN = 6 * 60 * 60
+
+# Number of pages freed by each incremental vacuum step
+VACUUM_PAGES = 1024
+
+
+class Retention:
+    """
+    The retention subsystem keeps raw observations for a configurable window,
+    rolls older observations up into hourly aggregates and hourly aggregates
+    older than a second window up into daily aggregates. Old rows are deleted
+    in small batches, each in its own transaction, such that concurrent readers
+    are only blocked for a short time. Freed pages are returned to the file
+    system using incremental vacuuming if the database supports it.
+    """
+
+    def __init__(self,
+                 database_file,
+                 raw_window=DEFAULT_RAW_WINDOW,
+                 hourly_window=DEFAULT_HOURLY_WINDOW,
+                 batch_span=DEFAULT_BATCH_SPAN,
+                 pause=0.1):
+        """
+        database_file : str
+            Path of the database file.
+        raw_window : float
+            Time in seconds for which raw observations are kept.
+        hourly_window : float
+            Time in seconds for which hourly aggregates are kept. Must be
+            larger than raw_window.
+        batch_span : float
+            Time range in seconds which is rolled up and deleted per batch.
+        pause : float
+            Time in seconds to sleep between two batches.
+        """
+        self.database_file = database_file
+        self.raw_window = raw_window
+        self.hourly_window = max(hourly_window, raw_window)
+        self.batch_span = batch_span
+        self.pause = pause
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    @staticmethod
+    def create_tables(database):
+        for table in AGGREGATE_TABLES:
+            database.conn.execute(TABLE_SCHEMA_AGGREGATES.format(table=table))
+            database.conn.execute(TABLE_INDEX_AGGREGATES.format(table=table))
+
+    @staticmethod
+    def enable_incremental_vacuum(database):
+        """
+        Switches the database to incremental auto-vacuum mode. This requires a
+        full VACUUM and should only be done once, while the database is not in
+        use.
+        """
+        database.conn.commit()
+        database.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        database.conn.execute("VACUUM")
+
+    def _oldest(self, database, table, modality):
+        res = database.conn.execute(
+            "SELECT MIN(timestamp) FROM " + table + " WHERE modality = ?",
+            (modality, )).fetchone()
+        return None if res[0] is None else float(res[0])
+
+    def _batch(self, database, src, sql, bucket, cutoff, modality):
+        """
+        Rolls up and deletes the oldest rows of the given modality in the given
+        source table older than the cutoff. Returns the number of deleted rows,
+        zero if there is nothing left to do. Restricting each batch to a single
+        modality allows all queries to use the (modality, timestamp) indices.
+        """
+        cutoff = (cutoff // bucket) * bucket
+        oldest = self._oldest(database, src, modality)
+        if oldest is None or oldest >= cutoff:
+            return 0
+
+        # Process whole buckets only, such that each bucket is aggregated in a
+        # single query
+        t0 = (oldest // bucket) * bucket
+        t1 = min(cutoff, t0 + max(bucket, (self.batch_span // bucket) * bucket))
+        database.conn.execute(sql, {
+            "bucket": bucket,
+            "daily": AGGREGATE_TABLES["observations_daily"],
+            "t0": t0,
+            "t1": t1,
+            "modality": modality
+        })
+        changes = database.conn.total_changes
+        database.conn.execute(
+            "DELETE FROM " + src + " WHERE modality = ? AND timestamp >= ? "
+            "AND timestamp < ?", (modality, t0, t1))
+        database.conn.commit()
+        return database.conn.total_changes - changes
+
+    def _vacuum(self, database):
+        mode = database.conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        if mode == 2:
+            database.conn.execute("PRAGMA incremental_vacuum(" + str(
+                VACUUM_PAGES) + ")").fetchall()
+            database.conn.commit()
+
+    def run(self, now=None, max_batches=None):
+        """
+        Performs the roll-up and deletion of old data. Returns the number of
+        deleted raw and hourly rows.
+
+        now : float
+            Current time, defaults to time.time().
+        max_batches : int
+            Maximum number of batches to process, None for no limit.
+        """
+        now = time.time() if now is None else now
+        counts = {"observations": 0, "observations_hourly": 0}
+        batches = 0
+        with Database(self.database_file) as database:
+            self.create_tables(database)
+            database.conn.commit()
+            for src, sql, bucket, window in [
+                ("observations", SQL_ROLLUP_RAW,
+                 AGGREGATE_TABLES["observations_hourly"], self.raw_window),
+                ("observations_hourly", SQL_ROLLUP_HOURLY,
+                 AGGREGATE_TABLES["observations_daily"], self.hourly_window)
+            ]:
+                for modality in sorted(MODALITY_ID_MAP.keys()):
+                    while (max_batches is None or batches < max_batches) and \
+                            not self.stop_event.is_set():
+                        n = self._batch(database, src, sql, bucket,
+                                        now - window, modality)
+                        if n == 0:
+                            break
+                        counts[src] += n
+                        batches += 1
+                        self._vacuum(database)
+                        if self.pause > 0:
+                            time.sleep(self.pause)
+        if counts["observations"] > 0 or counts["observations_hourly"] > 0:
+            logger.info("Retention: rolled up and deleted " + str(counts[
+                "observations"]) + " raw and " + str(counts[
+                    "observations_hourly"]) + " hourly row(s)")
+        return counts
+
+    def start(self, interval=60 * 60):
+        """
+        Starts a background thread which runs the retention every "interval"
+        seconds.
+        """
+        if not self.thread is None:
+            return
+
+        def loop():
+            while not self.stop_event.is_set():
+                try:
+                    self.run()
+                except Exception:
+                    logger.exception("Exception while applying retention")
+                self.stop_event.wait(interval)
+
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops the background thread.
+        """
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+################################################################################
+# MAIN PROGRAM
+################################################################################
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(
+        description='Rolls up and deletes old observations')
+    parser.add_argument('database', type=str, help='Database file')
+    parser.add_argument('--raw-days',
+                        dest='raw_days',
+                        type=float,
+                        default=DEFAULT_RAW_WINDOW / (24 * 60 * 60),
+                        help='Number of days raw observations are kept')
+    parser.add_argument('--hourly-days',
+                        dest='hourly_days',
+                        type=float,
+                        default=DEFAULT_HOURLY_WINDOW / (24 * 60 * 60),
+                        help='Number of days hourly aggregates are kept')
+    parser.add_argument('--enable-incremental-vacuum',
+                        dest='enable_incremental_vacuum',
+                        action="store_true",
+                        default=False,
+                        help='Switch the database to incremental vacuum mode '
+                        '(requires a full VACUUM)')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.DEBUG,
+        format='%(filename)s:%(lineno)s %(levelname)s:%(message)s')
+
+    if args.enable_incremental_vacuum:
+        with Database(args.database) as database:
+            Retention.enable_incremental_vacuum(database)
+    retention = Retention(args.database, args.raw_days * 24 * 60 * 60,
+                          args.hourly_days * 24 * 60 * 60, pause=0.0)
+    print(retention.run())
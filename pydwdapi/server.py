@@ -17,14 +17,56 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import http.server
+import io
+import ipaddress
 import json
+import numpy as np
 import urllib.parse
 import socketserver
+import time
+
+from . import metrics, PyDWDApiException
+from .database import MODALITY_MAP
+from .history import AGGREGATIONS, steps
 
 import logging
 logger = logging.getLogger("pydwdapi")
 
 
+# Maximum resolution of a grid which can be requested via /api/1.0/grid
+MAX_GRID_RESOLUTION = 1024
+
+
+# Number of history entries written to the socket at once
+HISTORY_BLOCK_SIZE = 1024
+
+
+# Paths for which separate request latency histograms are recorded
+METRIC_PATHS = set([
+    "/api/1.0/weather", "/api/1.0/station", "/api/1.0/stations",
+    "/api/1.0/nearest", "/api/1.0/history", "/api/1.0/grid", "/metrics"
+])
+
+
+def gauges(api):
+    """
+    Returns the cache sizes and statistics of the given PyDWDApi instance as
+    gauges, see Metrics.render().
+    """
+    res = {
+        ("pydwdapi_interpolator_cache_size", ()): len(api.interpolators),
+        ("pydwdapi_series_interpolator_cache_size", ()):
+        len(api.series_interpolators),
+    }
+    stats = api.stats()
+    for key, value in stats.pop("factorizations").items():
+        res[("pydwdapi_kernel_factorizations", (("result", key), ))] = value
+    for kind, stats in stats.items():
+        for key, value in stats.items():
+            res[("pydwdapi_singleflight_" + key, (("kind", kind), ))] = value
+    return res
+
+
 def create_server(api, port=8080, interface="127.0.0.1"):
     """
     Creates a new HTTP server instance which serves api requests.
@@ -51,8 +93,78 @@ def create_server(api, port=8080, interface="127.0.0.1"):
             self.end_headers()
 
             # Write the file
-            self.wfile.write(
-                json.dumps(obj, indent=2, sort_keys=True).encode("utf-8"))
+            with metrics.registry.stage("json_encode"):
+                data = json.dumps(obj, indent=2, sort_keys=True).encode("utf-8")
+            self.wfile.write(data)
+
+        def _send_text(self, http_code, text, content_type):
+            # Make sure only one response is sent
+            if self.done:
+                return
+            self.done = True
+
+            data = text.encode("utf-8")
+            self.send_response(http_code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _send_array(self, http_code, arr, fmt="npy", headers={}):
+            # Make sure only one response is sent
+            if self.done:
+                return
+            self.done = True
+
+            # Either write a NumPy .npy file or the raw array data, in which
+            # case the array shape is only transmitted in the header
+            if fmt == "npy":
+                f = io.BytesIO()
+                np.lib.format.write_array_header_1_0(
+                    f, np.lib.format.header_data_from_array_1_0(arr))
+                header = f.getvalue()
+                content_type = "application/x-npy"
+            else:
+                header = b""
+                content_type = "application/octet-stream"
+
+            self.send_response(http_code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(header) + arr.nbytes))
+            self.send_header("X-Array-Shape", ",".join(map(str, arr.shape)))
+            self.send_header("X-Array-Dtype", arr.dtype.str)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+
+            # Stream the array buffer without copying it
+            self.wfile.write(header)
+            self.wfile.write(memoryview(np.ascontiguousarray(arr)).cast("B"))
+
+        def _send_history(self, http_code, history):
+            # Make sure only one response is sent
+            if self.done:
+                return
+            self.done = True
+
+            self.send_response(http_code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.end_headers()
+
+            # Stream the (timestamp, value) pairs in blocks instead of
+            # assembling the entire JSON document in memory
+            self.wfile.write(("{\"meta\": " + json.dumps(
+                history["meta"], sort_keys=True) + ", \"data\": [").encode(
+                    "utf-8"))
+            ts, values = history["dt"], history["values"]
+            for i in range(0, len(ts), HISTORY_BLOCK_SIZE):
+                block = ",".join(
+                    "[" + repr(float(t)) + "," + repr(round(float(v), 2)) + "]"
+                    for t, v in zip(ts[i:(i + HISTORY_BLOCK_SIZE)],
+                                    values[i:(i + HISTORY_BLOCK_SIZE)]))
+                self.wfile.write(((", " if i > 0 else "") + block).encode(
+                    "utf-8"))
+            self.wfile.write(b"]}")
 
         def _error(self, http_code, msg):
             self._send_json(http_code, {"error": msg})
@@ -97,11 +209,137 @@ def create_server(api, port=8080, interface="127.0.0.1"):
             api.update()
             return api.query_stations(station_ids, ts)
 
+        def _handle_api_1_0_grid(self, o, q):
+            """
+            Handles queries to the /api/1.0/grid url.
+            """
+            try:
+                extents = list(map(float, q["bbox"][0].split(",")))
+                if len(extents) != 4:
+                    raise Exception("bbox must contain four values")
+                modalities = q["modalities"][0].split(",")
+                for modality in modalities:
+                    if not modality in MODALITY_MAP:
+                        raise Exception("Unknown modality " + modality)
+                resolution = int(q["resolution"][0]) if "resolution" in q else 256
+                if resolution < 2 or resolution > MAX_GRID_RESOLUTION:
+                    raise Exception("Invalid resolution")
+                alt = float(q["alt"][0]) if "alt" in q else None
+                ts = float(q["ts"][0]) if "ts" in q else None
+                fmt = q["format"][0] if "format" in q else "npy"
+                if not fmt in ["npy", "raw"]:
+                    raise Exception("Invalid format")
+            except Exception:
+                logger.exception("Error while parsing the arguments")
+                self._error(400, "Invalid query")
+                return
+
+            # Query the weather data and stream the response
+            api.update()
+            arr, res_ts = api.query_grid(modalities, extents, resolution, alt,
+                                         ts)
+            self._send_array(200, arr, fmt, {
+                "X-Grid-Modalities": ",".join(modalities),
+                "X-Grid-Extents": ",".join(map(str, extents)),
+                "X-Grid-Timestamp": str(res_ts)
+            })
+
+        def _handle_api_1_0_history(self, o, q):
+            """
+            Handles queries to the /api/1.0/history url. The time range
+            [start, end) is half-open for both stations and locations.
+            """
+            try:
+                modality = q["modality"][0]
+                if not modality in MODALITY_MAP:
+                    raise Exception("Unknown modality " + modality)
+                station_id = int(q["id"][0]) if "id" in q else None
+                if station_id is None:
+                    lat = float(q["lat"][0])
+                    lon = float(q["lon"][0])
+                    alt = float(q["alt"][0]) if "alt" in q else None
+                else:
+                    lat, lon, alt = None, None, None
+                end = float(q["end"][0]) if "end" in q else time.time()
+                start = (float(q["start"][0]) if "start" in q else
+                         end - 24 * 60 * 60)
+                step = float(q["step"][0]) if "step" in q else 60 * 60
+                agg = q["agg"][0] if "agg" in q else "mean"
+                if not agg in AGGREGATIONS:
+                    raise Exception("Unknown aggregation " + agg)
+                steps(start, end, step)
+            except Exception:
+                logger.exception("Error while parsing the arguments")
+                self._error(400, "Invalid query")
+                return
+
+            # Query the weather data and stream the response
+            api.update()
+            self._send_history(200, api.query_history(
+                modality, start, end, step, station_id, lat, lon, alt, agg))
+
         def _handle_api_1_0_stations(self, o, q):
             """
             Handles queries to the /api/1.0/stations url.
             """
-            return sorted(api.stations.name_and_location_list())
+            return api.stations.name_and_location_list()
+
+        def _handle_api_1_0_nearest(self, o, q):
+            """
+            Handles queries to the /api/1.0/nearest url.
+            """
+            try:
+                lat = float(q["lat"][0])
+                lon = float(q["lon"][0])
+                k = int(q["k"][0]) if "k" in q else 5
+                radius = float(q["radius"][0]) if "radius" in q else None
+                ts = float(q["ts"][0]) if "ts" in q else None
+            except Exception:
+                logger.exception("Error while parsing the arguments")
+                self._error(400, "Invalid query")
+                return
+
+            # Query the weather data and fetch the response
+            api.update()
+            return api.query_nearest_stations(lat, lon, k, radius, ts)
+
+        def _handle_metrics(self, o, q):
+            """
+            Handles queries to the /metrics url, returns the metrics in the
+            Prometheus text format.
+            """
+            self._send_text(200, metrics.registry.render(gauges(api)),
+                            metrics.CONTENT_TYPE)
+
+        def _profile_requested(self):
+            """
+            Returns True if the client requested a profile of this request by
+            passing the profiler's query token in the "profile" query
+            parameter. Only honoured for clients connecting from localhost.
+            """
+            if not api.profiler.query_token:
+                return False
+            q = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query,
+                                      keep_blank_values=True)
+            if not "profile" in q or not ipaddress.ip_address(
+                    self.client_address[0]).is_loopback:
+                return False
+            return api.profiler.check_token(q["profile"][0])
+
+        def _send_profile(self):
+            """
+            Handles the request under the profiler and sends the profile
+            instead of the actual response, which is discarded.
+            """
+            wfile = self.wfile
+            self.wfile = io.BytesIO()
+            try:
+                _, profile = api.profiler.run(self._timed_dispatch, "request")
+            finally:
+                self.wfile = wfile
+            self.done = False
+            self._send_text(200, api.profiler.report(profile),
+                            "text/plain; charset=utf-8")
 
         def do_GET(self):
             """
@@ -109,6 +347,24 @@ def create_server(api, port=8080, interface="127.0.0.1"):
             routing and error handling.
             """
             self.done = False
+            if not api.profiler is None:
+                if self._profile_requested():
+                    return self._send_profile()
+                if api.profiler.sample("request"):
+                    return api.profiler.run(self._timed_dispatch,
+                                            "request")[0]
+            return self._timed_dispatch()
+
+        def _timed_dispatch(self):
+            if not metrics.registry.enabled:
+                return self._dispatch()
+            path = urllib.parse.urlparse(self.path).path
+            with metrics.registry.timer(
+                    "pydwdapi_request_seconds",
+                (("path", path if path in METRIC_PATHS else "other"), )):
+                return self._dispatch()
+
+        def _dispatch(self):
             try:
                 # Make sure the URL is correct
                 o = urllib.parse.urlparse(self.path)
@@ -119,10 +375,21 @@ def create_server(api, port=8080, interface="127.0.0.1"):
                     response = self._handle_api_1_0_station(o, q)
                 elif o.path == "/api/1.0/stations":
                     response = self._handle_api_1_0_stations(o, q)
+                elif o.path == "/api/1.0/nearest":
+                    response = self._handle_api_1_0_nearest(o, q)
+                elif o.path == "/api/1.0/history":
+                    response = self._handle_api_1_0_history(o, q)
+                elif o.path == "/api/1.0/grid":
+                    response = self._handle_api_1_0_grid(o, q)
+                elif o.path == "/metrics":
+                    response = self._handle_metrics(o, q)
                 else:
                     self._error(404,
                                 "Requested file " + o.path + " not found!")
                     return
+            except PyDWDApiException as e:
+                self._error(400, str(e))
+                return
             except:
                 logger.exception("Error while processing the request")
                 self._error(500, "Internal error")
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+#   Simple REST HTTP Weather Server using DWD weather data for Germany
+#   Copyright (C) 2016 Andreas Stöckel
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import struct
+import numpy as np
+
+from .interpolator import (Interpolator, LocalInterpolator,
+                           MODALITY_ALTITUDE_WEIGHT)
+
+# Fetch the logger
+import logging
+logger = logging.getLogger("pydwdapi")
+
+# Magic bytes at the beginning of each snapshot file
+SNAPSHOT_MAGIC = b"PYDWDSNP"
+
+# Version of the snapshot file format, snapshots with a different version are
+# ignored
+SNAPSHOT_VERSION = 1
+
+# Alignment of the arrays stored in the snapshot file
+SNAPSHOT_ALIGNMENT = 64
+
+# Arrays stored for each interpolator, if present. Local interpolators do not
+# have nodes.
+SNAPSHOT_ARRAYS = ["tbl", "station_ids", "nodes"]
+
+
+def stations_fingerprint(stations):
+    """
+    Returns a hash of the station coordinates -- snapshots created with
+    different station coordinates are ignored.
+    """
+    h = hashlib.sha1()
+    for sid in sorted(stations.coords.keys()):
+        h.update(repr((sid, stations.coords[sid])).encode("utf-8"))
+    return h.hexdigest()
+
+
+def save(filename, interpolators, stations):
+    """
+    Writes the solved state of the given interpolators to a snapshot file. The
+    file is written to a temporary file first and then atomically moved to the
+    target location, such that concurrent readers never see partial files.
+
+    The file consists of the magic bytes, the format version and the length
+    of a JSON header describing the interpolators, followed by the header and
+    the raw array data, each array aligned to SNAPSHOT_ALIGNMENT bytes.
+
+    interpolators : dict
+        Map from (modality, latest_ts) to Interpolator instances.
+    """
+    entries, blobs = [], []
+    offset = 0
+    for (modality, latest_ts), interpolator in interpolators.items():
+        entry = {
+            "modality": modality,
+            "latest_ts": latest_ts,
+            "min_value": float(interpolator.min_value),
+            "max_value": float(interpolator.max_value),
+            "altitude_weight": float(interpolator.altitude_weight),
+            "engine": interpolator.engine,
+            "arrays": {}
+        }
+        if isinstance(interpolator, LocalInterpolator):
+            entry["neighbours"] = interpolator.neighbours
+        for name in SNAPSHOT_ARRAYS:
+            if not hasattr(interpolator, name):
+                continue
+            arr = np.ascontiguousarray(getattr(interpolator, name))
+            arr = arr.astype(arr.dtype.newbyteorder("<"), copy=False)
+            offset = -(-offset // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+            entry["arrays"][name] = [offset, arr.dtype.str, list(arr.shape)]
+            blobs.append((offset, arr))
+            offset += arr.nbytes
+        entries.append(entry)
+
+    header = json.dumps({
+        "stations": stations_fingerprint(stations),
+        "interpolators": entries
+    }).encode("utf-8")
+    data_start = len(SNAPSHOT_MAGIC) + 8 + len(header)
+    data_start = -(-data_start // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+
+    tmp = filename + ".tmp." + str(os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack("<II", SNAPSHOT_VERSION, len(header)))
+        f.write(header)
+        for blob_offset, arr in blobs:
+            f.seek(data_start + blob_offset)
+            f.write(arr.tobytes())
+    os.replace(tmp, filename)
+
+
+def load(filename, stations, mmap=True):
+    """
+    Loads the interpolators stored in the given snapshot file. Returns a map
+    from (modality, latest_ts) to Interpolator instances. If the file does not
+    exist, has an incompatible version or was created for different stations,
+    an empty map is returned. If mmap is True, the arrays are memory-mapped
+    instead of being read into memory.
+    """
+    if not os.path.exists(filename):
+        return {}
+    try:
+        with open(filename, "rb") as f:
+            if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                raise Exception("Invalid magic bytes")
+            version, header_len = struct.unpack("<II", f.read(8))
+            if version != SNAPSHOT_VERSION:
+                logger.info("Ignoring snapshot " + filename + " with version "
+                            + str(version))
+                return {}
+            header = json.loads(f.read(header_len).decode("utf-8"))
+        if header["stations"] != stations_fingerprint(stations):
+            logger.info("Ignoring snapshot " + filename +
+                        " created for different stations")
+            return {}
+        data_start = len(SNAPSHOT_MAGIC) + 8 + header_len
+        data_start = -(-data_start // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+        data = (np.memmap(filename, dtype=np.uint8, mode="r")
+                if mmap else np.fromfile(filename, dtype=np.uint8))
+
+        res = {}
+        for entry in header["interpolators"]:
+            modality = entry["modality"]
+            weight = (MODALITY_ALTITUDE_WEIGHT[modality]
+                      if modality in MODALITY_ALTITUDE_WEIGHT else 1.0)
+            if weight != entry["altitude_weight"]:
+                continue
+            arrays = {}
+            for name, (offset, dtype, shape) in entry["arrays"].items():
+                dtype = np.dtype(dtype)
+                start = data_start + offset
+                end = start + dtype.itemsize * int(np.prod(shape))
+                arrays[name] = data[start:end].view(dtype).reshape(shape)
+            engine = entry.get("engine", "rbf")
+            if engine == "rbf":
+                interpolator = Interpolator.from_state(
+                    modality, arrays["tbl"], arrays["station_ids"],
+                    arrays["nodes"], entry["min_value"], entry["max_value"],
+                    entry["altitude_weight"])
+            else:
+                interpolator = LocalInterpolator.from_state(
+                    modality, arrays["tbl"], arrays["station_ids"],
+                    entry["min_value"], entry["max_value"],
+                    entry["altitude_weight"], engine, entry["neighbours"])
+            res[(modality, entry["latest_ts"])] = interpolator
+        return res
+    except Exception:
+        logger.exception("Error while loading the snapshot " + filename)
+        return {}
@@ -17,12 +17,15 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import ftplib
+import os
 import time
 import re
 import xml.etree.ElementTree
 
+from . import compiled_cache
 from . import ftp_util
 from . import html_dwd_observation_parser
+from . import metrics
 
 # Fetch the logger
 import logging
@@ -38,95 +41,312 @@ MIN_BACKOFF = 60.0
 MAX_BACKOFF = 600.0
 
 
+class FTPSourceType:
+    """
+    Source type downloading the newest file matching the source from the DWD
+    FTP server. The connection is established lazily upon the first download
+    and shared between all sources of this type.
+    """
+
+    # Failed or missing updates are retried with exponential backoff
+    backoff = True
+
+    def __init__(self, ftp_user, ftp_password):
+        self.ftp_user = ftp_user
+        self.ftp_password = ftp_password
+        self.session = None
+        self.warned = False
+
+    def fetch(self, source, since):
+        """
+        Returns a list of (modified, filename, data) triples, oldest first, or
+        None if the source is not available.
+        """
+        if not self.ftp_user or not self.ftp_password:
+            if not self.warned:
+                logger.warn("No username or password given, will not download new data")
+                self.warned = True
+            return None
+        with metrics.registry.stage("ftp_download"):
+            if self.session is None:
+                logger.info("Connecting to ftp://" + self.ftp_user + "@" +
+                            DWD_SERVER + "/")
+                self.session = ftplib.FTP()
+                self.session.connect(DWD_SERVER)
+                self.session.login(self.ftp_user, self.ftp_password)
+            res = ftp_util.download_newest(self.session, source["path"],
+                                           re.compile(source["matcher"]).match)
+        if len(res) == 0:
+            logger.warn("Failed to download data from " + source["path"])
+        metrics.registry.inc("pydwdapi_ftp_bytes_total",
+                             sum(len(r[2]) for r in res))
+        return res
+
+    def close(self):
+        if not self.session is None:
+            self.session.close()
+            self.session = None
+
+
+class LocalDirSourceType:
+    """
+    Source type reading saved DWD HTML files from a local directory. The
+    directory is scanned for matching files with a modification time not older
+    than the last ingested file, all of which are returned, oldest first.
+    Files sharing the modification time of the last ingested file are returned
+    as well, Sources skips those which have already been processed. This
+    allows to replay archived data at full speed and to run without network
+    access or credentials. The directory is scanned at most once per source
+    timeout.
+    """
+
+    # Files are read as soon as they appear, files which cannot be parsed are
+    # skipped
+    backoff = False
+
+    def __init__(self, ftp_user, ftp_password):
+        pass
+
+    def fetch(self, source, since):
+        """
+        Scans the directory and returns an iterator over the (modified,
+        filename, data) triples of the matching files, oldest first, or None if
+        the directory cannot be read.
+        """
+        with metrics.registry.stage("local_dir_scan"):
+            matcher = re.compile(source["matcher"]).match
+            files = []
+            try:
+                with os.scandir(source["path"]) as it:
+                    for entry in it:
+                        if entry.is_file() and matcher(entry.name):
+                            modified = entry.stat().st_mtime
+                            if modified >= since:
+                                files.append((modified, entry.name,
+                                              entry.path))
+            except OSError as e:
+                logger.warning("Failed to scan " + source["path"] + ": " +
+                               str(e))
+                return None
+            files.sort()
+        return self._read(files)
+
+    def _read(self, files):
+        # Read the files lazily, such that large directories can be replayed.
+        # Files which vanished since the scan are skipped.
+        for modified, filename, path in files:
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except OSError as e:
+                logger.warning("Failed to read " + path + ": " + str(e))
+                continue
+            yield modified, filename, data
+
+    def close(self):
+        pass
+
+
+# Map from the source type names used in the sources.xml file to the classes
+# implementing them. Source types are constructed with the FTP credentials and
+# must provide a fetch(source, since) method returning (modified, filename,
+# data) triples, oldest first, or None if the source is currently not available,
+# a close() method and a "backoff" attribute.
+SOURCE_TYPES = {
+    "html_dwd_observations": FTPSourceType,
+    "local_dir": LocalDirSourceType,
+}
+
+
+def register_source_type(name, cls):
+    """
+    Registers an additional source type which can then be referenced in the
+    sources.xml file.
+    """
+    SOURCE_TYPES[name] = cls
+
+
 class Sources:
     """
     Class responsible for keeping the data stored in the data-base up to date
     by downloading the raw data from the corresponding servers.
     """
 
-    def __init__(self, config_file):
-        self.sources = {}
+    def __init__(self, config_file, archive=None, cache=False):
+        """
+        config_file : str
+            Path of the sources.xml file.
+        archive : Archive
+            If given, all fetched raw files are appended to this archive before
+            being parsed, see archive.py.
+        cache : bool
+            If True, the parsed file is stored in a compiled cache file next
+            to the configuration file, see compiled_cache.py.
+        """
         self.backoff = {}
+        self.archive = archive
+
+        # Modification time and names of the files processed last for each
+        # source, used to skip files sharing the modification time of the last
+        # ingested file which have already been processed
+        self.processed = {}
 
+        # Wall-clock time of the last scan of each source without backoff,
+        # used to rate-limit the scans according to the source timeout
+        self.scanned = {}
+        if cache:
+            self.sources = compiled_cache.load(config_file, self._read,
+                                               "sources")
+        else:
+            self.sources = self._read(config_file)
+        for source in self.sources.values():
+            if not source["type"] in SOURCE_TYPES:
+                raise Exception("Unknown source type \"" + source["type"] +
+                                "\"")
+
+    @staticmethod
+    def _read(config_file):
+        """
+        Parses the sources.xml file, returns a map from source ids to the
+        source configuration.
+        """
+        sources = {}
         tree = xml.etree.ElementTree.parse(config_file)
         for source in tree.getroot():
             if source.tag == "source":
-                self.sources[int(source.attrib["id"])] = {
+                sources[int(source.attrib["id"])] = {
                     "type": source.find("type").text,
                     "path": source.find("path").text,
                     "matcher": source.find("matcher").text,
                     "timeout": float(source.find("timeout").text)
                 }
+        return sources
 
     def update(self, ftp_user, ftp_password, stations, database):
-        # Lazily connect to the server
-        connected = {"value": False}
+        with metrics.registry.stage("sources_update"):
+            return self._update(ftp_user, ftp_password, stations, database)
 
-        def connect(f):
-            if not connected["value"]:
-                logger.info("Connecting to ftp://" + ftp_user + "@" +
-                            DWD_SERVER + "/")
-                f.connect(DWD_SERVER)
-                f.login(ftp_user, ftp_password)
-            connected["value"] = True
+    @staticmethod
+    def parse(source_id, modified, data, stations):
+        """
+        Parses the given raw file and returns the list of observations in the
+        format expected by Database.store_observations().
+        """
+        with metrics.registry.stage("parse"):
+            parsed = html_dwd_observation_parser.parse(
+                str(data, "latin-1"), stations)
+        observations = []
+        for modality, elems in parsed.items():
+            logger.debug("Writing " + str(len(elems)) +
+                         " value(s) for modality " + modality +
+                         " from source " + str(source_id))
+            for station_id, value in elems:
+                observations.append(
+                    (modified, value, modality, station_id, source_id))
+        return observations
+
+    @staticmethod
+    def ingest(source_id, modified, data, stations, database):
+        """
+        Parses the given raw file and stores the observations in the database.
+        Returns the number of inserted observations.
+        """
+        observations = Sources.parse(source_id, modified, data, stations)
+        with metrics.registry.stage("ingest"):
+            inserted = database.store_observations(observations)
+        metrics.registry.inc("pydwdapi_ingest_rows_total", inserted)
+        return inserted
+
+    def _update(self, ftp_user, ftp_password, stations, database):
+        # Source type instances are created lazily, such that e.g. no FTP
+        # connection is established if no FTP source needs to be updated
+        source_types = {}
 
         has_changes = False
-        with ftplib.FTP() as f:
+        try:
             # Iterate over all sources an check whether a source needs to be
             # updated
             now = time.time()
             for source_id, source in self.sources.items():
                 source_time = database.get_source_time(source_id)
                 timeout = source["timeout"]
-                if now - source_time > timeout:
-                    # Make sure we are connected to the server and download the
-                    # newest files
-                    connect(f)
-                    res = ftp_util.download_newest(
-                        f, source["path"], re.compile(source["matcher"]).match)
-                    if (len(res) == 0):
-                        logger.warn("Failed to download data from " + source[
-                            "path"])
-
-                    # Check whether the data was actually updated
-                    modified, filename, data = res[0]
-                    if modified > source_time:
-                        # Parse the data and store the results in the database
-                        try:
-                            parsed = html_dwd_observation_parser.parse(
-                                str(data, "latin-1"), stations)
-                            for modality, elems in parsed.items():
-                                logger.debug("Writing " + str(len(
-                                    elems)) + " value(s) for modality " +
-                                             modality + " from source " +
-                                             source["path"])
-                                for station_id, value in elems:
-                                    database.store_observation(
-                                        modified, value, modality, station_id,
-                                        source_id)
-                                    has_changes = True
-                            database.set_source_time(source_id, modified)
-                            self.backoff[source_id] = 0  # Reset the backoff
-                            continue
-                        except Exception:
-                            logger.exception(
-                                "Exception while parsing the observation data")
-
-                    # There was no update -- try again in a few minutes with
-                    # exponential backoff (min 1-10 minute wait time)
-                    if not source_id in self.backoff:
-                        self.backoff[source_id] = 0.0
-                    self.backoff[source_id] = min(MAX_BACKOFF, max(
-                        MIN_BACKOFF, self.backoff[source_id] * 1.5))
-                    database.set_source_time(
-                        source_id, now - timeout + self.backoff[source_id])
-                    logger.debug("No update for " + source["path"] +
-                                 ", trying again in " + str(
-                                     int(self.backoff[source_id])) + "s")
-                else:
+                check_time = max(source_time,
+                                 self.scanned.get(source_id, 0.0))
+                if now - check_time <= timeout:
                     logger.debug("Source " + source["path"] +
                                  " is up to date, next update in " + str(
-                                     int(timeout - now + source_time)) + "s")
+                                     int(timeout - now + check_time)) + "s")
+                    continue
+
+                if not source["type"] in source_types:
+                    source_types[source["type"]] = SOURCE_TYPES[source[
+                        "type"]](ftp_user, ftp_password)
+                source_type = source_types[source["type"]]
+
+                # Fetch the new files, parse the data and store the results in
+                # the database
+                files = source_type.fetch(source, source_time)
+                if not source_type.backoff:
+                    self.scanned[source_id] = now
+                if files is None:
+                    continue
+                latest = source_time
+                seen = set()
+                if source_id in self.processed and self.processed[source_id][
+                        0] == source_time:
+                    seen = self.processed[source_id][1]
+                for modified, filename, data in files:
+                    # Files with the same modification time as the latest file
+                    # are only skipped if they have already been processed.
+                    # Source types with backoff only return the newest file,
+                    # which has been processed if its time did not change.
+                    if modified < latest or (modified == latest and (
+                            source_type.backoff or filename in seen)):
+                        continue
+                    if not self.archive is None:
+                        try:
+                            with metrics.registry.stage("archive"):
+                                self.archive.append(source_id, modified,
+                                                    filename, data)
+                        except Exception:
+                            logger.exception("Exception while archiving " +
+                                             filename)
+                    try:
+                        if self.ingest(source_id, modified, data, stations,
+                                       database) > 0:
+                            has_changes = True
+                    except Exception:
+                        logger.exception(
+                            "Exception while parsing the observation data in "
+                            + filename)
+                        if source_type.backoff:
+                            break
+                    if modified > latest:
+                        seen = set()
+                    seen.add(filename)
+                    latest = modified
+                self.processed[source_id] = (latest, seen)
+                if latest > source_time:
+                    database.set_source_time(source_id, latest)
+                    self.backoff[source_id] = 0  # Reset the backoff
+                    continue
+                if not source_type.backoff:
+                    continue
+
+                # There was no update -- try again in a few minutes with
+                # exponential backoff (min 1-10 minute wait time)
+                if not source_id in self.backoff:
+                    self.backoff[source_id] = 0.0
+                self.backoff[source_id] = min(MAX_BACKOFF, max(
+                    MIN_BACKOFF, self.backoff[source_id] * 1.5))
+                database.set_source_time(
+                    source_id, now - timeout + self.backoff[source_id])
+                logger.debug("No update for " + source["path"] +
+                             ", trying again in " + str(
+                                 int(self.backoff[source_id])) + "s")
+        finally:
+            for source_type in source_types.values():
+                source_type.close()
         return has_changes
 
 ################################################################################
@@ -16,8 +16,28 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import threading
+import numpy as np
 import xml.etree.ElementTree
 
+from . import compiled_cache
+
+# Mean earth radius in km, used to compute the station ECEF coordinates
+EARTH_RADIUS = 6371.0
+
+
+def ecef(lats, lons):
+    """
+    Converts the given latitudes and longitudes (in degrees) to earth-centered,
+    earth-fixed cartesian coordinates (in km) on a spherical earth. Returns an
+    array of shape (..., 3).
+    """
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    lons = np.radians(np.asarray(lons, dtype=np.float64))
+    return EARTH_RADIUS * np.stack(
+        (np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons),
+         np.sin(lats)), -1)
+
 
 class Stations:
     """
@@ -26,10 +46,43 @@ class Stations:
     stations.xml file.
     """
 
-    def __init__(self, config_file):
-        self.ids = {}
-        self.names = {}
-        self.coords = {}
+    def __init__(self, config_file, cache=False):
+        """
+        config_file : str
+            Path of the stations.xml file.
+        cache : bool
+            If True, the parsed file is stored in a compiled cache file next
+            to the configuration file, see compiled_cache.py.
+        """
+        if cache:
+            self.ids, self.names, self.coords = compiled_cache.load(
+                config_file, self._read, "stations")
+        else:
+            self.ids, self.names, self.coords = self._read(config_file)
+
+        # Assemble the sorted list of station names and locations once
+        res = []
+        for sid in self.ids.keys():
+            sname = sorted(self.ids[sid], key=lambda x: len(x))[0]
+            slat, slon, salt = self.coords[sid]
+            res.append((sname, slat, slon, salt, sid))
+        self._name_and_location_list = tuple(sorted(res))
+
+        # The spatial index over the station ECEF coordinates is built upon
+        # first use, see the index property
+        self.index_ids = np.array(sorted(self.coords.keys()), dtype=np.int64)
+        self._index = None
+        self._index_lock = threading.Lock()
+
+    @staticmethod
+    def _read(config_file):
+        """
+        Parses the stations.xml file, returns the maps from station ids to
+        names, from names to ids and from ids to coordinates.
+        """
+        ids = {}
+        names = {}
+        coords = {}
 
         tree = xml.etree.ElementTree.parse(config_file)
         for child in tree.getroot():
@@ -39,15 +92,15 @@ class Stations:
                 sid = int(child.attrib["id"])
 
                 # Store the mapping from id to possible names
-                if sid in self.ids:
-                    self.ids[sid].append(sname)
+                if sid in ids:
+                    ids[sid].append(sname)
                 else:
-                    self.ids[sid] = [sname]
+                    ids[sid] = [sname]
 
                 # Store a mapping from the name to the id
-                if sname in self.names:
+                if sname in names:
                     raise Exception("Duplicate name \"" + sname + "\"")
-                self.names[sname] = sid
+                names[sname] = sid
 
                 # Store a mapping from the id to the coordinates -- coordinates
                 # must not be present
@@ -56,25 +109,74 @@ class Stations:
                     slat = float(child.attrib["lat"])
                     slon = float(child.attrib["lon"])
                     salt = float(child.attrib["alt"])
-                    self.coords[sid] = (slat, slon, salt)
+                    coords[sid] = (slat, slon, salt)
 
         # Make sure each id has one coordinate pair
-        for sid in self.ids.keys():
-            if not sid in self.coords:
+        for sid in ids.keys():
+            if not sid in coords:
                 raise Exception("No coordinates specified for station " + str(
                     sid))
 
+        return ids, names, coords
+
+    @property
+    def index(self):
+        """
+        KD-tree over the station ECEF coordinates, ordered as index_ids. None
+        if there are no stations. Building the tree requires SciPy, which is
+        thus only imported once the index is used.
+        """
+        if self._index is None and len(self.index_ids) > 0:
+            with self._index_lock:
+                if self._index is None:
+                    import scipy.spatial
+                    coords = np.array(
+                        [self.coords[sid] for sid in self.index_ids])
+                    self._index = scipy.spatial.cKDTree(
+                        ecef(coords[:, 0], coords[:, 1]))
+        return self._index
+
     def name_and_location_list(self):
         """
-        Returns a list containing the name and location of each station. The
-        shortes available name is returned.
+        Returns a list containing the name and location of each station, sorted
+        by name. The shortest available name is returned. The list is only
+        computed once and must not be modified.
         """
-        res = []
-        for sid in self.ids.keys():
-            sname = sorted(self.ids[sid], key=lambda x: len(x))[0]
-            slat, slon, salt = self.coords[sid]
-            res.append((sname, slat, slon, salt, sid))
-        return res
+        return self._name_and_location_list
+
+    def nearest(self, lat, lon, k=1):
+        """
+        Returns a list of up to k pairs (station_id, distance) containing the
+        stations closest to the given location, sorted by their distance.
+        Distances are great-circle distances in km.
+        """
+        if self.index is None or k <= 0:
+            return []
+        k = min(k, len(self.index_ids))
+        ds, idcs = self.index.query(ecef(lat, lon), k=[i + 1 for i in range(k)])
+        return [(int(self.index_ids[i]), self._chord_to_distance(d))
+                for d, i in zip(ds, idcs)]
+
+    def within(self, lat, lon, radius):
+        """
+        Returns a list of pairs (station_id, distance) containing all stations
+        with a great-circle distance of at most radius km from the given
+        location, sorted by their distance.
+        """
+        if self.index is None:
+            return []
+        radius = min(radius, np.pi * EARTH_RADIUS)
+        chord = 2.0 * EARTH_RADIUS * np.sin(radius / (2.0 * EARTH_RADIUS))
+        p = ecef(lat, lon)
+        idcs = self.index.query_ball_point(p, chord * (1.0 + 1e-9))
+        ds = np.linalg.norm(self.index.data[idcs] - p, axis=-1)
+        return [(int(self.index_ids[idcs[i]]), self._chord_to_distance(ds[i]))
+                for i in np.argsort(ds, kind="stable")]
+
+    @staticmethod
+    def _chord_to_distance(d):
+        return float(2.0 * EARTH_RADIUS * np.arcsin(
+            min(1.0, d / (2.0 * EARTH_RADIUS))))
 
 ################################################################################
 # MAIN PROGRAM
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#   Simple REST HTTP Weather Server using DWD weather data for Germany
+#   Copyright (C) 2016 Andreas Stöckel
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import concurrent.futures
+import time
+import numpy as np
+
+from .database import Database, MODALITY_MAP
+from .interpolator import (create_interpolator, DEFAULT_NEIGHBOURS, ENGINES,
+                           MODALITY_ALTITUDE_WEIGHT, MODALITY_NO_CLAMP)
+
+# Fetch the logger
+import logging
+logger = logging.getLogger("pydwdapi")
+
+# Default number of snapshots evaluated per modality
+DEFAULT_SNAPSHOTS = 50
+
+# Maximum age of the observations in a snapshot in seconds, matches the default
+# of PyDWDApi
+DEFAULT_MAX_AGE = 4 * 60 * 60
+
+# Minimum number of stations in a snapshot
+MIN_STATIONS = 4
+
+# Number of random points at which the evaluation time is measured
+EVALUATION_POINTS = 4096
+
+# Seed used to generate the evaluation points
+SEED = 4718
+
+
+def parameter_grid(engines=("rbf", ), altitude_weights=None,
+                   neighbours=None):
+    """
+    Returns the list of (engine, altitude_weight, neighbours) combinations to
+    evaluate. An altitude weight of None refers to the weight of the modality
+    in MODALITY_ALTITUDE_WEIGHT, the number of neighbours is None for the
+    global engine.
+    """
+    altitude_weights = [None] if altitude_weights is None else altitude_weights
+    neighbours = [DEFAULT_NEIGHBOURS] if neighbours is None else neighbours
+    res = []
+    for engine in engines:
+        if not engine in ENGINES:
+            raise Exception("Unknown interpolation engine \"" + engine + "\"")
+        for altitude_weight in altitude_weights:
+            for k in ([None] if engine == "rbf" else neighbours):
+                res.append((engine, altitude_weight, k))
+    return res
+
+
+def snapshot_timestamps(database, modality, start=None, end=None,
+                        snapshots=DEFAULT_SNAPSHOTS):
+    """
+    Returns up to the given number of observation timestamps of the modality in
+    the given time range, evenly spread over the available timestamps.
+    """
+    ts = database.query_timestamps(modality, -1e20 if start is None else start,
+                                   1e20 if end is None else end)
+    if len(ts) > snapshots:
+        ts = [ts[i] for i in np.linspace(0, len(ts) - 1, snapshots).astype(int)]
+    return ts
+
+
+def errors(interpolator):
+    """
+    Returns the leave-one-out prediction error of the given interpolator at
+    each station. Predictions are clamped to the range of the remaining
+    stations, as the interpolator would be if built without the station. The
+    residuals of the global radial basis function interpolator are computed in
+    closed form, see Interpolator.leave_one_out(), such that sweeping over
+    parameters does not require refitting the interpolator for each station.
+    """
+    truth = interpolator._join_values(interpolator.tbl[:, 3:].T)
+    pred = interpolator._join_values(interpolator.leave_one_out().T)
+    if interpolator.modality in MODALITY_NO_CLAMP:
+        d = np.abs(pred - truth) % 360.0
+        return np.minimum(d, 360.0 - d)
+
+    # Range of the values without the station itself
+    order = np.argsort(truth, kind="stable")
+    lo = np.full(len(truth), truth[order[0]])
+    hi = np.full(len(truth), truth[order[-1]])
+    lo[order[0]] = truth[order[1]]
+    hi[order[-1]] = truth[order[-2]]
+    return np.abs(np.clip(pred, lo, hi) - truth)
+
+
+def evaluate(observations, stations, modality, parameters):
+    """
+    Evaluates all parameter combinations on a single snapshot. Returns a list
+    of dictionaries containing the number of stations, the sum of absolute
+    and squared errors and the build, leave-one-out and evaluation times.
+    """
+    rng = np.random.RandomState(SEED)
+    res = []
+    for engine, altitude_weight, k in parameters:
+        t0 = time.perf_counter()
+        interpolator = create_interpolator(
+            observations,
+            stations,
+            modality,
+            engine,
+            neighbours=DEFAULT_NEIGHBOURS if k is None else k,
+            altitude_weight=altitude_weight)
+        t1 = time.perf_counter()
+        e = errors(interpolator)
+        t2 = time.perf_counter()
+
+        # Evaluate at random points within the bounding box of the stations
+        tbl = interpolator.tbl
+        idcs = rng.randint(tbl.shape[0], size=EVALUATION_POINTS)
+        lats = rng.uniform(np.min(tbl[:, 0]), np.max(tbl[:, 0]),
+                           EVALUATION_POINTS)
+        lons = rng.uniform(np.min(tbl[:, 1]), np.max(tbl[:, 1]),
+                           EVALUATION_POINTS)
+        t3 = time.perf_counter()
+        interpolator.interpolate(lats, lons, tbl[idcs, 2])
+        t4 = time.perf_counter()
+
+        res.append({
+            "engine": engine,
+            "altitude_weight": interpolator.altitude_weight,
+            "neighbours": k,
+            "stations": len(e),
+            "sum_abs": float(np.sum(e)),
+            "sum_sq": float(np.sum(e**2)),
+            "max": float(np.max(e)),
+            "build": t1 - t0,
+            "leave_one_out": t2 - t1,
+            "evaluate": t4 - t3
+        })
+    return res
+
+
+_worker_state = {}
+
+
+def _init_worker(database_file, stations_file):
+    from .stations import Stations
+    _worker_state["database"] = Database(database_file)
+    _worker_state["stations"] = Stations(stations_file)
+
+
+def _evaluate_snapshot(task):
+    """
+    Loads a snapshot from the database and evaluates it in a worker process.
+    """
+    modality, ts, max_age, parameters = task
+    observations = _worker_state["database"].query_observations(
+        modality, ts - max_age, ts)
+    observations = {
+        sid: obs
+        for sid, obs in observations.items()
+        if sid in _worker_state["stations"].coords
+    }
+    if len(observations) < MIN_STATIONS:
+        return modality, ts, []
+    try:
+        return modality, ts, evaluate(observations, _worker_state["stations"],
+                                      modality, parameters)
+    except Exception:
+        logger.exception("Error while evaluating " + modality + " at " +
+                         str(ts))
+        return modality, ts, []
+
+
+def aggregate(results):
+    """
+    Combines the per-snapshot results into one entry per modality and
+    parameter combination, containing the mean absolute and root mean square
+    error over all stations and snapshots as well as the mean timings.
+    """
+    groups = {}
+    for modality, ts, entries in results:
+        for entry in entries:
+            key = (modality, entry["engine"], entry["altitude_weight"],
+                   entry["neighbours"])
+            if not key in groups:
+                groups[key] = []
+            groups[key].append(entry)
+    res = []
+    for (modality, engine, altitude_weight, k), entries in groups.items():
+        n = sum(entry["stations"] for entry in entries)
+        res.append({
+            "modality": modality,
+            "engine": engine,
+            "altitude_weight": altitude_weight,
+            "neighbours": k,
+            "default": (altitude_weight == (
+                MODALITY_ALTITUDE_WEIGHT[modality]
+                if modality in MODALITY_ALTITUDE_WEIGHT else 1.0)),
+            "snapshots": len(entries),
+            "stations": n / len(entries),
+            "mae": sum(entry["sum_abs"] for entry in entries) / n,
+            "rmse": float(np.sqrt(
+                sum(entry["sum_sq"] for entry in entries) / n)),
+            "max": max(entry["max"] for entry in entries),
+            "build": float(np.mean([entry["build"] for entry in entries])),
+            "leave_one_out": float(np.mean(
+                [entry["leave_one_out"] for entry in entries])),
+            "evaluate": float(np.mean(
+                [entry["evaluate"] for entry in entries])),
+        })
+    res.sort(key=lambda x: (x["modality"], x["rmse"]))
+    return res
+
+
+def run(database_file,
+        stations_file,
+        modalities=None,
+        parameters=None,
+        start=None,
+        end=None,
+        snapshots=DEFAULT_SNAPSHOTS,
+        max_age=DEFAULT_MAX_AGE,
+        workers=None):
+    """
+    Leave-one-out cross-validation of the interpolation engines. Evaluates the
+    given parameter combinations (see parameter_grid()) on up to "snapshots"
+    historical snapshots per modality in [start, end]: each station is
+    predicted from all other stations and the prediction error is reported
+    along with the time required to build and evaluate the interpolators.
+    The snapshots are evaluated by a pool of worker processes. Returns the
+    aggregated results, see aggregate().
+    """
+    modalities = sorted(MODALITY_MAP.keys()) if modalities is None else \
+        modalities
+    parameters = parameter_grid() if parameters is None else parameters
+    tasks = []
+    with Database(database_file) as database:
+        for modality in modalities:
+            for ts in snapshot_timestamps(database, modality, start, end,
+                                          snapshots):
+                tasks.append((modality, ts, max_age, parameters))
+    logger.info("Evaluating " + str(len(parameters)) +
+                " parameter combination(s) on " + str(len(tasks)) +
+                " snapshot(s)")
+
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=_init_worker,
+            initargs=(database_file, stations_file)) as executor:
+        results = list(executor.map(_evaluate_snapshot, tasks, chunksize=4))
+    return aggregate(results)
+
+
+def report(results):
+    """
+    Returns the aggregated results as a human readable table. Rows using the
+    current default altitude weight of the modality are marked with "*".
+    """
+    lines = [
+        "{:<16} {:<10} {:>8} {:>4} {:>5} {:>6} {:>8} {:>8} {:>9} {:>9} {:>9}"
+        .format("modality", "engine", "weight", "k", "snaps", "n", "mae",
+                "rmse", "build ms", "loo ms", "eval ms")
+    ]
+    for r in results:
+        lines.append(
+            "{:<16} {:<10} {:>7.1f}{} {:>4} {:>5} {:>6.1f} {:>8.3f} {:>8.3f} "
+            "{:>9.2f} {:>9.2f} {:>9.2f}".format(
+                r["modality"], r["engine"], r["altitude_weight"],
+                "*" if r["default"] else " ",
+                "-" if r["neighbours"] is None else r["neighbours"],
+                r["snapshots"], r["stations"], r["mae"], r["rmse"],
+                r["build"] * 1000.0, r["leave_one_out"] * 1000.0,
+                r["evaluate"] * 1000.0))
+    return "\n".join(lines) + "\n"
+
+################################################################################
+# MAIN PROGRAM
+################################################################################
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    import sys
+
+    def floats(s):
+        return list(map(float, s.split(",")))
+
+    def ints(s):
+        return list(map(int, s.split(",")))
+
+    parser = argparse.ArgumentParser(
+        description='Leave-one-out cross-validation of the interpolators')
+    parser.add_argument('database', type=str, help='Observation database')
+    parser.add_argument('--stations',
+                        type=str,
+                        default='./data/stations.xml',
+                        help='Stations file')
+    parser.add_argument('--modalities',
+                        type=str,
+                        default=None,
+                        help='Comma separated modalities, defaults to all')
+    parser.add_argument('--engines',
+                        type=str,
+                        default='rbf',
+                        help='Comma separated interpolation engines')
+    parser.add_argument('--altitude-weights',
+                        dest='altitude_weights',
+                        type=floats,
+                        default=None,
+                        help='Comma separated altitude weights, defaults to '
+                        'the weight of each modality')
+    parser.add_argument('--neighbours',
+                        type=ints,
+                        default=None,
+                        help='Comma separated neighbour counts for the local '
+                        'engines')
+    parser.add_argument('--snapshots',
+                        type=int,
+                        default=DEFAULT_SNAPSHOTS,
+                        help='Number of snapshots per modality')
+    parser.add_argument('--start',
+                        type=float,
+                        default=None,
+                        help='Start of the time range (Unix time)')
+    parser.add_argument('--end',
+                        type=float,
+                        default=None,
+                        help='End of the time range (Unix time)')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=None,
+                        help='Number of worker processes')
+    parser.add_argument('--output',
+                        type=str,
+                        default=None,
+                        help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format='%(filename)s:%(lineno)s %(levelname)s:%(message)s')
+
+    results = run(args.database,
+                  args.stations,
+                  None if args.modalities is None else
+                  args.modalities.split(","),
+                  parameter_grid(args.engines.split(","),
+                                 args.altitude_weights, args.neighbours),
+                  args.start,
+                  args.end,
+                  args.snapshots,
+                  workers=args.workers)
+    sys.stdout.write(report(results))
+    if not args.output is None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
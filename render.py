@@ -17,7 +17,9 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import numpy as np
 import sys
+import time
 
 # Fetch the logger
 import logging
@@ -39,7 +41,39 @@ if __name__ == '__main__':
                         dest='modality',
                         required=True,
                         type=str,
-                        help='Modality to plot.')
+                        nargs='+',
+                        help='Modality or list of modalities to plot.')
+    parser.add_argument('--start',
+                        dest='start',
+                        type=float,
+                        default=None,
+                        help='Unix timestamp of the first frame. If given, '
+                        'one map per time step is rendered for each modality')
+    parser.add_argument('--end',
+                        dest='end',
+                        type=float,
+                        default=None,
+                        help='Unix timestamp of the last frame, defaults to '
+                        'the current time')
+    parser.add_argument('--step',
+                        dest='step',
+                        type=float,
+                        default=3600.0,
+                        help='Time between two frames in seconds')
+    parser.add_argument('--workers',
+                        dest='workers',
+                        type=int,
+                        default=None,
+                        help='Number of worker processes, defaults to the '
+                        'number of CPUs. Workers are forked from the main '
+                        'process where supported; otherwise each worker '
+                        'loads the altitude data, stations and database '
+                        'state on start-up')
+    parser.add_argument('--output-dir',
+                        dest='output_dir',
+                        type=str,
+                        default=".",
+                        help='Directory the maps are written to')
     parser.add_argument('--bare',
                         dest='bare',
                         action="store_true",
@@ -50,11 +84,24 @@ if __name__ == '__main__':
                         type=int,
                         default=256,
                         help='Map resolution in pixels')
+    parser.add_argument('--backend',
+                        dest='backend',
+                        type=str,
+                        choices=["matplotlib", "raster"],
+                        default="matplotlib",
+                        help='Rendering backend. The "raster" backend does not '
+                        'require matplotlib, is much faster and only supports '
+                        'PNG output')
     parser.add_argument('--format',
                         dest='format',
                         type=str,
                         default="pdf",
                         help='Output format')
+    parser.add_argument('--single-precision',
+                        dest='single_precision',
+                        action='store_true',
+                        default=False,
+                        help='Evaluate the maps in single precision')
     args = parser.parse_args()
 
     # Setup logging
@@ -66,16 +113,27 @@ if __name__ == '__main__':
     # Map extents -- min_lat, max_lat, min_lon, max_lon
     extents = [47.0, 55.1, 5.8, 15.1]
 
-    # Create the API and plot the map
+    # Assemble the timestamps that should be rendered
+    if args.start is None:
+        timestamps = [None]
+    else:
+        end = time.time() if args.end is None else args.end
+        timestamps = list(np.arange(args.start, end + 1e-3, args.step))
+    if args.backend == "raster" and args.format != "png":
+        logger.warning("Raster backend only supports PNG output")
+
+    # Create the API, fetch the newest data and plot the maps
     import pydwdapi
-    api = pydwdapi.PyDWDApi(args.user, args.password)
+    import pydwdapi.batch
+    api = pydwdapi.PyDWDApi(args.user,
+                            args.password,
+                            single_precision=args.single_precision)
     api.update()
-    api.render_map(args.modality,
-                   extents,
-                   resolution=args.resolution,
-                   bare=args.bare).savefig(
-                       args.modality + "." + args.format,
-                       format=args.format,
-                       bbox_inches='tight',
-                       pad_inches=(0.0 if args.bare else 0.1))
-
+    jobs = pydwdapi.batch.create_jobs(args.modality, timestamps, extents,
+                                      args.resolution, args.bare,
+                                      args.backend, args.format,
+                                      args.output_dir)
+    pydwdapi.batch.render_batch(jobs,
+                                {"single_precision": args.single_precision},
+                                args.workers,
+                                api=api)
@@ -23,10 +23,46 @@ import logging
 logger = logging.getLogger("pydwdapi")
 
 if __name__ == '__main__':
-    if len(sys.argv) != 4:
-        sys.stderr.write(
-            "Usage: ./serve.py <DWD FTP USER> <DWD FTP PASSWORD> <PORT>\n")
-        sys.exit(1)
+    import argparse
+
+    parser = argparse.ArgumentParser(description='pydwdapi HTTP server')
+    parser.add_argument('ftp_user', type=str, help='DWD FTP user')
+    parser.add_argument('ftp_password', type=str, help='DWD FTP password')
+    parser.add_argument('port', type=int, help='HTTP port')
+    parser.add_argument('workers',
+                        type=int,
+                        nargs='?',
+                        default=None,
+                        help='Number of worker processes (pre-fork mode)')
+    parser.add_argument('--profile-requests',
+                        dest='profile_requests',
+                        type=int,
+                        default=0,
+                        help='Profile one in N requests')
+    parser.add_argument('--profile-updates',
+                        dest='profile_updates',
+                        type=int,
+                        default=0,
+                        help='Profile one in N update cycles')
+    parser.add_argument('--profile-dir',
+                        dest='profile_dir',
+                        type=str,
+                        default=None,
+                        help='Directory the profiles are written to')
+    parser.add_argument('--profile-query',
+                        dest='profile_query',
+                        type=str,
+                        default=None,
+                        metavar='TOKEN',
+                        help='Allow profiling requests from localhost by '
+                        'passing TOKEN in the "profile" query parameter')
+    parser.add_argument('--single-precision',
+                        dest='single_precision',
+                        action='store_true',
+                        default=False,
+                        help='Evaluate grids and store the altitude data in '
+                        'single precision')
+    args = parser.parse_args()
 
     # Setup logging
     logging.basicConfig(
@@ -34,17 +70,48 @@ if __name__ == '__main__':
         level=logging.INFO,
         format='%(filename)s:%(lineno)s %(levelname)s:%(message)s')
 
+    # Create the profiler, if requested
+    profiler = None
+    if (args.profile_requests > 0 or args.profile_updates > 0 or
+            not args.profile_query is None):
+        import pydwdapi.profiling
+        profiler = pydwdapi.profiling.Profiler(
+            args.profile_requests, args.profile_updates, args.profile_dir,
+            args.profile_query)
+
     # Create the API instance
     import pydwdapi
     import pydwdapi.server
-    api = pydwdapi.PyDWDApi(sys.argv[1], sys.argv[2])
+    api = pydwdapi.PyDWDApi(args.ftp_user,
+                            args.ftp_password,
+                            enable_metrics=True,
+                            profiler=profiler,
+                            single_precision=args.single_precision)
+
+    # Start the pre-fork server if a number of workers is given
+    if not args.workers is None:
+        import pydwdapi.prefork
+        logger.info("Starting HTTP server with " + str(args.workers) +
+                    " workers...")
+        try:
+            pydwdapi.prefork.serve_prefork(api, args.port,
+                                           workers=args.workers)
+        except KeyboardInterrupt:
+            logger.info("Stopping server...")
+        logger.info("Done.")
+        sys.exit(0)
 
     # Start the server
     logger.info("Starting HTTP server...")
-    httpd = pydwdapi.server.create_server(api, int(sys.argv[3]))
+    httpd = pydwdapi.server.create_server(api, args.port)
+
+    # Load the altitude data and migrate databases created by older versions
+    # while already accepting connections
+    api.preload(background=True)
+    api.migrate(background=True)
 
     # Handle the requests until CTRL+C is pressed
-    logger.info("Listening on port " + sys.argv[3])
+    logger.info("Listening on port " + str(args.port))
     try:
         while True:
             httpd.handle_request()
@@ -52,4 +119,3 @@ if __name__ == '__main__':
         logger.info("Stopping server...")
         pass
     logger.info("Done.")
-
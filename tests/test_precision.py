@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+#   Simple REST HTTP Weather Server using DWD weather data for Germany
+#   Copyright (C) 2016 Andreas Stöckel
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Checks the documented error bounds of the single precision evaluation against
+the double precision path on a fixed synthetic station network.
+"""
+
+import io
+import numpy as np
+import pytest
+
+from pydwdapi.altitude_data import AltitudeData
+from pydwdapi.benchmark import (EXTENTS, synthetic_altitude_data,
+                                synthetic_observations, synthetic_stations)
+from pydwdapi.interpolator import (ENGINES, FLOAT32_ERROR_FACTOR,
+                                   create_interpolator)
+
+# Size of the synthetic station network, matches the DWD network
+NETWORK_SIZE = 180
+
+# Resolution of the evaluation grid
+GRID_SIZE = 64
+
+
+@pytest.fixture(scope="module")
+def stations(tmp_path_factory):
+    return synthetic_stations(
+        str(tmp_path_factory.mktemp("precision") / "stations.xml"),
+        NETWORK_SIZE)
+
+
+@pytest.fixture(scope="module")
+def grid():
+    lats, lons = np.meshgrid(np.linspace(EXTENTS[0], EXTENTS[1], GRID_SIZE),
+                             np.linspace(EXTENTS[2], EXTENTS[3], GRID_SIZE))
+    alts = np.random.RandomState(1).uniform(0.0, 1500.0, lats.shape)
+    return lats, lons, alts
+
+
+def split_values(interpolator, kernel):
+    """
+    Evaluates the interpolator without joining the value dimensions.
+    """
+    if isinstance(kernel, tuple):
+        idcs, weights = kernel
+        return np.einsum("mk,mkd->md", weights,
+                         interpolator.tbl[:, 3:].astype(weights.dtype)[idcs])
+    return kernel @ interpolator.nodes.astype(kernel.dtype)
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+@pytest.mark.parametrize("modality", ["temperature", "pressure", "humidity"])
+def test_interpolate_kernel_float32(stations, grid, engine, modality):
+    interpolator = create_interpolator(
+        synthetic_observations(stations, modality), stations, modality,
+        engine)
+    k64 = interpolator.kernel(*grid)
+    k32 = interpolator.kernel(*grid, np.float32)
+    v64 = interpolator.interpolate_kernel(k64)
+    v32 = interpolator.interpolate_kernel(k32)
+    assert v32.dtype == np.float32
+    assert v64.dtype == np.float64
+    assert np.all(
+        np.abs(v32 - v64) <= interpolator.float32_error_bound(k64)[:, 0])
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_split_values_float32(stations, grid, engine):
+    interpolator = create_interpolator(
+        synthetic_observations(stations, "wind_direction"), stations,
+        "wind_direction", engine)
+    k64 = interpolator.kernel(*grid)
+    k32 = interpolator.kernel(*grid, np.float32)
+    d = np.abs(split_values(interpolator, k32) -
+               split_values(interpolator, k64))
+    assert d.shape == (GRID_SIZE * GRID_SIZE, 2)
+    assert np.all(d <= interpolator.float32_error_bound(k64))
+
+
+def test_interpolate_float32(stations, grid):
+    interpolator = create_interpolator(
+        synthetic_observations(stations, "temperature"), stations,
+        "temperature")
+    v64 = interpolator.interpolate(*grid)
+    v32 = interpolator.interpolate(*grid, np.float32)
+    bound = interpolator.float32_error_bound(interpolator.kernel(*grid))
+    assert v32.shape == grid[0].shape
+    assert np.all(np.abs(v32 - v64).ravel() <= bound[:, 0])
+
+
+def test_altitude_data_float32():
+    data = synthetic_altitude_data(nrows=120, ncols=160)
+    altitude_data = {}
+    for dtype in [np.float64, np.float32]:
+        altitude_data[dtype] = AltitudeData(dtype=dtype)
+        altitude_data[dtype].read(io.BytesIO(data))
+    assert altitude_data[np.float32].data.nbytes * 2 == altitude_data[
+        np.float64].data.nbytes
+
+    ref = altitude_data[np.float64]
+    rng = np.random.RandomState(2)
+    lats = rng.uniform(ref.ys[0], ref.ys[-1], 10000)
+    lons = rng.uniform(ref.xs[0], ref.xs[-1], 10000)
+    q64 = ref.query(lats, lons)
+    q32 = altitude_data[np.float32].query(lats, lons)
+    assert q32.dtype == np.float32
+    assert np.all(np.abs(q32 - q64) <= FLOAT32_ERROR_FACTOR *
+                  np.finfo(np.float32).eps * np.max(np.abs(ref.data)))